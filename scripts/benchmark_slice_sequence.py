@@ -0,0 +1,46 @@
+"""Times the metadata slicing of the datasets (BaseDataset._slice_sequence) on synthetic annotation tables"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from soundbay.data import BaseDataset
+
+
+def synthetic_metadata(n_rows: int, seq_length: float, windows_per_row: float, seed: int = 0) -> pd.DataFrame:
+    """annotations with half background and half calls, windows_per_row windows long on average"""
+    rng = np.random.default_rng(seed)
+    begin_time = np.round(rng.uniform(0, 3600, n_rows), 3)
+    call_length = np.round(rng.uniform(0, 2 * windows_per_row * seq_length, n_rows), 3)
+    return pd.DataFrame({'filename': rng.integers(0, 1000, n_rows).astype(str),
+                         'begin_time': begin_time,
+                         'end_time': begin_time + call_length,
+                         'label': rng.integers(0, 2, n_rows),
+                         'call_length': call_length})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the metadata slicing of the datasets')
+    parser.add_argument('--windows', type=int, nargs='+', default=[10 ** 5, 10 ** 6, 10 ** 7],
+                        help='approximate numbers of output windows')
+    parser.add_argument('--seq-length', type=float, default=1.0, help='window length in seconds')
+    parser.add_argument('--windows-per-row', type=float, default=5, help='average windows per annotation')
+    args = parser.parse_args()
+
+    dataset = BaseDataset.__new__(BaseDataset)
+    dataset.seq_length = args.seq_length
+    for n_windows in args.windows:
+        dataset.metadata = synthetic_metadata(int(n_windows / args.windows_per_row), args.seq_length,
+                                              args.windows_per_row)
+        dataset._labels = dataset.metadata['label'].values.astype(np.int64)
+        n_rows = len(dataset.metadata)
+        start = time.perf_counter()
+        dataset._slice_sequence()
+        elapsed = time.perf_counter() - start
+        print(f'{n_rows} rows -> {len(dataset.metadata)} windows: {elapsed:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
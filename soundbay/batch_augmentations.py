@@ -0,0 +1,239 @@
+"""soundbay batched augmentations - torch versions of the audiomentations we use that augment a whole batch at once,
+with random parameters drawn per sample. Parameter names follow https://github.com/iver56/audiomentations"""
+
+import random
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Union
+
+import numpy as np
+import soundfile as sf
+import torch
+import torchaudio
+
+
+def _uniform(low: float, high: float, n: int, device) -> torch.Tensor:
+    return low + (high - low) * torch.rand(n, device=device)
+
+
+def _frequency_to_mel(freq):
+    return 2595 * np.log10(1 + freq / 700)
+
+
+def _mel_to_frequency(mel):
+    return 700 * (10 ** (mel / 2595) - 1)
+
+
+class BatchAugmentation:
+    """
+    Base class of the batched augmentations. Samples are a [B, ..., T] tensor, every sample is augmented with
+    probability p and gets its own random parameters.
+    """
+    supports_multichannel = True
+
+    def __init__(self, p: float = 0.5):
+        assert 0 <= p <= 1
+        self.p = p
+
+    def __call__(self, samples: torch.Tensor, sample_rate: int) -> torch.Tensor:
+        should_apply = torch.rand(samples.shape[0], device=samples.device) < self.p
+        if not should_apply.any():
+            return samples
+        samples = samples.clone()
+        samples[should_apply] = self.apply(samples[should_apply], sample_rate)
+        return samples
+
+    def apply(self, samples: torch.Tensor, sample_rate: int) -> torch.Tensor:
+        raise NotImplementedError
+
+
+class BatchCompose:
+    """
+    Batched version of audiomentations.Compose: the whole chain is applied to each sample with probability p, the
+    order of the transforms is shuffled once per batch.
+    """
+
+    def __init__(self, transforms: List[BatchAugmentation], p: float = 1.0, shuffle: bool = False):
+        self.transforms = list(transforms)
+        self.p = p
+        self.shuffle = shuffle
+
+    def __call__(self, samples: torch.Tensor, sample_rate: int) -> torch.Tensor:
+        should_apply = torch.rand(samples.shape[0], device=samples.device) < self.p
+        if not should_apply.any():
+            return samples
+        transforms = random.sample(self.transforms, len(self.transforms)) if self.shuffle else self.transforms
+        augmented = samples[should_apply]
+        for transform in transforms:
+            augmented = transform(augmented, sample_rate)
+        samples = samples.clone()
+        samples[should_apply] = augmented
+        return samples
+
+
+class BatchGain(BatchAugmentation):
+    """Multiplies every sample by a random gain in [min_gain_in_db, max_gain_in_db]"""
+
+    def __init__(self, min_gain_in_db: float = -12, max_gain_in_db: float = 12, p: float = 0.5):
+        super().__init__(p)
+        assert min_gain_in_db <= max_gain_in_db
+        self.min_gain_in_db = min_gain_in_db
+        self.max_gain_in_db = max_gain_in_db
+
+    def apply(self, samples, sample_rate):
+        gain_in_db = _uniform(self.min_gain_in_db, self.max_gain_in_db, samples.shape[0], samples.device)
+        gain = 10 ** (gain_in_db / 20)
+        return samples * gain.view(-1, *([1] * (samples.dim() - 1)))
+
+
+class BatchTimeMask(BatchAugmentation):
+    """Silences a random part of every sample, of length min_band_part to max_band_part of the sample"""
+
+    def __init__(self, min_band_part: float = 0.0, max_band_part: float = 0.5, fade: bool = False, p: float = 0.5):
+        super().__init__(p)
+        assert 0 <= min_band_part <= max_band_part <= 1
+        self.min_band_part = min_band_part
+        self.max_band_part = max_band_part
+        self.fade = fade
+
+    def apply(self, samples, sample_rate):
+        batch_size, num_samples = samples.shape[0], samples.shape[-1]
+        t = (_uniform(self.min_band_part, self.max_band_part, batch_size, samples.device) * num_samples).long()
+        t0 = (torch.rand(batch_size, device=samples.device) * (num_samples - t + 1)).long().clamp(max=num_samples - t)
+        position = torch.arange(num_samples, device=samples.device).unsqueeze(0)
+        t, t0 = t.unsqueeze(1), t0.unsqueeze(1)
+        mask = ((position < t0) | (position >= t0 + t)).to(samples.dtype)
+        if self.fade:
+            fade_length = torch.clamp(torch.minimum(torch.full_like(t, int(sample_rate * 0.01)), t // 10), min=1)
+            fade_in = (t0 + fade_length - 1 - position) / fade_length
+            fade_out = (position - (t0 + t - fade_length)) / fade_length
+            mask = torch.maximum(mask, torch.clamp(torch.maximum(fade_in, fade_out), 0, 1))
+        return samples * mask.view(batch_size, *([1] * (samples.dim() - 2)), num_samples)
+
+
+class BatchBandStopFilter(BatchAugmentation):
+    """
+    Attenuates a random frequency band of every sample with a zero-phase butterworth band-stop response applied in
+    the frequency domain. As in audiomentations, the center frequency is drawn uniformly on the mel scale and the
+    bandwidth is a random fraction of it. zero_phase is accepted for config compatibility, the filter is always
+    zero phase.
+    """
+
+    def __init__(self, min_center_freq: float = 200.0, max_center_freq: float = 4000.0,
+                 min_bandwidth_fraction: float = 0.5, max_bandwidth_fraction: float = 1.99,
+                 min_rolloff: int = 12, max_rolloff: int = 24, zero_phase: bool = True, p: float = 0.5):
+        super().__init__(p)
+        assert min_center_freq <= max_center_freq
+        assert min_bandwidth_fraction <= max_bandwidth_fraction
+        assert min_rolloff <= max_rolloff and min_rolloff >= 6
+        self.min_center_freq = min_center_freq
+        self.max_center_freq = max_center_freq
+        self.min_bandwidth_fraction = min_bandwidth_fraction
+        self.max_bandwidth_fraction = max_bandwidth_fraction
+        self.min_rolloff = min_rolloff
+        self.max_rolloff = max_rolloff
+
+    def apply(self, samples, sample_rate):
+        batch_size, num_samples = samples.shape[0], samples.shape[-1]
+        device = samples.device
+        center_mel = _uniform(float(_frequency_to_mel(self.min_center_freq)),
+                              float(_frequency_to_mel(self.max_center_freq)), batch_size, device)
+        center_freq = _mel_to_frequency(center_mel)
+        bandwidth = center_freq * _uniform(self.min_bandwidth_fraction, self.max_bandwidth_fraction, batch_size,
+                                           device)
+        order = torch.randint(self.min_rolloff // 6, self.max_rolloff // 6 + 1, (batch_size,), device=device)
+        freqs = torch.fft.rfftfreq(num_samples, d=1 / sample_rate, device=device).unsqueeze(0)
+        center_freq, bandwidth, order = center_freq.unsqueeze(1), bandwidth.unsqueeze(1), order.unsqueeze(1)
+        # |H|^2 = 1 / (1 + (f * bw / (fc^2 - f^2))^(-2n)), the band-stop transform of a butterworth low-pass
+        ratio = (center_freq ** 2 - freqs ** 2) / (freqs * bandwidth + 1e-12)
+        response = 1 / torch.sqrt(1 + torch.abs(ratio).clamp(min=1e-12) ** (-2 * order))
+        spectrum = torch.fft.rfft(samples, dim=-1)
+        spectrum = spectrum * response.view(batch_size, *([1] * (samples.dim() - 2)), -1)
+        return torch.fft.irfft(spectrum, n=num_samples, dim=-1).to(samples.dtype)
+
+
+class BatchTimeStretch(BatchAugmentation):
+    """
+    Changes the speed of every sample by a random rate in [min_rate, max_rate] by resampling (linear interpolation).
+    Unlike audiomentations.TimeStretch (phase vocoder) the pitch changes with the speed, which is much cheaper and
+    batches. With leave_length_unchanged the output keeps the input length (cropped or zero padded at the end).
+    """
+
+    def __init__(self, min_rate: float = 0.8, max_rate: float = 1.25, leave_length_unchanged: bool = True,
+                 p: float = 0.5):
+        super().__init__(p)
+        assert 0 < min_rate <= max_rate
+        assert leave_length_unchanged, 'BatchTimeStretch keeps the batch shape, leave_length_unchanged must be True'
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.leave_length_unchanged = leave_length_unchanged
+
+    def apply(self, samples, sample_rate):
+        batch_size, num_samples = samples.shape[0], samples.shape[-1]
+        rate = _uniform(self.min_rate, self.max_rate, batch_size, samples.device).unsqueeze(1)
+        position = torch.arange(num_samples, device=samples.device).unsqueeze(0) * rate
+        left = position.floor().long().clamp(max=num_samples - 1)
+        right = (left + 1).clamp(max=num_samples - 1)
+        weight = (position - left).to(samples.dtype)
+        valid = (position <= num_samples - 1).to(samples.dtype)
+        shape = (batch_size, *([1] * (samples.dim() - 2)), num_samples)
+        left, right = left.view(shape).expand_as(samples), right.view(shape).expand_as(samples)
+        weight, valid = weight.view(shape), valid.view(shape)
+        stretched = torch.gather(samples, -1, left) * (1 - weight) + torch.gather(samples, -1, right) * weight
+        return stretched * valid
+
+
+class BatchAddBackgroundNoise(BatchAugmentation):
+    """
+    Mixes every sample with a random crop of a random noise file from sounds_path, at a random SNR in
+    [min_snr_in_db, max_snr_in_db]. Noise files are loaded as mono (channels are mixed together), resampled to the
+    sample rate if needed, and the last lru_cache_size of them are kept in memory.
+    """
+
+    def __init__(self, sounds_path: Union[List[Union[Path, str]], Path, str], min_snr_in_db: float = 3,
+                 max_snr_in_db: float = 30, p: float = 0.5, lru_cache_size: int = 2):
+        super().__init__(p)
+        assert min_snr_in_db <= max_snr_in_db
+        paths = sounds_path if isinstance(sounds_path, (list, tuple)) else [sounds_path]
+        self.sound_file_paths = []
+        for path in map(Path, paths):
+            self.sound_file_paths.extend(sorted(path.rglob('*.wav')) if path.is_dir() else [path])
+        assert len(self.sound_file_paths) > 0, f'no noise files found in {sounds_path}'
+        self.min_snr_in_db = min_snr_in_db
+        self.max_snr_in_db = max_snr_in_db
+        self.lru_cache_size = lru_cache_size
+        self._cache = OrderedDict()
+
+    def _load_sound(self, path: Path, sample_rate: int) -> torch.Tensor:
+        key = (path, sample_rate)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        data, file_sample_rate = sf.read(str(path), dtype='float32', always_2d=True)
+        noise = torch.from_numpy(data.mean(axis=1))
+        if file_sample_rate != sample_rate:
+            noise = torchaudio.functional.resample(noise, file_sample_rate, sample_rate)
+        self._cache[key] = noise
+        while len(self._cache) > max(self.lru_cache_size, 1):
+            self._cache.popitem(last=False)
+        return noise
+
+    def apply(self, samples, sample_rate):
+        batch_size, num_samples = samples.shape[0], samples.shape[-1]
+        noises = []
+        for _ in range(batch_size):
+            noise = self._load_sound(random.choice(self.sound_file_paths), sample_rate)
+            if len(noise) < num_samples:
+                noise = noise.repeat(num_samples // len(noise) + 1)
+            start = random.randint(0, len(noise) - num_samples)
+            noises.append(noise[start:start + num_samples])
+        noise = torch.stack(noises).to(samples.device, samples.dtype)
+        noise = noise.view(batch_size, *([1] * (samples.dim() - 2)), num_samples)
+        dims = tuple(range(1, samples.dim()))
+        clean_rms = torch.sqrt(torch.mean(samples ** 2, dim=dims, keepdim=True))
+        noise_rms = torch.sqrt(torch.mean(noise ** 2, dim=dims, keepdim=True))
+        snr_in_db = _uniform(self.min_snr_in_db, self.max_snr_in_db, batch_size, samples.device)
+        desired_noise_rms = clean_rms / (10 ** (snr_in_db.view_as(clean_rms) / 20))
+        # too silent noise files leave the sample unchanged
+        gain = torch.where(noise_rms < 1e-9, torch.zeros_like(noise_rms), desired_noise_rms / (noise_rms + 1e-12))
+        return samples + noise * gain
@@ -0,0 +1,111 @@
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset
+
+from soundbay.data import BaseDataset, BatchPreprocessor, InferenceDataset
+
+
+CASCADE_INPUTS = ('features', 'waveforms', 'read')
+
+
+class Cascade:
+    """
+    The second stage of a two stage inference. The windows whose call probability by the first-stage model (1 - the
+    probability of the first class, noise) is inside band are predicted again by a second, more expensive model, and
+    its predictions replace the first ones.
+    The second stage takes its input from the first-stage batch when it can: the features, when both stages
+    preprocess alike, or the waveforms (of a dataset with batch_preprocessing) when they have the same sample rate.
+    Otherwise the escalated windows are read again, by an InferenceDataset with the sample rate and the preprocessors
+    of the second stage. The number of windows and of escalated windows are counted for report.
+    Input:
+        model: the second-stage model, on device
+        preprocessors: the preprocessors arguments of the second stage
+        sample_rate: the sample rate of the second stage
+        band: (low, high), the first-stage call probabilities that are escalated, inclusive
+        first_stage_preprocessors: the preprocessors arguments of the first stage, the features are reused when they
+                                   are the same
+        device: cpu/gpu
+    """
+
+    def __init__(self, model: torch.nn.Module, preprocessors, sample_rate: int, band: Tuple[float, float] = (0.1, 0.9),
+                 first_stage_preprocessors=None, device: torch.device = torch.device('cpu')):
+        assert 0 <= band[0] <= band[1] <= 1, f'band should be (low, high) between 0 and 1, got {band}'
+        self.model = model.eval()
+        self.preprocessors = preprocessors
+        self.sample_rate = sample_rate
+        self.band = band
+        self.same_preprocessing = first_stage_preprocessors is not None and first_stage_preprocessors == preprocessors
+        self.batch_preprocessor = BatchPreprocessor(BaseDataset.set_preprocessor(preprocessors)).to(device)
+        self.device = device
+        self.n_windows, self.n_escalated = 0, 0
+        self.input = None
+        self._dataset = None
+
+    def bind(self, dataset):
+        """chooses the input of the second stage for the batches of a first-stage dataset"""
+        if dataset.sample_rate == self.sample_rate and self.same_preprocessing:
+            self.input = 'features'
+        elif dataset.sample_rate == self.sample_rate and dataset.batch_preprocessor is not None:
+            self.input = 'waveforms'
+        else:
+            if isinstance(dataset, IterableDataset):
+                raise ValueError('the second stage reads the windows again, and needs a map-style first-stage dataset')
+            self.input = 'read'
+            self._dataset = InferenceDataset(file_path=dataset.file_path, preprocessors=self.preprocessors,
+                                             seq_length=dataset.seq_length, data_sample_rate=dataset.data_sample_rate,
+                                             sample_rate=self.sample_rate, overlap=dataset.overlap,
+                                             window_slice=dataset.window_slice, channel=dataset.channel)
+
+    def refine(self, predictions: np.ndarray, waveforms: torch.Tensor, features: torch.Tensor,
+               indices: np.ndarray) -> np.ndarray:
+        """
+        predicts the escalated windows of a batch with the second model
+        Input:
+            predictions: the first-stage probabilities of the batch, [batch size, num classes]
+            waveforms: the batch as the data loader gives it, on device
+            features: the batch the first model took, on device
+            indices: the indices of the batch windows in the dataset
+        Output:
+            predictions: the probabilities of the batch, of the second stage for the escalated windows
+        """
+        call_probability = 1 - predictions[:, 0]
+        escalate = (call_probability >= self.band[0]) & (call_probability <= self.band[1])
+        self.n_windows += len(predictions)
+        self.n_escalated += int(escalate.sum())
+        if not escalate.any():
+            return predictions
+        if self.input == 'features':
+            audio = features[torch.from_numpy(escalate).to(features.device)]
+        elif self.input == 'waveforms':
+            audio = self.batch_preprocessor(waveforms[torch.from_numpy(escalate).to(waveforms.device)])
+        else:
+            audio = torch.stack([self._dataset[idx] for idx in indices[escalate]]).to(self.device)
+        with torch.no_grad():
+            second_stage = torch.softmax(self.model(audio), dim=1).cpu().numpy()
+        assert second_stage.shape[1] == predictions.shape[1], \
+            f'the second stage has {second_stage.shape[1]} classes, the first has {predictions.shape[1]}'
+        predictions = predictions.copy()
+        predictions[escalate] = second_stage
+        return predictions
+
+    def report(self, wall_time: Optional[float] = None, total_windows: Optional[int] = None) -> Dict[str, float]:
+        """
+        the fraction of the first-stage windows escalated so far, and the end to end throughput when the wall time is
+        given, also printed
+        Input:
+            wall_time: the duration of the inference in seconds
+            total_windows: the number of windows of the inference, defaults to the first-stage windows (it differs
+                           when a pre-screen skips windows)
+        """
+        report = {'windows': self.n_windows, 'escalated': self.n_escalated,
+                  'escalated_fraction': self.n_escalated / max(self.n_windows, 1)}
+        message = (f"Cascade escalated {report['escalated_fraction']:.1%} of the windows "
+                   f"({self.n_escalated} of {self.n_windows}) to the second stage, input: {self.input}")
+        if wall_time is not None:
+            total_windows = self.n_windows if total_windows is None else total_windows
+            report['windows_per_second'] = total_windows / max(wall_time, 1e-9)
+            message += f", throughput {report['windows_per_second']:.1f} windows/s"
+        print(message)
+        return report
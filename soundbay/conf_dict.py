@@ -5,7 +5,7 @@ These dicts describe the allowed values of the soundbay framework
 '''
 
 from soundbay.models import ResNet1Channel, GoogleResNet50withPCEN, ChristophCNN, ResNet182D, Squeezenet2D, EfficientNet2D, WAV2VEC2
-from soundbay.data import ClassifierDataset, InferenceDataset, NoBackGroundDataset
+from soundbay.data import ClassifierDataset, InferenceDataset, NoBackGroundDataset, StreamingInferenceDataset
 import torch
 from audiomentations import PitchShift, BandStopFilter, TimeMask, TimeStretch
 
@@ -19,7 +19,8 @@ models_dict = {'models.ResNet1Channel': ResNet1Channel,
 
 datasets_dict = {'soundbay.data.ClassifierDataset': ClassifierDataset,
                  'soundbay.data.NoBackGroundDataset': NoBackGroundDataset,
-                 'soundbay.data.InferenceDataset': InferenceDataset}
+                 'soundbay.data.InferenceDataset': InferenceDataset,
+                 'soundbay.data.StreamingInferenceDataset': StreamingInferenceDataset}
 
 optim_dict = {'torch.optim.Adam': torch.optim.Adam, 'torch.optim.SGD': torch.optim.SGD}
 
@@ -1,21 +1,29 @@
-import ast
+import copy
 import random
-from itertools import starmap, repeat
 from pathlib import Path
-from typing import Union
+from typing import Optional, Tuple, Union
 
 import numpy as np
 import pandas as pd
-import soundfile as sf
 import torch
 import torchaudio
 import torchvision
 from hydra.utils import instantiate
 from omegaconf import DictConfig
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset
 from torchvision import transforms
 from audiomentations import Compose
 
+from soundbay.batch_augmentations import BatchAugmentation, BatchCompose
+from soundbay.utils.audio_index import AudioIndex, DirectoryIndex
+from soundbay.utils.audio_io import create_audio_reader
+from soundbay.utils.sample_store import SampleStore
+from soundbay.utils.feature_cache import FeatureCache, config_hash
+from soundbay.utils.metadata_cache import MetadataCache
+
+
+_LABEL_BRACKETS = str.maketrans('', '', '[]() ')
+
 
 class BaseDataset(Dataset):
     """
@@ -23,7 +31,11 @@ class BaseDataset(Dataset):
     """
     def __init__(self, data_path, metadata_path, augmentations, augmentations_p, preprocessors,
                  seq_length=1, data_sample_rate=44100, sample_rate=44100, mode="train",
-                 slice_flag=False, margin_ratio=0, split_metadata_by_label=False, path_hierarchy: int = 0):
+                 slice_flag=False, margin_ratio=0, split_metadata_by_label=False, path_hierarchy: int = 0,
+                 file_pool_size: int = 16, read_dtype: str = 'float32', audio_backend: str = 'soundfile',
+                 sample_store: Optional[str] = None, feature_cache: Optional[str] = None,
+                 feature_cache_max_gb: float = 10, batch_preprocessing: bool = False,
+                 metadata_cache: Optional[str] = None, persist_index: bool = False, index_dir: Optional[str] = None):
         """
         __init__ method initiates ClassifierDataset instance:
         Input:
@@ -53,27 +65,91 @@ class BaseDataset(Dataset):
                 - sub_folder3
                     - file3.wav
                     - file8.wav
+        file_pool_size - number of audio files kept open per DataLoader worker (0 opens the file on every item)
+        read_dtype - dtype the audio is read into, 'float32' or 'int16'
+        audio_backend - 'soundfile' reads through open sound files, 'memmap' maps uncompressed PCM WAV files
+        sample_store - path to a sample store made by soundbay/materialize.py, the audio is then read from the store
+        (already at sample_rate) instead of data_path
+        feature_cache - directory of an on-disk cache of the preprocessed items, used only when the dataset is
+        deterministic (not in train mode and without random preprocessors)
+        feature_cache_max_gb - size limit of the feature cache
+        batch_preprocessing - if True, items hold the augmented waveforms and the preprocessors are applied to whole
+        batches by self.batch_preprocessor (see BatchPreprocessor)
+        metadata_cache - directory of snapshots of the preprocessed metadata (see MetadataCache), datasets over the
+        same annotations, audio files and preprocessing arguments load the snapshots instead of preprocessing again
+        persist_index - save the directory and audio indexes of data_path (see DirectoryIndex and AudioIndex) for later
+        datasets and runs, otherwise they are kept in memory
+        index_dir - directory of the saved indexes, None saves them inside data_path
         Output:
         ClassifierDataset Object - inherits from Dataset object in PyTorch package
         """
-        self.audio_dict = self._create_audio_dict(Path(data_path), path_hierarchy=path_hierarchy)
         self.metadata_path = metadata_path
         self.dtype_dict = {'filename': 'str'}
-        metadata = pd.read_csv(self.metadata_path, dtype=self.dtype_dict)
-        self.metadata = self._update_metadata_by_mode(metadata, mode, split_metadata_by_label)
+        if sample_store is not None:
+            store = SampleStore(sample_store, file_pool_size)
+            assert store.sample_rate == sample_rate, \
+                f'sample store {sample_store} is in {store.sample_rate}Hz, should be {sample_rate}Hz'
+            self.audio_dict = store.audio_dict
+            self.audio_reader = store
+            data_sample_rate = sample_rate
+        else:
+            self.audio_dict = self._create_audio_dict(Path(data_path), path_hierarchy=path_hierarchy,
+                                                      persist_index=persist_index, index_dir=index_dir)
+            self.audio_reader = create_audio_reader(audio_backend, file_pool_size, read_dtype)
         self.mode = mode
         self.seq_length = seq_length
         self.sample_rate = sample_rate
         self.data_sample_rate = data_sample_rate
         self.sampler = torchaudio.transforms.Resample(orig_freq=data_sample_rate, new_freq=sample_rate)
-        self._preprocess_metadata(slice_flag)
+        metadata_cache = MetadataCache(metadata_cache) if metadata_cache is not None else None
+        snapshot, filtered = None, None
+        if metadata_cache is not None:
+            # the metadata is snapshotted once filtered, and once sliced: datasets that slice the same annotations
+            # differently (the train and train_as_val datasets of a run) share the first. The mode only selects rows
+            # with split_metadata_by_label, otherwise the datasets of all the modes share the snapshots
+            split = mode if split_metadata_by_label else None
+            filtered_key = metadata_cache.key(metadata_path, self.audio_dict, seq_length=seq_length, split=split)
+            snapshot_key = metadata_cache.key(metadata_path, self.audio_dict, seq_length=seq_length, split=split,
+                                              slice_flag=slice_flag)
+            snapshot = metadata_cache.get(snapshot_key)
+            if snapshot is None:
+                filtered = metadata_cache.get(filtered_key)
+        if snapshot is not None:
+            self.metadata, self._labels, samples_weight = snapshot
+        elif filtered is not None:
+            self.metadata, self._labels, _ = filtered
+        else:
+            metadata = pd.read_csv(self.metadata_path, dtype=self.dtype_dict)
+            self.metadata = self._update_metadata_by_mode(metadata, mode, split_metadata_by_label)
+        if sample_store is not None:
+            self.audio_index = store
+        else:
+            self.audio_index = AudioIndex(data_path, [self.audio_dict[name] for name in self.metadata['filename'].unique()
+                                                      if name in self.audio_dict],
+                                          persist=persist_index, index_dir=index_dir)
+        if snapshot is None:
+            if filtered is None:
+                self._filter_metadata()
+                if metadata_cache is not None:
+                    metadata_cache.put(filtered_key, self.metadata, self._labels, np.zeros(0))
+            self._preprocess_metadata(slice_flag)
         self.label_type = self._evaluate_label_type()
         self.augmenter = self._set_augmentations(augmentations, augmentations_p)
         self.preprocessor = self.set_preprocessor(preprocessors)
+        self.batch_preprocessor = BatchPreprocessor(
+            self.preprocessor, augmenter=self._train_batch_augmenter if mode == 'train' else None,
+            sample_rate=sample_rate) if batch_preprocessing else None
+        self.feature_cache = self._set_feature_cache(feature_cache, feature_cache_max_gb, preprocessors)
         assert (0 <= margin_ratio) and (1 >= margin_ratio)
         self.margin_ratio = margin_ratio
         self.num_classes = self._get_num_classes()
-        self.samples_weight = self._get_samples_weight()
+        if snapshot is not None:
+            self.samples_weight = samples_weight
+        else:
+            self.samples_weight = self._get_samples_weight()
+            if metadata_cache is not None:
+                metadata_cache.put(snapshot_key, self.metadata, self._labels, self.samples_weight)
+        self._compile_index()
 
     @staticmethod
     def _update_metadata_by_mode(metadata, mode, split_metadata_by_label):
@@ -81,11 +157,14 @@ class BaseDataset(Dataset):
             metadata = metadata[metadata['split_type'] == mode]
         return metadata
 
-    def _create_audio_dict(self, data_path: Path, path_hierarchy=0) -> dict:
+    @staticmethod
+    def _create_audio_dict(data_path: Path, path_hierarchy=0, persist_index: bool = False,
+                           index_dir: Optional[str] = None) -> dict:
         """
             create reference dict to extract audio files from metadata annotation
             Input:
             data_path - Path object
+            persist_index, index_dir - as DirectoryIndex's persist and index_dir
             Output:
             audio_dict contains references to audio paths given name from metadata
         """
@@ -96,64 +175,77 @@ class BaseDataset(Dataset):
                  f"{len(parent_path_parts)}")
             return '/'.join(parent_path_parts[len(parent_path_parts) - path_hierarchy:])
 
-        audio_paths = list(data_path.rglob('*.wav'))
+        audio_paths = DirectoryIndex(data_path, persist=persist_index, index_dir=index_dir).paths('.wav')
         return {f'{get_parent_path(x, path_hierarchy)}/{x.name[:-4]}'.strip('/'): x for x in audio_paths}
 
-    def _preprocess_metadata(self, slice_flag=False):
+    def _filter_metadata(self):
         """
-        function _preprocesses_metadata grabs calls with minimal length of self.seq_length + len_buffer
-        Input:
-            slice_flag: bool, default = False
-                If true, the metadata file is sliced into segments of lengths self.seq_length.
+        function _filter_metadata grabs calls with minimal length of self.seq_length + len_buffer
         Output:
-            ClassifierDataset object with self.metadata dataframe after applying the condition
+            ClassifierDataset object with self.metadata dataframe after applying the condition, and self._labels
         """
-        self.metadata['label'] = self._preprocess_target()
-        is_noise = self.metadata['label'].apply(self._is_noise)
+        self._labels = self._preprocess_target()
+        is_noise = self._noise_mask(self._labels)
 
         # All calls are worthy (because we can later create a bigger slice contain them that is still a call in
         # _get_audio) but only long enough background sections will do.
-        self.metadata = self.metadata[((self.metadata['call_length'] >= self.seq_length) & is_noise) | (~is_noise)]
+        keep = ((self.metadata['call_length'].values >= self.seq_length) & is_noise) | (~is_noise)
+        self.metadata = self.metadata[keep]
+        self._labels = self._labels[keep]
 
         # sometimes the bbox's end time exceeds the file's length
         for name, sub_df in self.metadata.groupby('filename'):
-            duration = sf.info(str(self.audio_dict[name])).duration
+            duration = self.audio_index[self.audio_dict[name]].duration
             if not all(sub_df['end_time'] <= duration):
                 print(f'seems like some tags in file {name} have bigger end_time than its duration')
                 print(f"file {name} --- int(duration): {int(duration)} --- biggest end time: {sub_df['end_time'].max()}")
+        self.metadata = self.metadata.reset_index(drop=True)
 
+    def _preprocess_metadata(self, slice_flag=False):
+        """
+        function _preprocess_metadata slices the filtered metadata (see _filter_metadata) and sets its label column
+        Input:
+            slice_flag: bool, default = False
+                If true, the metadata file is sliced into segments of lengths self.seq_length.
+        """
         if slice_flag:
             self._slice_sequence()
 
         self.metadata.reset_index(drop=True, inplace=True)
+        self.metadata['label'] = list(self._labels) if self._labels.ndim == 2 else self._labels
 
-    def _preprocess_target(self) -> pd.Series:
+    def _preprocess_target(self) -> np.ndarray:
         """
-        Preprocesses the label column in the metadata. If the label is a string, it is evaluated and converted to an
-        integer or a list of integers.
+        Parses the label column of the metadata in one pass. Integer labels give an int vector, labels that are
+        strings of lists of integers (e.g. "[0, 1, 1]") give a [N, C] matrix, uint8 when the values fit.
         """
-        if pd.api.types.is_string_dtype(self.metadata['label']):
-            assert self.metadata['label'].str.match(r'^(\[|\()?(\d+)(\s*,\s*\d+)*(\]|\))?$').all(), \
+        labels = self.metadata['label']
+        if pd.api.types.is_string_dtype(labels):
+            labels = labels.astype(str)
+            assert labels.str.match(r'^(\[|\()?(\d+)(\s*,\s*\d+)*(\]|\))?$').all(), \
                 "label should be a string that could be evaluated as a list of integers or integers."
-            self.metadata['label'] = self.metadata['label'].apply(ast.literal_eval)
-            if self.metadata['label'].apply(lambda x: isinstance(x, (list, tuple))).all():
-                self.metadata['label'] = self.metadata['label'].apply(np.array, dtype=int)
-        return self.metadata['label']
+            # as with ast.literal_eval, "3" and "(3)" are integers while "[3]" and "3, 4" are sequences
+            commas = labels.str.count(',').values
+            is_sequence = labels.str.startswith('[').values | (commas > 0)
+            if is_sequence.any() and not is_sequence.all():
+                raise ValueError("label should be either a list of integers or integers.")
+            values = np.fromstring(','.join(labels).translate(_LABEL_BRACKETS), dtype=np.int64, sep=',')
+            if not is_sequence.any():
+                return values
+            assert len(commas) == 0 or (commas == commas[0]).all(), "All labels should have the same length"
+            matrix = values.reshape(len(labels), commas[0] + 1 if len(commas) else 0)
+            return matrix.astype(np.uint8) if matrix.size == 0 or matrix.max() <= np.iinfo(np.uint8).max else matrix
+        if not pd.api.types.is_integer_dtype(labels):
+            raise ValueError("label should be either a list of integers or integers.")
+        return labels.values.astype(np.int64)
 
     def _evaluate_label_type(self) -> str:
         """
         function _evaluate_label_type evaluates the type of the label ("multi_label", "single_label") in the metadata
-        Input:
-            label - pd.Series
         Output:
             label_type - string
         """
-        if self.metadata['label'].apply(lambda x: isinstance(x, np.ndarray)).all():
-            return 'multi_label'
-        elif self.metadata['label'].apply(lambda x: isinstance(x, (int, np.integer))).all():
-            return 'single_label'
-        else:
-            raise ValueError("label should be either a list of integers or integers.")
+        return 'multi_label' if self._labels.ndim == 2 else 'single_label'
 
     @staticmethod
     def _is_noise(value: Union[int, np.ndarray]) -> bool:
@@ -163,28 +255,86 @@ class BaseDataset(Dataset):
         assert (isinstance(value, (int, np.integer)) | isinstance(value, np.ndarray)), "value should be either int or np.ndarray"
         return np.sum(value) == 0
 
+    @staticmethod
+    def _noise_mask(labels: np.ndarray) -> np.ndarray:
+        """
+        vectorized _is_noise over a label vector or matrix
+        """
+        return labels.reshape(len(labels), -1).sum(axis=1) == 0
+
+    def _compile_index(self):
+        """
+        compiles the metadata columns read by __getitem__ into compact numpy arrays: file ids into a table of paths,
+        begin and end sample offsets and channels (-1 when the metadata has no channel column), next to the labels
+        array of _preprocess_target. The arrays are all the workers need, the metadata DataFrame is not pickled into
+        them (see __getstate__).
+        """
+        file_ids, filenames = pd.factorize(self.metadata['filename'])
+        self._file_paths = [self.audio_dict[name] for name in filenames]
+        for path_to_file in self._file_paths:
+            orig_sample_rate = self.audio_index[path_to_file].samplerate
+            assert orig_sample_rate == self.data_sample_rate, \
+                f'{path_to_file} sample rate is {orig_sample_rate}, should be {self.data_sample_rate}'
+        self._file_ids = file_ids.astype(np.int32)
+        self._begin_samples = (self.metadata['begin_time'].values * self.data_sample_rate).astype(np.int64)
+        self._end_samples = (self.metadata['end_time'].values * self.data_sample_rate).astype(np.int64)
+        if 'channel' in self.metadata.columns:
+            self._channels = self.metadata['channel'].values.astype(np.int16)
+        else:
+            self._channels = np.full(len(self.metadata), -1, dtype=np.int16)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('metadata', None)
+        return state
+
     def _grab_fields(self, idx):
         """
-        grabs fields from metadata according to idx
+        grabs fields from the compiled metadata arrays according to idx
         input :idx
-        output: begin_time - start time of segment
-                end_time - end time of segment
+        output: begin_time - start sample of segment
+                end_time - end sample of segment
                 path_to_file - full path to file
         """
-        filename = self.metadata['filename'][idx]
-        begin_time = self.metadata['begin_time'][idx]
-        end_time = self.metadata['end_time'][idx]
-        path_to_file = self.audio_dict[filename]
-        orig_sample_rate = sf.info(path_to_file).samplerate
-        assert orig_sample_rate == self.data_sample_rate
-        begin_time = int(begin_time * orig_sample_rate)
-        end_time = int(end_time * orig_sample_rate)
-        label = self.metadata['label'][idx]
-        if 'channel' in self.metadata.columns:
-            channel = self.metadata['channel'][idx]
-        else:
-            channel = None
-        return path_to_file, begin_time, end_time, label, channel
+        path_to_file = self._file_paths[self._file_ids[idx]]
+        begin_time = int(self._begin_samples[idx])
+        end_time = int(self._end_samples[idx])
+        label = self._labels[idx].astype(np.int64)
+        channel = int(self._channels[idx])
+        return path_to_file, begin_time, end_time, label, channel if channel >= 0 else None
+
+    @staticmethod
+    def _slice_times(begin_times: np.ndarray, end_times: np.ndarray, is_call: np.ndarray, seq_length):
+        """
+        Slices the [begin_time, end_time) segments into windows of seq_length. A segment holds the windows
+        np.arange(begin_time, end_time, seq_length) yields, calls are closed by one more window that ends at end_time.
+        The windows are computed with the same floating point arithmetic as np.arange, so the result is identical.
+        Input:
+            begin_times, end_times - arrays of the segments times
+            is_call - boolean array, False for background segments
+            seq_length - window length
+        Output:
+            rows - index of the segment of every window
+            new_begin_time, new_end_time - arrays of the windows times
+        """
+        begin_times, end_times = np.asarray(begin_times), np.asarray(end_times)
+        dtype = np.result_type(begin_times, end_times, seq_length)
+        begin_times, end_times = begin_times.astype(np.float64), end_times.astype(np.float64)
+        n_points = np.maximum(np.ceil((end_times - begin_times) / seq_length), 0).astype(np.int64)
+        repeats = np.where(is_call, n_points, np.maximum(n_points - 1, 0))
+        rows = np.repeat(np.arange(len(repeats)), repeats)
+        window = np.arange(len(rows)) - (np.cumsum(repeats) - repeats)[rows]
+        begin = begin_times[rows]
+        second = (begin_times + seq_length)[rows]  # np.arange fills start + i * (second - start)
+        delta = second - begin
+
+        def point(i):
+            return np.where(i == 0, begin, np.where(i == 1, second, begin + i * delta))
+
+        new_begin_time = point(window)
+        closes_call = is_call[rows] & (window == repeats[rows] - 1)
+        new_end_time = np.where(closes_call, end_times[rows], point(window + 1))
+        return rows, new_begin_time.astype(dtype), new_end_time.astype(dtype)
 
     def _slice_sequence(self):
         """
@@ -194,20 +344,20 @@ class BaseDataset(Dataset):
         self.metadata sliced according to buffers
         """
         self.metadata = self.metadata.reset_index(drop=True)
-        count_values_before = self.metadata.astype({'label': str}).value_counts('label', sort=False) # for validating that the following code doesn't lose samples
-        sliced_times = list(starmap(np.arange, zip(self.metadata['begin_time'], self.metadata['end_time'], repeat(self.seq_length))))
-        # add the last sequence at the end of this list for calls only (only if it does not exceed the file)
-        sliced_times = list([np.append(s, self.metadata.loc[i, 'end_time']) if (not self._is_noise(self.metadata.loc[i, 'label']))
-                             else s for i, s in enumerate(sliced_times)])
-        new_begin_time = list(x[:-1] for x in sliced_times)
-        duplicate_size_vector = [len(list_elem) for list_elem in new_begin_time] # vector to duplicate original dataframe
-        new_begin_time = np.concatenate(new_begin_time) # vectorize to array
-        new_end_time = np.concatenate(list(x[1:] for x in sliced_times)) # same for end_times
-        self.metadata = self.metadata.iloc[self.metadata.index.repeat(duplicate_size_vector)].reset_index(drop=True)
+        is_call = ~self._noise_mask(self._labels)
+        rows, new_begin_time, new_end_time = self._slice_times(
+            self.metadata['begin_time'].values, self.metadata['end_time'].values, is_call, self.seq_length)
+        # for validating that the following code doesn't lose samples
+        label_uniques, label_codes = np.unique(self._labels, axis=0, return_inverse=True)
+        label_codes, label_uniques = label_codes.ravel(), [str(label) for label in label_uniques]
+        count_values_before = pd.Series(np.bincount(label_codes), index=label_uniques)
+        count_values_after = pd.Series(np.bincount(label_codes[rows], minlength=len(label_uniques)),
+                                       index=label_uniques)
+        self.metadata = self.metadata.iloc[rows].reset_index(drop=True)
+        self._labels = self._labels[rows]
         self.metadata['begin_time'] = new_begin_time
         self.metadata['end_time'] = new_end_time
-        self.metadata['call_length'] = np.shape(self.metadata)[0] * [self.seq_length]
-        count_values_after = self.metadata.astype({'label': str}).value_counts('label', sort=False)
+        self.metadata['call_length'] = np.full(len(self.metadata), self.seq_length)
         if not all(count_values_after >= count_values_before):
             print(f'Note: seems like _slice_sequence erases data.\nbefore:{count_values_before}\n'
                   f'after:{count_values_after}')
@@ -219,17 +369,27 @@ class BaseDataset(Dataset):
     def _set_augmentations(self, augmentations_dict, augmentations_p):
         """
         get augmentations list and instantiate - TBD
+        batched augmentations (soundbay.batch_augmentations) are composed separately, they are applied to the whole
+        batch when the dataset uses batch_preprocessing and to the single item otherwise
         """
         if augmentations_dict is not None:
             augmentations_list = [instantiate(args) for args in augmentations_dict.values()]
         else:
             augmentations_list = []
+        batch_augmentations = [a for a in augmentations_list if isinstance(a, BatchAugmentation)]
+        augmentations_list = [a for a in augmentations_list if not isinstance(a, BatchAugmentation)]
         self._train_augmenter = Compose(augmentations_list, p=augmentations_p, shuffle=True)
+        self._train_batch_augmenter = BatchCompose(batch_augmentations, p=augmentations_p, shuffle=True) \
+            if batch_augmentations else None
         self._val_augmenter = torch.nn.Identity()
 
     def augment(self, x):
         if self.mode == 'train':
-            return torch.tensor(self._train_augmenter(x.numpy(), self.sample_rate), dtype=torch.float32)
+            if self._train_augmenter.transforms:
+                x = torch.tensor(self._train_augmenter(x.numpy(), self.sample_rate), dtype=torch.float32)
+            if self._train_batch_augmenter is not None and self.batch_preprocessor is None:
+                x = self._train_batch_augmenter(x.unsqueeze(0), self.sample_rate).squeeze(0)
+            return x
         else:
             return self._val_augmenter(x)
 
@@ -252,16 +412,34 @@ class BaseDataset(Dataset):
             preprocessor = torch.nn.Identity()
         return preprocessor
 
+    @staticmethod
+    def is_deterministic(preprocessor) -> bool:
+        """
+        Checks if a preprocessor (as returned by set_preprocessor) always gives the same output for the same input
+        """
+        random_transforms = (torchaudio.transforms.FrequencyMasking, torchaudio.transforms.TimeMasking)
+        return all(getattr(t, 'deterministic', True) and not isinstance(t, random_transforms)
+                   for t in getattr(preprocessor, 'transforms', [preprocessor]))
+
+    def _set_feature_cache(self, feature_cache, feature_cache_max_gb, preprocessors_args) -> Optional[FeatureCache]:
+        """
+        Returns the feature cache of the dataset, or None if the dataset items are not deterministic
+        """
+        if feature_cache is None or self.mode == 'train' or self.batch_preprocessor is not None or \
+                not self.is_deterministic(self.preprocessor):
+            return None
+        namespace = config_hash(preprocessors_args, type(self).__name__, self.seq_length, self.data_sample_rate,
+                                self.sample_rate)
+        return FeatureCache(feature_cache, namespace, max_gb=feature_cache_max_gb)
+
     def _get_num_classes(self) -> int:
         """
         Returns the number of classes in the metadata.
         """
         if self.label_type == 'multi_label':
-            label_lengths = self.metadata['label'].apply(len)
-            assert label_lengths.nunique() == 1, "All labels should have the same length"
-            return label_lengths.iloc[0]
+            return self._labels.shape[1]
         else:
-            return self.metadata['label'].nunique()
+            return len(np.unique(self._labels))
 
     def _get_samples_weight(self) -> np.ndarray:
         """
@@ -270,14 +448,14 @@ class BaseDataset(Dataset):
             - if the label is a list, the weight is the inverse of the minimum class count.
         """
         if self.label_type == 'multi_label':
-            noise_counts = self.metadata['label'].apply(self._is_noise).sum()
-            class_counts = np.sum(self.metadata['label'])
-            per_sample_min_class_count = (self.metadata['label'].apply(
-                lambda x: class_counts[x.astype(bool)].min() if not self._is_noise(x) else noise_counts))
-            return (1 / per_sample_min_class_count).values
+            is_noise = self._noise_mask(self._labels)
+            class_counts = self._labels.sum(axis=0, dtype=np.int64)
+            min_class_count = np.where(self._labels.astype(bool), class_counts, np.iinfo(np.int64).max).min(axis=1)
+            per_sample_min_class_count = np.where(is_noise, is_noise.sum(), min_class_count)
+            return 1 / per_sample_min_class_count
         else:
-            weights = 1 / np.unique(self.metadata['label'], return_counts=True)[1]
-            return np.array([weights[t] for t in self.metadata['label']])
+            weights = 1 / np.unique(self._labels, return_counts=True)[1]
+            return weights[self._labels]
 
 
     def __getitem__(self, idx):
@@ -297,20 +475,32 @@ class BaseDataset(Dataset):
 
         '''
         path_to_file, begin_time, end_time, label, channel = self._grab_fields(idx)
-        audio = self._get_audio(path_to_file, begin_time, end_time, label, channel)
-        audio_raw = self.sampler(audio)
-        audio_augmented = self.augment(audio_raw)
-        audio_processed = self.preprocessor(audio_augmented)
+        cached = None
+        if self.feature_cache is not None:
+            info = self.audio_index[path_to_file]
+            cache_key = self.feature_cache.key(str(path_to_file), info.mtime_ns, info.size, begin_time, channel)
+            cached = self.feature_cache.get(cache_key)
+        if cached is not None:
+            audio_processed, audio_raw = cached
+        else:
+            audio = self._get_audio(path_to_file, begin_time, end_time, label, channel)
+            audio_raw = self.sampler(audio)
+            audio_augmented = self.augment(audio_raw)
+            if self.batch_preprocessor is None:
+                audio_processed = self.preprocessor(audio_augmented)
+            else:
+                audio_processed = audio_augmented
+            if self.feature_cache is not None:
+                self.feature_cache.put(cache_key, audio_processed, audio_raw)
 
         if self.mode == "train" or self.mode == "val":
-            label = self.metadata["label"][idx]
             return audio_processed, label, audio_raw, {"idx": idx, "begin_time": begin_time, "org_file": Path(path_to_file).stem}
 
         elif self.mode == "test":
             return audio_processed
 
     def __len__(self):
-        return self.metadata.shape[0]
+        return len(self._file_ids)
 
 
 
@@ -336,7 +526,7 @@ class ClassifierDataset(BaseDataset):
         """
         seg_length = end_time - begin_time
         requested_seq_length = int(self.seq_length * self.data_sample_rate)
-        last_start_time = sf.info(path_to_file).frames - requested_seq_length
+        last_start_time = self.audio_index[path_to_file].frames - requested_seq_length
         # Do all this stuff only to calls in training set, because otherwise _slice_sequence has already been done
         if self.mode == "train":
             if seg_length >= requested_seq_length:
@@ -366,17 +556,16 @@ class ClassifierDataset(BaseDataset):
             else:
                 print(f'in {path_to_file}, one of the val\'s begin times is too big and exceeding the file so it was set to be smaller\nbegin time:{begin_time}, last_start_time:{last_start_time}')
                 start_time = last_start_time
-        data, _ = sf.read(str(path_to_file), start=start_time,
-                          stop=start_time + requested_seq_length)
-        if channel is not None and data.ndim > 1:
+        if channel is not None and self.audio_index[path_to_file].channels > 1:
             assert channel > 0, f"channel as to be a positive integer, got {channel}"
-            data = data[:, channel - 1]
-        elif channel is None and data.ndim > 1:
-            data = data[:, 0] # when channel is not specified, take the first channel
+            channel_idx = channel - 1
+        else:
+            channel_idx = 0 # when channel is not specified, take the first channel
+        data = self.audio_reader.read(path_to_file, start_time, start_time + requested_seq_length, channel_idx)
         if data.shape[0] < 1:
             raise ValueError(f"Audio segment is empty. {path_to_file}: "
                              f"{start_time}, {start_time + requested_seq_length}")
-        audio = torch.tensor(data, dtype=torch.float).unsqueeze(0)
+        audio = torch.from_numpy(data).unsqueeze(0)
         return audio
 
 
@@ -404,14 +593,13 @@ class NoBackGroundDataset(BaseDataset):
                 start_time = 0
         else:
             start_time = begin_time
-        data, _ = sf.read(str(path_to_file), start=start_time,
-                          stop=start_time + int(self.seq_length * self.data_sample_rate))
-        if channel is not None:
-            data = data[:, channel-1]
+        data = self.audio_reader.read(path_to_file, start_time,
+                                      start_time + int(self.seq_length * self.data_sample_rate),
+                                      channel - 1 if channel is not None else 0)
         if data.shape[0] < 1:
            raise ValueError(f"Audio segment is empty. {path_to_file}: "
                             f"{start_time}, {start_time + int(self.seq_length * self.data_sample_rate)}")
-        audio = torch.tensor(data, dtype=torch.float).unsqueeze(0)
+        audio = torch.from_numpy(data).unsqueeze(0)
         return audio
 
 
@@ -422,6 +610,13 @@ class PeakNormalize:
 
         return (sample - sample.min()) / (sample.max() - sample.min() + 1e-8)
 
+    def batch(self, samples):
+        """normalizes every sample of a batch by its own min and max"""
+        dims = tuple(range(1, samples.dim()))
+        samples_min = samples.amin(dim=dims, keepdim=True)
+        samples_max = samples.amax(dim=dims, keepdim=True)
+        return (samples - samples_min) / (samples_max - samples_min + 1e-8)
+
 
 class MinFreqFiltering:
     """Cut the spectrogram frequency axis to make it start from min_freq
@@ -443,9 +638,9 @@ class MinFreqFiltering:
         if self.min_freq_filtering > self.sample_rate / 2 or self.min_freq_filtering < 0:
             raise ValueError("min_freq_filtering should be greater than 0, and smaller than sample_rate/2")
         max_freq_in_spectrogram = self.sample_rate / 2
-        min_value = sample.size(dim=1) * self.min_freq_filtering / max_freq_in_spectrogram
+        min_value = sample.size(dim=-2) * self.min_freq_filtering / max_freq_in_spectrogram
         min_value = int(np.floor(min_value))
-        sample = sample[:, min_value:, :]
+        sample = sample[..., min_value:, :]
 
         return sample
 
@@ -453,6 +648,10 @@ class MinFreqFiltering:
 
         return self.edit_spectrogram_axis(sample)
 
+    def batch(self, samples):
+
+        return self.edit_spectrogram_axis(samples)
+
 
 class UnitNormalize:
     """Remove mean and divide by std to normalize samples"""
@@ -461,6 +660,11 @@ class UnitNormalize:
 
         return (sample - sample.mean()) / (sample.std() + 1e-8)
 
+    def batch(self, samples):
+        """normalizes every sample of a batch by its own mean and std"""
+        dims = tuple(range(1, samples.dim()))
+        return (samples - samples.mean(dim=dims, keepdim=True)) / (samples.std(dim=dims, keepdim=True) + 1e-8)
+
 
 class SlidingWindowNormalize:
     """ Based on Sliding window augmentations of
@@ -470,6 +674,7 @@ class SlidingWindowNormalize:
 
         Must come after spectrogram and before AmplitudeToDB
     """
+    deterministic = False
 
     def __init__(self, sr: float, n_fft: int, lower_cutoff: float = 50, norm=True,
                  inner_ratio: float = 0.06, outer_ratio: float = 0.5):
@@ -481,17 +686,32 @@ class SlidingWindowNormalize:
         self.outer_ratio = outer_ratio
 
     def spectrogram_norm(self, spect):
-
+        """clips every spectrogram (last two dims) to 1.5 std around its mean above lower_cutoff, and sets the bins
+        below lower_cutoff to the mean"""
         min_f_ind = int((self.lower_cutoff / (self.sr / 2)) * self.n_fft)
 
-        mval, sval = np.mean(spect[min_f_ind:, :]), np.std(spect[min_f_ind:, :])
+        above_cutoff = spect[..., min_f_ind:, :]
+        mval = above_cutoff.mean(dim=(-2, -1), keepdim=True)
+        sval = above_cutoff.std(dim=(-2, -1), unbiased=False, keepdim=True)
         fact_ = 1.5
-        spect[spect > mval + fact_ * sval] = mval + fact_ * sval
-        spect[spect < mval - fact_ * sval] = mval - fact_ * sval
-        spect[:min_f_ind, :] = mval
+        spect = torch.clamp(spect, min=mval - fact_ * sval, max=mval + fact_ * sval)
+        spect[..., :min_f_ind, :] = mval
 
         return spect
 
+    @staticmethod
+    def _box_sum(x, length, dim):
+        """
+        moving sum over windows of length samples along dim, the same as np.convolve(x, np.ones(length), 'same')
+        computed for every row at once with a cumulative sum
+        """
+        n = x.shape[dim]
+        padded_cumsum = torch.cat([torch.zeros_like(x.narrow(dim, 0, 1)), torch.cumsum(x, dim)], dim)
+        index = torch.arange(n, device=x.device)
+        end = torch.clamp(index + (length - 1) // 2 + 1, max=n)
+        begin = torch.clamp(index - length // 2, min=0)
+        return padded_cumsum.index_select(dim, end) - padded_cumsum.index_select(dim, begin)
+
     # slidingWindowV Function from: https://github.com/nmkridler/moby2/blob/master/metrics.py
     def slidingWindow(self, torch_spectrogram, dim=0):
         ''' slidingWindow Method
@@ -499,38 +719,32 @@ class SlidingWindowNormalize:
                 horizontally (along temporal dimension) for dim=1
 
                 Args:
-                    torch_spectrogram: 2-D numpy array image
+                    torch_spectrogram: tensor whose last two dims are the spectrogram (frequency, time), leading
+                    dims (channel, batch) are processed independently
                     dim: dimension to do the sliding window across
                 Returns:
-                    Q: 2-D numpy array image with vertically-enhanced contrast
+                    Q: tensor of the same shape, device and dtype with enhanced contrast
 
         '''
         if dim not in {0, 1}:
             raise ValueError('dim must be 0 or 1')
 
-        spect = torch_spectrogram.cpu().clone().numpy()
-        spect_shape = spect.shape
-        spect = spect.squeeze()
+        # float64 like the np.convolve implementation this replaces
+        spect = torch_spectrogram.to(torch.float64)
         if self.norm:
             spect = self.spectrogram_norm(spect)
+        axis = dim - 2
 
         # Set up the local mean window
-        wInner = np.ones(int(self.inner_ratio * spect.shape[dim]))
+        inner_length = int(self.inner_ratio * spect.shape[axis])
         # Set up the overall mean window
-        wOuter = np.ones(int(self.outer_ratio * spect.shape[dim]))
-        # Remove overall mean and local mean using np.convolve
-        for i in range(spect.shape[1-dim]):
-            if dim == 0:
-                spect[:, i] = spect[:, i] - (
-                        np.convolve(spect[:, i], wOuter, 'same') - np.convolve(spect[:, i], wInner, 'same')) / (
-                            wOuter.shape[0] - wInner.shape[0])
-            elif dim == 1:
-                spect[i, :] = spect[i, :] - (
-                        np.convolve(spect[i, :], wOuter, 'same') - np.convolve(spect[i, :], wInner, 'same')) / (
-                                      wOuter.shape[0] - wInner.shape[0])
-
-        spect[spect < 0] = 0.
-        return torch.from_numpy(spect).reshape(spect_shape)
+        outer_length = int(self.outer_ratio * spect.shape[axis])
+        # Remove overall mean and local mean using box filters
+        spect = spect - (self._box_sum(spect, outer_length, axis) - self._box_sum(spect, inner_length, axis)) / (
+                outer_length - inner_length)
+
+        spect = torch.clamp(spect, min=0.)
+        return spect.to(torch_spectrogram.dtype)
 
     def __call__(self, x):
 
@@ -539,6 +753,12 @@ class SlidingWindowNormalize:
         else:
             return self.slidingWindow(x, dim=1)
 
+    def batch(self, samples):
+        """applies the sliding window to a batch, the direction is drawn per sample"""
+        vertical = torch.rand(samples.shape[0], device=samples.device) < 0.5
+        vertical = vertical.view(-1, *([1] * (samples.dim() - 1)))
+        return torch.where(vertical, self.slidingWindow(samples, dim=0), self.slidingWindow(samples, dim=1))
+
 
 class Resize(torchvision.transforms.Resize):
 
@@ -546,6 +766,43 @@ class Resize(torchvision.transforms.Resize):
         super().__init__(list(size))
 
 
+class BatchPreprocessor:
+    """
+    Applies the transforms of a preprocessor (as returned by BaseDataset.set_preprocessor) to a whole batch of
+    waveforms [B, 1, T], so e.g. a single batched STFT replaces B separate ones. Batched augmentations, if given, are
+    applied to the waveforms first. Every sample gets the same output as
+    the per-item preprocessor: transforms with a batch method (the normalizers reduce per sample) use it, torch
+    transforms that handle a leading batch dimension are called on the batch, and any other transform is applied
+    sample by sample.
+    The transforms are copied, so the preprocessor can be moved to the training device without affecting the dataset.
+    """
+    batched_transforms = (torch.nn.Identity, torchaudio.transforms.Spectrogram, torchaudio.transforms.MelSpectrogram,
+                          torchaudio.transforms.AmplitudeToDB, torchvision.transforms.Resize)
+
+    def __init__(self, preprocessor, augmenter: Optional[BatchCompose] = None, sample_rate: Optional[int] = None):
+        self.transforms = [copy.deepcopy(t) for t in getattr(preprocessor, 'transforms', [preprocessor])]
+        self.augmenter = augmenter
+        self.sample_rate = sample_rate
+
+    def to(self, device):
+        for t in self.transforms:
+            if isinstance(t, torch.nn.Module):
+                t.to(device)
+        return self
+
+    def __call__(self, batch):
+        if self.augmenter is not None:
+            batch = self.augmenter(batch, self.sample_rate)
+        for t in self.transforms:
+            if hasattr(t, 'batch'):
+                batch = t.batch(batch)
+            elif isinstance(t, self.batched_transforms):
+                batch = t(batch)
+            else:
+                batch = torch.stack([t(sample) for sample in batch])
+        return batch
+
+
 class InferenceDataset(Dataset):
     '''
     class for storing and loading data.
@@ -555,10 +812,22 @@ class InferenceDataset(Dataset):
                  seq_length: float = 1,
                  data_sample_rate: int = 44100,
                  sample_rate: int = 44100,
-                 overlap: float = 0):
+                 overlap: float = 0,
+                 file_pool_size: int = 16,
+                 audio_backend: str = 'soundfile',
+                 batch_preprocessing: bool = False,
+                 window_slice: Optional[Tuple[int, int]] = None,
+                 channel: Optional[int] = None,
+                 persist_index: bool = False,
+                 index_dir: Optional[str] = None):
         """
         __init__ method initiates InferenceDataset instance:
         Input:
+        window_slice - (first, last) keeps only the windows of every file whose index is in [first, last), used to
+        process long recordings in chunks (see window_count)
+        channel - keeps only the windows of this channel of every file, all the channels if None
+        persist_index - save the directory and audio indexes of the inferred files for later runs (inside index_dir,
+        next to the files if None), otherwise they are kept in memory
 
         Output:
         InferenceDataset Object - inherits from Dataset object in PyTorch package
@@ -571,9 +840,17 @@ class InferenceDataset(Dataset):
         self.sample_rate = sample_rate
         self.data_sample_rate = data_sample_rate
         self.overlap = overlap
+        self.window_slice = window_slice
+        self.channel = channel
+        self.persist_index = persist_index
+        self.index_dir = index_dir
         self.sampler = torchaudio.transforms.Resample(orig_freq=data_sample_rate, new_freq=sample_rate)
         self.preprocessor = ClassifierDataset.set_preprocessor(preprocessors)
+        self.batch_preprocessor = BatchPreprocessor(self.preprocessor) if batch_preprocessing else None
+        self.audio_reader = create_audio_reader(audio_backend, file_pool_size)
+        self.audio_index = None
         self.metadata = self._create_inference_metadata()
+        self._compile_index()
 
     def _create_inference_metadata(self) -> pd.DataFrame:
         """
@@ -584,14 +861,20 @@ class InferenceDataset(Dataset):
         """
         all_data_frames = []
         if self.file_path.is_dir():
-            all_files = [self.file_path / x for x in self.file_path.iterdir()]
+            all_files = DirectoryIndex(self.file_path, persist=self.persist_index,
+                                       index_dir=self.index_dir).paths(suffix=None, recursive=False)
+            index_root = self.file_path
         else:
             all_files = [self.file_path]
+            index_root = self.file_path.parent
         for file in all_files:
             if file.suffix not in ['.wav', '.WAV']:
                 raise ValueError(f'InferenceDataset only supports .wav files, got {file.suffix}')
+        self.audio_index = AudioIndex(index_root, all_files, persist=self.persist_index, index_dir=self.index_dir)
+        for file in all_files:
             file_start_time = self._create_start_times(file)
-            for channel_num in range(sf.info(file).channels):
+            channels = range(self.audio_index[file].channels) if self.channel is None else [self.channel]
+            for channel_num in channels:
                 metadata = pd.DataFrame({'filename': [file] * len(file_start_time),
                                          'channel': [channel_num] * len(file_start_time),
                                          'begin_time': file_start_time,
@@ -600,6 +883,26 @@ class InferenceDataset(Dataset):
         metadata = pd.concat(all_data_frames, ignore_index=True)
         return metadata
 
+    def _compile_index(self):
+        """
+        compiles the metadata into the numpy arrays read by __getitem__: file ids into a table of paths, channels and
+        begin sample offsets. The metadata DataFrame itself is not pickled into the DataLoader workers.
+        """
+        file_ids, self._file_paths = pd.factorize(self.metadata['filename'])
+        self._file_paths = list(self._file_paths)
+        for filepath in self._file_paths:
+            orig_sample_rate = self.audio_index[filepath].samplerate
+            assert orig_sample_rate == self.data_sample_rate, \
+                f'sample rate is {orig_sample_rate}, should be {self.data_sample_rate}'
+        self._file_ids = file_ids.astype(np.int32)
+        self._channels = self.metadata['channel'].values.astype(np.int16)
+        self._begin_samples = (self.metadata['begin_time'].values * self.data_sample_rate).astype(np.int64)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('metadata', None)
+        return state
+
     def _create_start_times(self, filepath: Path) -> np.ndarray:
         """
             create reference dict to extract audio files from metadata annotation
@@ -608,8 +911,10 @@ class InferenceDataset(Dataset):
             Output:
             audio_dict contains references to audio paths given name from metadata
         """
-        audio_len = sf.info(filepath).duration
+        audio_len = self.audio_index[filepath].duration
         step = self.seq_length * (1-self.overlap)
+        if self.window_slice is not None:
+            return self._slice_start_times(audio_len, step)
         start_times =  np.arange(0, audio_len, step)
         filtered_start_times = start_times[np.where(start_times <= audio_len - self.seq_length)]
         # if (duration - seq_length) is not a multiple of the step size, add the last segment
@@ -617,30 +922,58 @@ class InferenceDataset(Dataset):
             filtered_start_times = np.append(filtered_start_times, audio_len - self.seq_length)
         return filtered_start_times
 
-    def _get_audio(self, filepath: Path, channel: int, begin_time: float) -> torch.Tensor:
+    def _slice_start_times(self, audio_len: float, step: float) -> np.ndarray:
         """
-        _get_audio gets a path_to_file from _grab_fields method and also begin_time and end_time
+        The start times of the windows in self.window_slice, computed without enumerating the whole file. Window k is
+        np.arange(0, audio_len, step)[k] as in _create_start_times, and the window that ends at the end of the file
+        (if any) has the index len(np.arange(0, audio_len, step)).
+        """
+        n_windows = int(np.ceil(audio_len / step))
+        first, last = self.window_slice
+        last_start_time = audio_len - self.seq_length
+        start_times = np.arange(first, min(last, n_windows)) * step
+        filtered_start_times = start_times[start_times <= last_start_time]
+        # the window that ends at the end of the file is added unless a window of the grid starts at the same time
+        # (window k starts at k * step, as np.arange computes it)
+        on_grid = round(last_start_time / step) * step == last_start_time
+        if first <= n_windows < last and last_start_time >= 0 and not on_grid:
+            filtered_start_times = np.append(filtered_start_times, last_start_time)
+        return filtered_start_times
+
+    def window_count(self, filepath: Path) -> int:
+        """
+        upper bound of the window indices of a file, for window_slice
+        """
+        return int(np.ceil(self.audio_index[filepath].duration / (self.seq_length * (1 - self.overlap)))) + 1
+
+    def _get_audio(self, filepath: Path, channel: int, begin_time: int) -> torch.Tensor:
+        """
+        _get_audio gets a path_to_file, channel and begin_time from the compiled metadata
         and returns the audio segment in a torch.tensor
 
         input:
         path_to_file - string
-        begin_time - int
-        end_time - int
+        channel - int (zero-based)
+        begin_time - int (start sample)
 
         output:
         audio - pytorch tensor (1-D array)
         """
-        duration = sf.info(filepath).duration
-        begin_time = int(begin_time * self.data_sample_rate)
+        frames = self.audio_index[filepath].frames
         stop_time = begin_time + int(self.seq_length * self.data_sample_rate)
-        assert duration * self.data_sample_rate >= stop_time, f"trying to load audio from {begin_time} to {stop_time} but audio is only {duration} long"
-        data, orig_sample_rate = sf.read(filepath, start=begin_time, stop=stop_time, always_2d=True)
-        data = data[:, channel]
-        assert orig_sample_rate == self.data_sample_rate, \
-            f'sample rate is {orig_sample_rate}, should be {self.data_sample_rate}'
-        audio = torch.tensor(data, dtype=torch.float).unsqueeze(0)
+        assert frames >= stop_time, f"trying to load audio from {begin_time} to {stop_time} but audio is only {frames} samples long"
+        data = self.audio_reader.read(filepath, begin_time, stop_time, channel)
+        audio = torch.from_numpy(data).unsqueeze(0)
         return audio
 
+    def read_window(self, idx: int) -> torch.Tensor:
+        """
+        reads the audio of window idx of the metadata, at data_sample_rate and before the preprocessing (see
+        __getitem__), as a [1, T] torch tensor
+        """
+        return self._get_audio(filepath=self._file_paths[self._file_ids[idx]], channel=int(self._channels[idx]),
+                               begin_time=int(self._begin_samples[idx]))
+
     def __getitem__(self, idx: int):
         '''
         __getitem__ method loads item according to idx from the metadata.
@@ -651,12 +984,97 @@ class InferenceDataset(Dataset):
         output:
         audio -  torch tensor (1-d if no spectrogram is applied/ 2-d if applied a spectrogram
         '''
-        filepath, channel, begin_time = self.metadata.loc[idx, ['filename', 'channel', 'begin_time']]
-        audio = self._get_audio(filepath=filepath, channel=channel, begin_time=begin_time)
-        audio = self.sampler(audio)
-        audio = self.preprocessor(audio)
+        audio = self.sampler(self.read_window(idx))
+        if self.batch_preprocessor is None:
+            audio = self.preprocessor(audio)
 
         return audio
 
     def __len__(self):
-        return len(self.metadata)
+        return len(self._file_ids)
+
+
+class StreamingInferenceDataset(InferenceDataset, IterableDataset):
+    '''
+    InferenceDataset that reads every file sequentially. Blocks of block_length seconds of all the channels are read
+    and resampled once, and the (possibly overlapping) windows are strided views into the block, so no sample is
+    decoded twice. The windows are emitted file by file, in time order and then channel order - the order of
+    self.metadata - hence a single DataLoader worker is supported.
+    With block_spectrogram, the leading frame-wise preprocessors (Spectrogram/MelSpectrogram followed by
+    MinFreqFiltering and AmplitudeToDB without top_db) are computed once per block as well, and every window whose
+    start is a multiple of hop_length takes its columns from the block spectrogram, only the remaining preprocessors
+    (e.g. the normalization) are applied per window. With center=True (the torchaudio default) the first and last
+    frames of a window then see the neighbouring samples instead of the window's padding.
+    '''
+    frame_transforms = (torchaudio.transforms.Spectrogram, torchaudio.transforms.MelSpectrogram)
+
+    def __init__(self, *args, block_length: float = 600, block_spectrogram: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        assert block_length >= self.seq_length, f'block_length should be at least seq_length, got {block_length}'
+        self.block_length = block_length
+        self.block_preprocessor, self.window_preprocessor, self.hop_length = None, self.preprocessor, None
+        if block_spectrogram:
+            assert self.batch_preprocessor is None, 'block_spectrogram preprocesses the items, not the batches'
+            self._split_preprocessor()
+
+    def _split_preprocessor(self):
+        """
+        splits the preprocessor into the frame-wise transforms computed on whole blocks and the per-window rest
+        """
+        processors = list(getattr(self.preprocessor, 'transforms', []))
+        if not processors or not isinstance(processors[0], self.frame_transforms):
+            print('Notice: block_spectrogram needs the preprocessors to start with a spectrogram, it is ignored')
+            return
+        n_frame_transforms = 1
+        for processor in processors[1:]:
+            frame_wise = isinstance(processor, MinFreqFiltering) or \
+                (isinstance(processor, torchaudio.transforms.AmplitudeToDB) and processor.top_db is None)
+            if not frame_wise:
+                break
+            n_frame_transforms += 1
+        self.block_preprocessor = transforms.Compose(processors[:n_frame_transforms])
+        self.window_preprocessor = transforms.Compose(processors[n_frame_transforms:])
+        spectrogram = processors[0].spectrogram if isinstance(processors[0], torchaudio.transforms.MelSpectrogram) \
+            else processors[0]
+        self.hop_length = spectrogram.hop_length
+
+    def _create_inference_metadata(self) -> pd.DataFrame:
+        metadata = super()._create_inference_metadata()
+        file_ids = pd.factorize(metadata['filename'])[0]
+        order = np.lexsort((metadata['channel'].values, metadata['begin_time'].values, file_ids))
+        return metadata.iloc[order].reset_index(drop=True)
+
+    def _iter_file(self, file_id: int):
+        filepath = self._file_paths[file_id]
+        channels = range(self.audio_index[filepath].channels) if self.channel is None else [self.channel]
+        begin_samples = np.unique(self._begin_samples[self._file_ids == file_id])
+        window_length = int(self.seq_length * self.data_sample_rate)
+        resampled_length = -(-window_length * self.sample_rate // self.data_sample_rate)
+        if self.block_preprocessor is not None:
+            n_frames = self.block_preprocessor(torch.zeros(1, resampled_length)).shape[-1]
+        block_samples = int(self.block_length * self.data_sample_rate)
+        first = 0
+        while first < len(begin_samples):
+            last = max(np.searchsorted(begin_samples, begin_samples[first] + block_samples), first + 1)
+            start, stop = begin_samples[first], begin_samples[last - 1] + window_length
+            data = self.audio_reader.read(filepath, start, stop)
+            block = self.sampler(torch.from_numpy(np.ascontiguousarray(data.T)))
+            windows = block.unfold(-1, resampled_length, 1)  # a view, windows[channel, offset] starts at offset
+            features = self.block_preprocessor(block) if self.block_preprocessor is not None else None
+            offsets = (begin_samples[first:last] - start) * self.sample_rate // self.data_sample_rate
+            for offset in np.minimum(offsets, windows.shape[1] - 1):
+                for channel in channels:
+                    if features is not None and offset % self.hop_length == 0:
+                        column = offset // self.hop_length
+                        yield self.window_preprocessor(features[channel:channel + 1, ..., column:column + n_frames])
+                        continue
+                    audio = windows[channel, offset].unsqueeze(0)
+                    yield audio if self.batch_preprocessor is not None else self.preprocessor(audio)
+            first = last
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None and worker_info.num_workers > 1:
+            raise ValueError('StreamingInferenceDataset emits the windows in metadata order, use a single worker')
+        for file_id in range(len(self._file_paths)):
+            yield from self._iter_file(file_id)
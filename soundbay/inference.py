@@ -1,27 +1,126 @@
-from typing import Generator, Union
+from typing import Generator, List, Optional, Tuple, Union
+
+import multiprocessing
 
 import pandas as pd
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, IterableDataset, Subset
 import numpy as np
 from tqdm import tqdm
-from scipy.special import softmax
 import hydra
 from pathlib import Path
 import os
 import pandas
 import datetime
+import time
 from omegaconf import OmegaConf
 
-from soundbay.results_analysis import inference_csv_to_raven
+from soundbay.cascade import Cascade
+from soundbay.prescreen import PreScreen, create_prescreen
 from soundbay.utils.logging import Logger
+from soundbay.utils.audio_index import AudioIndex, DirectoryIndex
 from soundbay.utils.checkpoint_utils import merge_with_checkpoint
+from soundbay.utils.inference_pipeline import InferencePipeline
+from soundbay.utils.results_writers import RESULTS_FORMATS, RavenWriter, create_results_writer
 from soundbay.conf_dict import models_dict, datasets_dict
 
 
+def _merge_skipped(first: int, stop: int, indices: np.ndarray, predictions: np.ndarray, noise: np.ndarray,
+                   batch_size: int) -> Generator[Tuple[int, np.ndarray], None, None]:
+    """
+    the predictions of the windows [first, stop) of a dataset, batch_size windows at a time, where the windows in
+    indices got predictions and all the others noise
+    """
+    for begin in range(first, stop, batch_size):
+        end = min(begin + batch_size, stop)
+        batch = np.tile(noise, (end - begin, 1))
+        low, high = np.searchsorted(indices, [begin, end])
+        batch[indices[low:high] - begin] = predictions[low:high]
+        yield begin, batch
+
+
+def iter_predictions(model: torch.nn.Module, data_loader,
+                     device: torch.device = torch.device('cpu'),
+                     apply_softmax: bool = True,
+                     prescreen: Optional[PreScreen] = None,
+                     cascade: Optional[Cascade] = None,
+                     ) -> Generator[Tuple[Optional[pd.DataFrame], np.ndarray], None, None]:
+    """
+    predicts the batches of the data loader one at a time, and yields the predictions of every batch as soon as it is
+    done, with the metadata rows of its windows
+    Input:
+        model: the wanted trained model for the inference
+        data_loader: dataloader class (or InferencePipeline), iterating over the dataset in the order of its metadata
+        device: cpu or gpu - torch.device()
+        apply_softmax: the predictions are the softmax of the model outputs over the classes, the raw outputs if False
+        prescreen: if given, only the windows the PreScreen keeps are read and predicted (by a DataLoader with the
+                   batch size of data_loader), and the skipped ones get the Noise class - 1 for the first class and 0
+                   for the others
+        cascade: if given, the windows the first model is unsure about are predicted again by the second stage (see
+                 Cascade), needs apply_softmax
+
+    Output (per batch):
+        metadata: the rows of the dataset metadata of the batch windows, None if the dataset has no metadata
+        predictions: [batch size, num classes] numpy array
+    """
+    dataset = getattr(data_loader, 'dataset', None)
+    metadata = getattr(dataset, 'metadata', None)
+    batch_preprocessor = getattr(dataset, 'batch_preprocessor', None)
+    if batch_preprocessor is not None:
+        batch_preprocessor.to(device)
+    kept = None
+    if prescreen is not None:
+        if isinstance(dataset, IterableDataset):
+            raise ValueError('the pre-screen needs a map-style dataset, got an IterableDataset')
+        batch_size = data_loader.batch_size
+        keep = prescreen.keep_mask(dataset)
+        kept = np.flatnonzero(keep)
+        print(f'Pre-screen skips {1 - len(kept) / max(len(dataset), 1):.1%} of the windows '
+              f'({len(dataset) - len(kept)} of {len(dataset)})')
+        if len(kept) == 0 and len(dataset) > 0:
+            kept = np.array([0])  # a window is predicted anyway for the number of classes, and yielded as noise
+        data_loader = DataLoader(dataset=Subset(dataset, kept), shuffle=False, batch_size=batch_size,
+                                 num_workers=0, pin_memory=False)
+    if cascade is not None:
+        assert apply_softmax, 'the cascade escalates windows by the probabilities of the first stage'
+        cascade.bind(dataset)
+    offset, n_predicted = 0, 0  # the number of windows yielded and predicted so far
+    with torch.no_grad():
+        model.eval()
+        for audio in tqdm(data_loader):
+            waveforms = audio = audio.to(device)
+            if batch_preprocessor is not None:
+                audio = batch_preprocessor(audio)
+            predictions = model(audio)
+            if apply_softmax:
+                predictions = torch.softmax(predictions, dim=1)
+            predictions = predictions.cpu().numpy()
+            indices = np.arange(offset, offset + len(predictions)) if kept is None \
+                else kept[n_predicted:n_predicted + len(predictions)]
+            n_predicted += len(predictions)
+            if cascade is not None:
+                predictions = cascade.refine(predictions, waveforms, audio, indices)
+            if kept is None:
+                batch_metadata = None if metadata is None else metadata.iloc[offset:offset + len(predictions)]
+                offset += len(predictions)
+                yield batch_metadata, predictions
+                continue
+            # the windows skipped since the previous batch are yielded with this one
+            noise = np.eye(predictions.shape[1], dtype=predictions.dtype)[0]
+            predictions[~keep[indices]] = noise
+            for first, batch in _merge_skipped(offset, indices[-1] + 1, indices, predictions, noise, batch_size):
+                yield None if metadata is None else metadata.iloc[first:first + len(batch)], batch
+            offset = indices[-1] + 1
+    if kept is not None and offset < len(dataset):
+        for first, batch in _merge_skipped(offset, len(dataset), kept[:0], predictions[:0], noise, batch_size):
+            yield None if metadata is None else metadata.iloc[first:first + len(batch)], batch
+
+
 def predict_proba(model: torch.nn.Module, data_loader: DataLoader,
                   device: torch.device = torch.device('cpu'),
                   selected_class_idx: Union[None, int] = None,
+                  prescreen: Optional[PreScreen] = None,
+                  cascade: Optional[Cascade] = None,
                   ) -> np.ndarray:
     """
     calculates the predicted probability to belong to a class for all the samples in the dataset given a specific model
@@ -30,27 +129,27 @@ def predict_proba(model: torch.nn.Module, data_loader: DataLoader,
         data_loader: dataloader class, containing the dataset location, metadata, batch size etc.
         device: cpu or gpu - torch.device()
         selected_class_idx: the wanted class for prediction. must be bound by the number of classes in the model
+        prescreen: skips the windows the PreScreen drops, see iter_predictions
+        cascade: predicts the uncertain windows again with a second stage, see iter_predictions
 
     Output:
-        softmax_activation: the vector of the predictions of all the samples after a softmax function
+        softmax_activation: the vector of the predictions of all the samples after a softmax function, the model
+        outputs of the selected class if selected_class_idx is given
 
     """
-    all_predictions = []
-    with torch.no_grad():
-        model.eval()
-        for audio in tqdm(data_loader):
-            audio = audio.to(device)
+    predictions = [batch_predictions for _, batch_predictions in
+                   iter_predictions(model, data_loader, device, apply_softmax=selected_class_idx is None,
+                                    prescreen=prescreen, cascade=cascade)]
+    predictions = np.concatenate(predictions)
+    if selected_class_idx is None:
+        return predictions
+    if selected_class_idx not in range(predictions.shape[1]):
+        raise ValueError(f'selected class index {selected_class_idx} not in output dimensions')
+    return predictions[:, selected_class_idx]
 
-            predicted_probability = model(audio).cpu().numpy()
-            if selected_class_idx is None:
-                all_predictions.extend(predicted_probability)
-            else:
-                if selected_class_idx in list(range(predicted_probability.shape[1])):
-                    return predicted_probability[:, selected_class_idx]
-                else:
-                    raise ValueError(f'selected class index {selected_class_idx} not in output dimensions')
-        softmax_activation = softmax(all_predictions, 1)
-        return softmax_activation
+
+def default_label_names(num_classes: int) -> List[str]:
+    return ['Noise'] + [f'Call_{i}' for i in range(1, num_classes)]
 
 
 def load_model(model_params, checkpoint_state_dict):
@@ -69,6 +168,30 @@ def load_model(model_params, checkpoint_state_dict):
     return model
 
 
+def create_cascade(cascade_args, dataset_args, device) -> Optional[Cascade]:
+    """
+    loads the second stage of the experiment.cascade arguments, None if it is not enabled
+    Input:
+        cascade_args: enabled, checkpoint (the path of the second-stage checkpoint) and band
+        dataset_args: the arguments of the first-stage dataset
+        device: cpu/gpu
+    """
+    if cascade_args is None or not cascade_args.get('enabled', False):
+        return None
+    ckpt_dict = torch.load(cascade_args['checkpoint'], map_location=torch.device('cpu'))
+    ckpt_args = ckpt_dict['args']
+    train_dataset = ckpt_args.data.train_dataset
+    if train_dataset.seq_length != dataset_args['seq_length']:
+        raise ValueError(f"the second stage windows are {train_dataset.seq_length}s long, the first stage windows "
+                         f"are {dataset_args['seq_length']}s")
+    model = load_model(OmegaConf.create(OmegaConf.to_container(ckpt_args.model.model, resolve=True)),
+                       ckpt_dict['model']).to(device)
+    to_container = lambda x: OmegaConf.to_container(x, resolve=True) if OmegaConf.is_config(x) else x
+    return Cascade(model, to_container(train_dataset.preprocessors), train_dataset.sample_rate,
+                   band=tuple(cascade_args.get('band', (0.1, 0.9))),
+                   first_stage_preprocessors=to_container(dataset_args.get('preprocessors')), device=device)
+
+
 def infer_with_metadata(
         device,
         batch_size,
@@ -95,6 +218,12 @@ def infer_with_metadata(
     seq_length=dataset_args['seq_length'], data_sample_rate=dataset_args['data_sample_rate'],
     sample_rate=dataset_args['sample_rate'], 
     mode=dataset_args['mode'], slice_flag=dataset_args['slice_flag'], path_hierarchy=dataset_args['path_hierarchy'],
+    file_pool_size=dataset_args.get('file_pool_size', 16), audio_backend=dataset_args.get('audio_backend', 'soundfile'),
+    sample_store=dataset_args.get('sample_store'),
+    feature_cache=dataset_args.get('feature_cache'), feature_cache_max_gb=dataset_args.get('feature_cache_max_gb', 10),
+    metadata_cache=dataset_args.get('metadata_cache'),
+    batch_preprocessing=dataset_args.get('batch_preprocessing', False),
+    persist_index=dataset_args.get('persist_index', False), index_dir=dataset_args.get('index_dir'),
     )
 
     # load model
@@ -140,7 +269,14 @@ def infer_without_metadata(
         save_raven,
         threshold,
         label_names,
-        raven_max_freq
+        raven_max_freq,
+        chunk_length=None,
+        num_processes=1,
+        pipeline=None,
+        results_format='csv',
+        prescreen=None,
+        cascade=None,
+        raven=None,
 ):
     """
         This functions takes the InferenceDataset dataset and produces the model prediction to a file, by iterating
@@ -151,65 +287,199 @@ def infer_without_metadata(
             dataset_args: the required arguments for the dataset class
             model_path: directory for the wanted trained model
             output_path: directory to save the prediction file
+            chunk_length: if given, the files are processed in chunks of chunk_length seconds (see predict_in_chunks)
+            num_processes: the files of a directory are shared between num_processes processes on the cpu
+                           (see predict_files_in_parallel)
+            pipeline: arguments of the InferencePipeline the dataset is iterated with, used when pipeline.enabled
+            results_format: csv or parquet, the results are written batch by batch as they are predicted, in the
+                            order of the dataset windows (InferenceDataset: by file, channel and begin time)
+            prescreen: arguments of the PreScreen (see create_prescreen), used when prescreen.enabled, the windows
+                       it skips are not predicted and get the Noise class
+            cascade: arguments of the second stage (see create_cascade), used when cascade.enabled, the windows whose
+                     call probability is inside cascade.band are predicted again by the second-stage model. When
+                     both stages have the same sample rate but preprocess differently, the dataset is switched to
+                     batch_preprocessing, so the second stage reuses the waveforms of the batches
+            raven: arguments of the RavenWriter the selections are written with (low_threshold, min_gap,
+                   num_workers), consecutive or overlapping positive windows are merged into events
     """
+    if results_format not in RESULTS_FORMATS:
+        raise ValueError(f'results_format should be one of {RESULTS_FORMATS}, got {results_format}')
+    prescreen = create_prescreen(prescreen)
     # load model
     model = load_model(model_args, checkpoint_state_dict).to(device)
-    all_raven_list = []
+    cascade = create_cascade(cascade, dataset_args, device)
+    if cascade is not None:
+        if num_processes > 1:
+            raise ValueError('the cascade runs in a single process, set num_processes to 1')
+        dataset_args = dict(dataset_args)
+        if not cascade.same_preprocessing and cascade.sample_rate == dataset_args['sample_rate'] \
+                and not dataset_args.get('batch_preprocessing', False):
+            # the batches keep the waveforms, for the second stage to preprocess them its way
+            print('Notice: the cascade stages preprocess differently, the first-stage windows are preprocessed on '
+                  'the batches (batch_preprocessing=True) so the second stage reuses their waveforms')
+            dataset_args['batch_preprocessing'] = True
+    start = time.perf_counter()
+    dataset_name = Path(dataset_args['file_path']).stem
+    filename = f"Inference_results-{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}-{model_name}-{dataset_name}.{results_format}"
+    output_file = output_path / filename
+    raven_writer = None
+    if save_raven:
+        raven_output_path = output_path / dataset_name if Path(dataset_args['file_path']).is_dir() else output_path
+        raven_output_path.mkdir(exist_ok=True)
+        raven_writer = RavenWriter(raven_output_path, model_name, threshold,
+                                   max_freq=dataset_args['sample_rate'] // 2 if raven_max_freq is None
+                                   else raven_max_freq, **(raven or {}))
+    if chunk_length is not None:
+        predict_in_chunks(model, dataset_args, chunk_length, batch_size, device, output_file,
+                          label_names=label_names, raven_writer=raven_writer, prescreen=prescreen, cascade=cascade)
+        if cascade is not None:
+            cascade.report(time.perf_counter() - start)
+        return
     dataset_args = dict(dataset_args)
     dataset_type = dataset_args.pop('_target_')
-    test_dataset = datasets_dict[dataset_type](**dataset_args)
-    test_dataloader = DataLoader(dataset=test_dataset, shuffle=False, batch_size=batch_size, num_workers=0,
-                                 pin_memory=False)
+    if num_processes > 1 and Path(dataset_args['file_path']).is_dir():
+        batches = [predict_files_in_parallel(model.cpu(), dataset_type, dataset_args, batch_size, num_processes,
+                                             prescreen=prescreen)]
+    else:
+        test_dataset = datasets_dict[dataset_type](**dataset_args)
+        if pipeline is not None and pipeline.get('enabled', False) and not isinstance(test_dataset, IterableDataset):
+            test_dataloader = InferencePipeline(test_dataset, batch_size,
+                                                **{k: v for k, v in pipeline.items() if k != 'enabled'})
+        else:
+            test_dataloader = DataLoader(dataset=test_dataset, shuffle=False, batch_size=batch_size, num_workers=0,
+                                         pin_memory=False)
+        batches = iter_predictions(model, test_dataloader, device, prescreen=prescreen, cascade=cascade)
+
+    # the results of every batch are written as soon as it is predicted, and the Raven selections of a file once all
+    # its windows are (the windows come file by file)
+    n_windows = 0
+    with create_results_writer(output_file) as writer:
+        for metadata, predict_prob in batches:
+            n_windows += len(predict_prob)
+            label_names = default_label_names(predict_prob.shape[1]) if label_names is None else label_names
+            results_df = pandas.DataFrame(predict_prob, columns=label_names)
+            batch_df = pandas.concat([metadata.reset_index(drop=True), results_df], axis=1)
+            writer.write(batch_df)
+            if raven_writer is not None:
+                raven_writer.write(batch_df, label_names)
+    if raven_writer is not None:
+        raven_writer.close()
+    if cascade is not None:
+        cascade.report(time.perf_counter() - start, n_windows)
 
-    # predict
-    predict_prob = predict_proba(model, test_dataloader, device, None)
-    label_names = ['Noise'] + [f'Call_{i}' for i in
-                               range(1, predict_prob.shape[1] + 1)] if label_names is None else label_names
+    return
 
-    results_df = pandas.DataFrame(predict_prob, columns=label_names)
 
-    concat_dataset = pandas.concat([test_dataset.metadata, results_df], axis=1)
-    # create raven file
-    raven_max_freq = dataset_args['sample_rate'] // 2 if raven_max_freq is None else raven_max_freq
-    if save_raven:
-        for file, df in concat_dataset.groupby('filename'):
-            file_raven_lists = []
-            for i in range(1, predict_prob.shape[1]):
-                file_raven_lists.append(
-                                       inference_csv_to_raven(results_df=df,
-                                                              num_classes=predict_prob.shape[1],
-                                                              seq_len=dataset_args['seq_length'],
-                                                              selected_class=label_names[i],
-                                                              threshold=threshold,
-                                                              class_name=label_names[i],
-                                                              max_freq=raven_max_freq)
-                                   )
-            whole_file_df = pd.concat(file_raven_lists, axis=0).sort_values('Begin Time (s)')
-            whole_file_df['Selection'] = np.arange(1, len(whole_file_df) + 1)
-            all_raven_list.append((file, whole_file_df))
-
-    #save file
-    dataset_name = Path(test_dataset.metadata_path).stem
-    filename = f"Inference_results-{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}-{model_name}-{dataset_name}.csv"
-    output_file = output_path / filename
-    concat_dataset = concat_dataset.sort_values(by=['filename', 'begin_time'])
-    concat_dataset.to_csv(index=False, path_or_buf=output_file)
+_worker_model = None
 
-    # Save raven file
-    if save_raven:
-        if Path(test_dataset.metadata_path).is_dir():
-            output_path = output_path / dataset_name
-            output_path.mkdir(exist_ok=True)
-        for filename, raven_out_df in all_raven_list:
-            save_raven_file(filename, raven_out_df, output_path, model_name)
 
-    return
+def _init_inference_worker(model, num_threads):
+    global _worker_model
+    torch.set_num_threads(num_threads)
+    _worker_model = model
+
+
+def _predict_file(task):
+    file, dataset_type, dataset_args, batch_size, prescreen = task
+    dataset = datasets_dict[dataset_type](file_path=file, **dataset_args)
+    data_loader = DataLoader(dataset=dataset, shuffle=False, batch_size=batch_size, num_workers=0, pin_memory=False)
+    if len(dataset) == 0:
+        return file, dataset.metadata, None
+    return file, dataset.metadata, predict_proba(_worker_model, data_loader, prescreen=prescreen)
 
 
-def save_raven_file(filename, raven_out_df, output_path, model_name):
-    raven_filename = f"{filename.stem}-Raven-inference_results-{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}-{model_name}.txt"
-    raven_output_file = output_path / raven_filename
-    raven_out_df.to_csv(index=False, path_or_buf=raven_output_file, sep='\t')
+def predict_files_in_parallel(model, dataset_type, dataset_args, batch_size, num_processes, prescreen=None):
+    """
+    Predicts the files of a directory in num_processes processes on the cpu, each with its own copy of the model and
+    an equal share of the torch threads. The longest files are scheduled first, so files of uneven durations don't
+    leave processes idle at the end.
+    Input:
+        model: the trained model
+        dataset_type: the dataset class name, as in datasets_dict
+        dataset_args: the arguments of the dataset, file_path is the directory
+        batch_size: the number of samples the model will infer at once
+        num_processes: the number of worker processes
+        prescreen: a PreScreen, see iter_predictions
+    Output:
+        metadata: the metadata of all the files, ordered by filename
+        predict_prob: the predictions matching the metadata rows
+    """
+    dataset_args = dict(dataset_args)
+    file_path = Path(dataset_args.pop('file_path'))
+    persist, index_dir = dataset_args.get('persist_index', False), dataset_args.get('index_dir')
+    files = sorted(DirectoryIndex(file_path, persist=persist, index_dir=index_dir).paths(suffix=None, recursive=False))
+    for file in files:
+        if file.suffix not in ['.wav', '.WAV']:
+            raise ValueError(f'InferenceDataset only supports .wav files, got {file.suffix}')
+    audio_index = AudioIndex(file_path, files, persist=persist, index_dir=index_dir)
+    tasks = [(file, dataset_type, dataset_args, batch_size, prescreen)
+             for file in sorted(files, key=lambda f: audio_index[f].duration, reverse=True)]
+    num_threads = max(torch.get_num_threads() // num_processes, 1)
+    results = {}
+    with multiprocessing.get_context('spawn').Pool(num_processes, initializer=_init_inference_worker,
+                                                   initargs=(model, num_threads)) as pool:
+        for file, metadata, predict_prob in tqdm(pool.imap_unordered(_predict_file, tasks), total=len(tasks)):
+            results[file] = (metadata, predict_prob)
+    results = [results[file] for file in files if results[file][1] is not None]
+    metadata = pandas.concat([metadata for metadata, _ in results], ignore_index=True)
+    return metadata, np.concatenate([predict_prob for _, predict_prob in results])
+
+
+def predict_in_chunks(model, dataset_args, chunk_length, batch_size, device, output_file, label_names=None,
+                      raven_writer=None, prescreen=None, cascade=None):
+    """
+    Predicts the windows of an InferenceDataset chunk_length seconds of a file at a time, and appends the results of
+    every chunk to the output file, so memory does not grow with the recordings length (the Raven writer only keeps
+    the windows that may be part of an event).
+    Input:
+        model: the trained model, on device
+        dataset_args: the arguments of the dataset, including _target_
+        chunk_length: the duration of a chunk in seconds
+        batch_size: the number of samples the model will infer at once
+        device: cpu/gpu
+        output_file: path of the results file, .csv or .parquet
+        label_names: names of the classes, defaults to Noise, Call_1, Call_2...
+        raven_writer: the RavenWriter of the Raven files (one per recording), None skips them, closed at the end
+        prescreen: a PreScreen, see iter_predictions
+        cascade: a Cascade, see iter_predictions
+    """
+    dataset_args = dict(dataset_args)
+    dataset_type = dataset_args.pop('_target_')
+    file_path = Path(dataset_args.pop('file_path'))
+    files = sorted(DirectoryIndex(file_path, persist=dataset_args.get('persist_index', False),
+                                  index_dir=dataset_args.get('index_dir')).paths(suffix=None, recursive=False)) \
+        if file_path.is_dir() else [file_path]
+    step = dataset_args.get('seq_length', 1) * (1 - dataset_args.get('overlap', 0))
+    windows_per_chunk = max(int(chunk_length // step), 1)
+    writer = create_results_writer(output_file)
+    # the rows come in the order of the whole file metadata: InferenceDataset orders the windows of a file channel by
+    # channel, so the chunks are taken channel by channel too, StreamingInferenceDataset orders them by time
+    by_channel = not issubclass(datasets_dict[dataset_type], IterableDataset)
+    for file in files:
+        channel, n_channels = 0, 1
+        while channel < n_channels:
+            first, window_count = 0, 1
+            while first < window_count:
+                dataset = datasets_dict[dataset_type](file_path=file, window_slice=(first, first + windows_per_chunk),
+                                                      channel=channel if by_channel else None, **dataset_args)
+                window_count = dataset.window_count(file)
+                n_channels = dataset.audio_index[file].channels if by_channel else 1
+                first += windows_per_chunk
+                if len(dataset) == 0:
+                    continue
+                data_loader = DataLoader(dataset=dataset, shuffle=False, batch_size=batch_size, num_workers=0,
+                                         pin_memory=False)
+                predict_prob = predict_proba(model, data_loader, device, None, prescreen, cascade)
+                label_names = default_label_names(predict_prob.shape[1]) if label_names is None else label_names
+                results_df = pandas.DataFrame(predict_prob, columns=label_names)
+                chunk_df = pandas.concat([dataset.metadata, results_df], axis=1)
+                writer.write(chunk_df)
+                if raven_writer is not None:
+                    raven_writer.write(chunk_df, label_names)
+            channel += 1
+    writer.close()
+    if raven_writer is not None:
+        raven_writer.close()
 
 
 def inference_to_file(
@@ -223,7 +493,14 @@ def inference_to_file(
     save_raven,
     threshold,
     label_names,
-    raven_max_freq
+    raven_max_freq,
+    chunk_length=None,
+    num_processes=1,
+    pipeline=None,
+    results_format='csv',
+    prescreen=None,
+    cascade=None,
+    raven=None,
 ):
     """
     This functions takes the dataset and produces the model prediction to a file
@@ -262,7 +539,14 @@ def inference_to_file(
                           save_raven,
                           threshold,
                           label_names,
-                          raven_max_freq)
+                          raven_max_freq,
+                          chunk_length,
+                          num_processes,
+                          pipeline,
+                          results_format,
+                          prescreen,
+                          cascade,
+                          raven)
     else:
         raise ValueError('Only ClassifierDataset or InferenceDataset allowed in inference')
 
@@ -303,6 +587,14 @@ def inference_main(args) -> None:
         threshold=args.experiment.threshold,
         label_names=args.data.label_names,
         raven_max_freq=args.experiment.raven_max_freq,
+        chunk_length=args.experiment.get('chunk_length'),
+        num_processes=args.experiment.get('num_processes', 1),
+        pipeline=args.experiment.get('pipeline'),
+        results_format=args.experiment.get('results_format', 'csv'),
+        prescreen=dict(args.experiment.get('prescreen') or {}, min_freq=args.data.get('min_freq'),
+                       max_freq=args.data.get('max_freq')),
+        cascade=args.experiment.get('cascade'),
+        raven=args.experiment.get('raven'),
     )
     print("Finished inference")
 
@@ -0,0 +1,278 @@
+import collections
+import json
+import queue
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional, Tuple
+from urllib.parse import parse_qs, quote, urlparse
+from urllib.request import Request, urlopen
+
+import hydra
+import numpy as np
+import pandas as pd
+import torch
+
+from soundbay.data import BaseDataset, BatchPreprocessor, InferenceDataset
+from soundbay.inference import default_label_names, load_model
+from soundbay.results_analysis import RAVEN_COLUMNS, extract_events
+from soundbay.utils.checkpoint_utils import merge_with_checkpoint
+
+
+class _Request:
+    def __init__(self, windows: torch.Tensor):
+        self.windows = windows
+        self.arrival = time.monotonic()
+        self.outputs = []
+        self.error = None
+        self.done = threading.Event()
+
+
+class DynamicBatcher:
+    """
+    Predicts the windows submitted by concurrent callers in shared batches, on a single thread that owns the model.
+    A batch is run once it holds max_batch_size windows, or max_latency seconds after the oldest waiting request
+    arrived, whichever comes first. A request with more than max_batch_size windows is split over several batches.
+    The number of requests, batches and windows predicted so far are kept in n_requests, n_batches and n_windows.
+    Input:
+        model: the trained model, on device
+        batch_preprocessor: a BatchPreprocessor applied to the windows before the model, None for the raw windows
+        device: cpu/gpu
+        max_batch_size: the maximal number of windows in a batch
+        max_latency: the maximal time in seconds a request waits for other requests to share its batch
+    """
+
+    def __init__(self, model: torch.nn.Module, batch_preprocessor: Optional[BatchPreprocessor] = None,
+                 device: torch.device = torch.device('cpu'), max_batch_size: int = 64, max_latency: float = 0.01):
+        assert max_batch_size >= 1, f'max_batch_size should be a positive integer, got {max_batch_size}'
+        assert max_latency >= 0, f'max_latency should be non negative, got {max_latency}'
+        self.model = model.eval()
+        self.batch_preprocessor = batch_preprocessor.to(device) if batch_preprocessor is not None else None
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.n_requests, self.n_batches, self.n_windows = 0, 0, 0
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, windows: torch.Tensor) -> np.ndarray:
+        """
+        predicts a [N, 1, T] tensor of windows, blocking until all of them are done
+        Output:
+            predictions: [N, num classes] numpy array of the softmax of the model outputs
+        """
+        assert len(windows) > 0, 'a request should have at least one window'
+        request = _Request(windows)
+        self._requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return np.concatenate(request.outputs)
+
+    def close(self):
+        self._requests.put(None)
+        self._thread.join()
+
+    def _predict(self, windows: torch.Tensor) -> np.ndarray:
+        with torch.no_grad():
+            audio = windows.to(self.device)
+            if self.batch_preprocessor is not None:
+                audio = self.batch_preprocessor(audio)
+            return torch.softmax(self.model(audio), dim=1).cpu().numpy()
+
+    def _run(self):
+        pending = collections.deque()  # [request, index of its first window that is not predicted yet]
+        closing = False
+        while not closing or pending:
+            if not pending:
+                request = self._requests.get()
+                if request is None:
+                    return
+                pending.append([request, 0])
+            # wait for more requests until the batch is full or the oldest one is due
+            deadline = pending[0][0].arrival + self.max_latency
+            while not closing and sum(len(r.windows) - first for r, first in pending) < self.max_batch_size:
+                try:
+                    timeout = deadline - time.monotonic()
+                    request = self._requests.get(timeout=timeout) if timeout > 0 else self._requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    closing = True
+                else:
+                    pending.append([request, 0])
+            parts, size = [], 0
+            while pending and size < self.max_batch_size:
+                request, first = pending[0]
+                last = min(len(request.windows), first + self.max_batch_size - size)
+                parts.append((request, first, last))
+                size += last - first
+                if last == len(request.windows):
+                    pending.popleft()
+                else:
+                    pending[0][1] = last
+            try:
+                predictions = self._predict(torch.cat([request.windows[first:last] for request, first, last in parts]))
+            except Exception as e:
+                for request, _, _ in parts:
+                    request.error = e
+                    request.done.set()
+                pending = collections.deque(entry for entry in pending if entry[0].error is None)
+                continue
+            self.n_batches += 1
+            self.n_windows += size
+            offset = 0
+            for request, first, last in parts:
+                request.outputs.append(predictions[offset:offset + last - first])
+                offset += last - first
+                if last == len(request.windows):
+                    self.n_requests += 1
+                    request.done.set()
+
+
+class InferenceServer(ThreadingHTTPServer):
+    """
+    A local HTTP inference service that keeps the model loaded. The windows of the recordings posted by concurrent
+    clients are predicted together by a DynamicBatcher, and every client gets the same per-window probabilities and
+    Raven selections infer_without_metadata writes for its recording.
+        POST /predict?filename=<name>.wav, with the wav file as the body: {"results": [...], "raven": [...]}, the
+            rows of the results file and of the Raven selections of the recording
+        GET /health: {"requests": ..., "batches": ..., "windows": ...}, counted since the server started
+    Input:
+        address: (host, port), port 0 picks a free port (see server_address)
+        batcher: the DynamicBatcher the windows are predicted with, it applies the preprocessor
+        dataset_args: the arguments of the InferenceDataset, file_path and preprocessors are ignored
+        label_names: names of the classes, defaults to Noise, Call_1, Call_2...
+        threshold, raven_max_freq: as in infer_without_metadata
+        raven: low_threshold and min_gap of the Raven selections, as in infer_without_metadata (see extract_events)
+    """
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], batcher: DynamicBatcher, dataset_args, label_names=None,
+                 threshold: float = 0.5, raven_max_freq: Optional[float] = None, raven=None):
+        dataset_args = dict(dataset_args)
+        target = dataset_args.pop('_target_', 'soundbay.data.InferenceDataset')
+        if not target.endswith('InferenceDataset'):
+            raise ValueError(f'the inference server only supports InferenceDataset, got {target}')
+        super().__init__(address, _InferenceRequestHandler)
+        for key in ['file_path', 'preprocessors', 'batch_preprocessing', 'window_slice']:
+            dataset_args.pop(key, None)
+        self.dataset_args = dataset_args
+        self.batcher = batcher
+        self.label_names = label_names
+        self.threshold = threshold
+        self.raven_max_freq = dataset_args['sample_rate'] // 2 if raven_max_freq is None else raven_max_freq
+        self.raven_args = {key: value for key, value in (raven or {}).items() if key in ['low_threshold', 'min_gap']}
+
+    def predict(self, data: bytes, filename: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        predicts the windows of a wav file given by its content
+        Output:
+            results: the metadata and the class probabilities of the windows, as in the results file
+            raven: the Raven selections of the recording
+        """
+        filename = Path(filename).name
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = Path(tmp_dir) / filename
+            file_path.write_bytes(data)
+            # the preprocessor is applied by the batcher, the dataset only reads and resamples the windows
+            dataset = InferenceDataset(file_path=file_path, preprocessors={}, **self.dataset_args)
+            windows = torch.stack([dataset[idx] for idx in range(len(dataset))])
+            metadata = dataset.metadata.assign(filename=filename)
+            dataset.audio_reader.close()
+        predict_prob = self.batcher.submit(windows)
+        label_names = default_label_names(predict_prob.shape[1]) if self.label_names is None else self.label_names
+        results = pd.concat([metadata, pd.DataFrame(predict_prob, columns=label_names)], axis=1)
+        raven = extract_events(results, label_names, self.threshold, max_freq=self.raven_max_freq,
+                               **self.raven_args)[RAVEN_COLUMNS]
+        return results, raven
+
+
+class _InferenceRequestHandler(BaseHTTPRequestHandler):
+    def _respond(self, status: int, body: str):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/health':
+            self._respond(404, json.dumps({'error': f'unknown path {self.path}'}))
+            return
+        batcher = self.server.batcher
+        self._respond(200, json.dumps({'requests': batcher.n_requests, 'batches': batcher.n_batches,
+                                       'windows': batcher.n_windows}))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/predict':
+            self._respond(404, json.dumps({'error': f'unknown path {self.path}'}))
+            return
+        filename = parse_qs(url.query).get('filename', ['recording.wav'])[0]
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            results, raven = self.server.predict(data, filename)
+        except Exception as e:
+            self._respond(400, json.dumps({'error': f'{type(e).__name__}: {e}'}))
+            return
+        self._respond(200, f'{{"results": {results.to_json(orient="records")}, '
+                           f'"raven": {raven.to_json(orient="records")}}}')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def request_predictions(url: str, file_path, timeout: float = 600) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    posts a wav file to an InferenceServer and returns its results and Raven selections (see InferenceServer.predict)
+    Input:
+        url: the address of the server, e.g. http://127.0.0.1:8000
+        file_path: path of the wav file
+    """
+    file_path = Path(file_path)
+    request = Request(f"{url.rstrip('/')}/predict?filename={quote(file_path.name)}", data=file_path.read_bytes(),
+                      headers={'Content-Type': 'audio/wav'}, method='POST')
+    with urlopen(request, timeout=timeout) as response:
+        body = json.loads(response.read())
+    return pd.DataFrame(body['results']), pd.DataFrame(body['raven'])
+
+
+@hydra.main(config_name="/runs/inference_single_audio.yaml", config_path="conf", version_base='1.2')
+def server_main(args) -> None:
+    """
+    Serves a trained model on a local port (experiment.server), with the InferenceDataset arguments of inference_main
+    (data.test_dataset). The checkpoint is loaded once, and the server runs until it is interrupted.
+    Input:
+        args: from conf file (for instance: inference_single_audio.yaml)
+    """
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    ckpt_dict = torch.load(args.experiment.checkpoint.path, map_location=torch.device('cpu'))
+    args = merge_with_checkpoint(args, ckpt_dict['args'])
+    model = load_model(args.model.model, ckpt_dict['model']).to(device)
+    preprocessor = BaseDataset.set_preprocessor(args.data.test_dataset.preprocessors)
+    server_args = args.experiment.get('server', {})
+    batcher = DynamicBatcher(model, BatchPreprocessor(preprocessor), device,
+                             max_batch_size=server_args.get('max_batch_size', args.data.batch_size),
+                             max_latency=server_args.get('max_latency', 0.01))
+    server = InferenceServer((server_args.get('host', '127.0.0.1'), server_args.get('port', 8000)), batcher,
+                             args.data.test_dataset, label_names=args.data.label_names,
+                             threshold=args.experiment.threshold, raven_max_freq=args.experiment.raven_max_freq,
+                             raven=args.experiment.get('raven'))
+    host, port = server.server_address[:2]
+    print(f"Serving {args.experiment.checkpoint.path} on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+if __name__ == "__main__":
+    server_main()
@@ -0,0 +1,92 @@
+"""Code to materialize the recordings of a dataset as a sample store at the training sample rate"""
+
+import argparse
+from pathlib import Path
+
+import pandas as pd
+import soundfile as sf
+import torch
+import torchaudio
+from tqdm import tqdm
+
+from soundbay.data import BaseDataset
+from soundbay.utils.sample_store import SampleStore, SAMPLE_STORE_DTYPES, SAMPLE_STORE_INDEX, \
+    update_sample_store_index, write_samples
+
+
+def materialize(data_path, out_path, sample_rate, metadata_paths=(), dtype='int16', path_hierarchy=0, force=False,
+                index_every=500):
+    """
+    Resamples the recordings referenced by the metadata files (all the recordings under data_path if none are given)
+    to sample_rate and writes them to a sample store, which the datasets read with the sample_store argument.
+
+    Parameters:
+    -----------
+    data_path: str
+        Path to the dataset, as given to the dataset classes
+    out_path: str
+        Path to the sample store directory
+    sample_rate: int
+        The sample rate the model is trained on (data.sample_rate)
+    metadata_paths: list of str
+        Annotation files whose recordings are materialized
+    dtype: str
+        'int16' or 'float16'
+    path_hierarchy: int
+        As given to the dataset classes
+    force: bool
+        Rewrite recordings that are already in the store
+    index_every: int
+        The index of the store is updated every index_every recordings (and at the end), so an interrupted run
+        resumes from the last update
+    """
+    audio_dict = BaseDataset._create_audio_dict(Path(data_path), path_hierarchy=path_hierarchy)
+    if metadata_paths:
+        names = set()
+        for metadata_path in metadata_paths:
+            names.update(pd.read_csv(metadata_path, dtype={'filename': str})['filename'].unique())
+        missing = names - audio_dict.keys()
+        if missing:
+            print(f'Notice: {len(missing)} recordings in the metadata are not in {data_path}, e.g. {next(iter(missing))}')
+        audio_dict = {name: path for name, path in audio_dict.items() if name in names}
+
+    out_path = Path(out_path)
+    out_path.mkdir(parents=True, exist_ok=True)
+    stored = SampleStore(out_path).audio_dict if (out_path / SAMPLE_STORE_INDEX).is_file() else {}
+    samplers = {}
+    rows = []
+    for name, path in tqdm(sorted(audio_dict.items())):
+        if name in stored and not force:
+            continue
+        data, orig_sample_rate = sf.read(str(path), dtype='float32', always_2d=True)
+        if orig_sample_rate not in samplers:
+            samplers[orig_sample_rate] = torchaudio.transforms.Resample(orig_freq=orig_sample_rate,
+                                                                         new_freq=sample_rate)
+        resampled = samplers[orig_sample_rate](torch.from_numpy(data.T.copy())).numpy().T
+        rows.append(write_samples(out_path, name, resampled, sample_rate, dtype=dtype))
+        if len(rows) >= index_every:
+            update_sample_store_index(out_path, rows, sample_rate)
+            rows = []
+    if rows:
+        update_sample_store_index(out_path, rows, sample_rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Materialize the recordings of a dataset at the training sample rate')
+    parser.add_argument('--path', required=True, help='path to dataset')
+    parser.add_argument('--annot', nargs='*', default=[], help='annotation files whose recordings are materialized '
+                                                               '(all the recordings when omitted)')
+    parser.add_argument('--out', required=True, help='path to the sample store')
+    parser.add_argument('--sample-rate', type=int, required=True, help='target sample rate (data.sample_rate)')
+    parser.add_argument('--dtype', default='int16', choices=SAMPLE_STORE_DTYPES, help='sample dtype in the store')
+    parser.add_argument('--path-hierarchy', type=int, default=0, help='path_hierarchy of the dataset')
+    parser.add_argument('--force', action='store_true', help='force overwrite of recordings already in the store')
+    parser.add_argument('--index-every', type=int, default=500, help='update the store index every N recordings')
+    args = parser.parse_args()
+
+    materialize(args.path, args.out, args.sample_rate, metadata_paths=args.annot, dtype=args.dtype,
+                path_hierarchy=args.path_hierarchy, force=args.force, index_every=args.index_every)
+
+
+if __name__ == '__main__':
+    main()
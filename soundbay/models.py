@@ -295,22 +295,35 @@ class PCENTransform(nn.Module):
         self.trainable = trainable
 
     @staticmethod
-    def pcen(x, eps=1E-6, s=0.025, alpha=0.98, delta=2, r=0.5, training=False):
-        frames = x.split(1, -2)
-        m_frames = []
+    def smooth(x, s, chunk_size=128):
+        """
+        The PCEN smoother M_t = (1 - s) * M_{t-1} + s * x_t along the frames axis (-2), with M_0 = s * x_0.
+        Instead of a loop over frames, every chunk of chunk_size frames is computed at once as a matrix product with
+        the lower triangular kernel s * (1 - s)^(i - j), and only the last state is carried between chunks. s can be
+        a float or a (trainable) tensor.
+        """
+        n_frames = x.shape[-2]
+        chunk_size = min(chunk_size, n_frames)
+        s = torch.as_tensor(s, dtype=x.dtype, device=x.device).reshape(())
+        index = torch.arange(chunk_size, device=x.device)
+        lag = index.unsqueeze(1) - index.unsqueeze(0)
+        kernel = torch.where(lag >= 0, s * (1 - s) ** lag.clamp(min=0).to(x.dtype), torch.zeros_like(s))
+        carry_decay = ((1 - s) ** (index + 1).to(x.dtype)).unsqueeze(1)
+        m_chunks = []
         last_state = None
-        for frame in frames:
-            if last_state is None:
-                last_state = s * frame
-                m_frames.append(last_state)
-                continue
-            if training:
-                m_frame = ((1 - s) * last_state).add_(s * frame)
-            else:
-                m_frame = (1 - s) * last_state + s * frame
-            last_state = m_frame
-            m_frames.append(m_frame)
-        M = torch.cat(m_frames, 1)
+        for start in range(0, n_frames, chunk_size):
+            chunk = x[..., start:start + chunk_size, :]
+            length = chunk.shape[-2]
+            m_chunk = torch.matmul(kernel[:length, :length], chunk)
+            if last_state is not None:
+                m_chunk = m_chunk + carry_decay[:length] * last_state
+            last_state = m_chunk[..., -1:, :]
+            m_chunks.append(m_chunk)
+        return torch.cat(m_chunks, -2)
+
+    @staticmethod
+    def pcen(x, eps=1E-6, s=0.025, alpha=0.98, delta=2, r=0.5, training=False):
+        M = PCENTransform.smooth(x, s)
         if training:
             pcen_ = (x / (M + eps).pow(alpha) + delta).pow(r) - delta ** r
         else:
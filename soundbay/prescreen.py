@@ -0,0 +1,172 @@
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import hydra
+import numpy as np
+import pandas as pd
+import torch
+
+from soundbay.conf_dict import datasets_dict
+from soundbay.data import BaseDataset
+from soundbay.utils.audio_io import to_float32
+from soundbay.utils.checkpoint_utils import merge_with_checkpoint
+
+
+PRESCREEN_METHODS = ('energy', 'flux')
+
+
+def _window_locations(dataset) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    the file ids (into dataset._file_paths), zero-based channels and first samples of the windows of a dataset, as
+    __getitem__ reads them (for a BaseDataset, as in test mode)
+    """
+    if not isinstance(dataset, BaseDataset):
+        return dataset._file_ids, dataset._channels.astype(np.int64), dataset._begin_samples
+    window = int(dataset.seq_length * dataset.data_sample_rate)
+    info = [dataset.audio_index[path] for path in dataset._file_paths]
+    frames = np.array([i.frames for i in info], dtype=np.int64)[dataset._file_ids]
+    multichannel = np.array([i.channels > 1 for i in info])[dataset._file_ids]
+    channels = np.where((dataset._channels > 0) & multichannel, dataset._channels.astype(np.int64) - 1, 0)
+    return dataset._file_ids, channels, np.minimum(dataset._begin_samples, frames - window)
+
+
+class PreScreen:
+    """
+    Scores the windows of a dataset by their band limited energy (or spectral flux), a cheap proxy for the presence
+    of a call, so the model can skip the windows of silent or quiet stretches. Every channel of a file is read once in
+    blocks, cut into non overlapping frames of n_fft samples, and the power (or the positive change of the magnitude
+    from the previous frame) between min_freq and max_freq is summed per frame. The score of a window is the mean over
+    its frames, in dB. Windows scoring below threshold are skipped, see iter_predictions.
+    Input:
+        min_freq, max_freq: the band in Hz, the whole spectrum if None
+        method: 'energy' or 'flux'
+        threshold: the score in dB below which windows are skipped, None keeps every window (see
+                   calibrate_threshold)
+        n_fft: the frame length in samples, at the sample rate of the recordings
+        block_length: the duration in seconds read at once
+    """
+
+    def __init__(self, min_freq: Optional[float] = None, max_freq: Optional[float] = None, method: str = 'energy',
+                 threshold: Optional[float] = None, n_fft: int = 1024, block_length: float = 60):
+        assert method in PRESCREEN_METHODS, f'method should be one of {PRESCREEN_METHODS}, got {method}'
+        self.min_freq = 0 if min_freq is None else min_freq
+        self.max_freq = np.inf if max_freq is None else max_freq
+        self.method = method
+        self.threshold = threshold
+        self.n_fft = n_fft
+        self.block_length = block_length
+
+    def _frame_scores(self, audio_reader, path, channel: int, start: int, n_frames: int,
+                      sample_rate: int) -> np.ndarray:
+        """the band power (or flux) of the n_fft frames of a channel from sample start on"""
+        frequencies = np.fft.rfftfreq(self.n_fft, 1 / sample_rate)
+        band = (frequencies >= self.min_freq) & (frequencies <= self.max_freq)
+        taper = np.hanning(self.n_fft).astype(np.float32)
+        block = max(int(self.block_length * sample_rate) // self.n_fft, 1)
+        scores, previous = [], None
+        for first in range(0, n_frames, block):
+            last = min(first + block, n_frames)
+            audio = to_float32(audio_reader.read(path, start + first * self.n_fft, start + last * self.n_fft,
+                                                 channel))
+            magnitude = np.abs(np.fft.rfft(audio.reshape(-1, self.n_fft) * taper, axis=1))[:, band]
+            if self.method == 'energy':
+                scores.append((magnitude ** 2).sum(axis=1))
+            else:
+                previous = magnitude[:1] if previous is None else previous
+                scores.append(np.maximum(np.diff(magnitude, axis=0, prepend=previous), 0).sum(axis=1))
+                previous = magnitude[-1:]
+        return np.concatenate(scores)
+
+    def scores(self, dataset) -> np.ndarray:
+        """
+        the scores of all the windows of an InferenceDataset (or a ClassifierDataset), in the order of its metadata
+        """
+        sample_rate = dataset.data_sample_rate
+        window = int(dataset.seq_length * sample_rate)
+        if window < self.n_fft:
+            raise ValueError(f'the windows ({window} samples) should be at least n_fft ({self.n_fft}) samples long')
+        file_ids, channels, begins = _window_locations(dataset)
+        scores = np.empty(len(begins), dtype=np.float64)
+        groups = pd.DataFrame({'file_id': file_ids, 'channel': channels}).groupby(['file_id', 'channel']).indices
+        for (file_id, channel), rows in groups.items():
+            # the frames are aligned to the start of the file, so a window gets the same score in any subset of the
+            # windows (e.g. the chunks of predict_in_chunks), and it is scored by the frames inside it
+            start = int(begins[rows].min()) // self.n_fft * self.n_fft
+            n_frames = (int(begins[rows].max()) + window - start) // self.n_fft
+            frame_scores = self._frame_scores(dataset.audio_reader, dataset._file_paths[file_id], int(channel),
+                                              start, n_frames, sample_rate)
+            cumulative = np.concatenate([[0], np.cumsum(frame_scores, dtype=np.float64)])
+            first = np.minimum(-((start - begins[rows]) // self.n_fft), n_frames - 1)
+            last = np.maximum((begins[rows] + window - start) // self.n_fft, first + 1)
+            scores[rows] = (cumulative[last] - cumulative[first]) / (last - first)
+        return 10 * np.log10(scores + 1e-12)
+
+    def keep_mask(self, dataset) -> np.ndarray:
+        """a boolean array, False for the windows of the dataset that score below the threshold"""
+        if self.threshold is None:
+            return np.ones(len(dataset), dtype=bool)
+        return self.scores(dataset) >= self.threshold
+
+
+def create_prescreen(prescreen_args) -> Optional[PreScreen]:
+    """
+    the PreScreen of the experiment.prescreen arguments (with min_freq and max_freq), None if it is not enabled
+    """
+    if prescreen_args is None or not prescreen_args.get('enabled', False):
+        return None
+    if prescreen_args.get('threshold') is None:
+        raise ValueError('the pre-screen threshold is not set, calibrate it with python -m soundbay.prescreen')
+    return PreScreen(**{k: v for k, v in prescreen_args.items() if k not in ['enabled', 'max_recall_loss']})
+
+
+def calibrate_threshold(scores: np.ndarray, is_call: np.ndarray, max_recall_loss: float = 0.01) -> float:
+    """
+    the highest pre-screen threshold that skips at most max_recall_loss of the call windows
+    Input:
+        scores: the pre-screen scores of labeled windows
+        is_call: boolean array, False for the background windows
+        max_recall_loss: the fraction of the call windows that may be skipped
+    """
+    call_scores = np.sort(scores[is_call])
+    assert len(call_scores) > 0, 'the calibration set should have call windows'
+    return float(call_scores[int(max_recall_loss * len(call_scores))])
+
+
+def prescreen_report(scores: np.ndarray, is_call: np.ndarray, threshold: float) -> Dict[str, float]:
+    """
+    the fraction of the windows a threshold skips, and the fraction of the call windows it skips (the recall lost
+    before the model sees the windows)
+    """
+    skipped = scores < threshold
+    return {'threshold': threshold, 'skip_rate': float(skipped.mean()),
+            'recall_loss': float(skipped[is_call].mean()) if is_call.any() else 0.,
+            'windows': len(scores), 'calls': int(is_call.sum())}
+
+
+@hydra.main(config_name="/runs/main_inference.yaml", config_path="conf", version_base='1.2')
+def prescreen_main(args) -> None:
+    """
+    Calibrates the pre-screen threshold (experiment.prescreen) on a labeled test set (data.test_dataset, a
+    ClassifierDataset), with the data arguments of the checkpoint, and prints its skip rate and recall loss.
+    Input:
+        args: from conf file (for instance: main_inference.yaml)
+    """
+    ckpt_dict = torch.load(args.experiment.checkpoint.path, map_location=torch.device('cpu'))
+    args = merge_with_checkpoint(args, ckpt_dict['args'])
+    dataset_args = dict(args.data.test_dataset)
+    dataset = datasets_dict[dataset_args.pop('_target_')](**dataset_args)
+    prescreen_args = args.experiment.prescreen
+    prescreen = PreScreen(args.data.get('min_freq'), args.data.get('max_freq'), prescreen_args.get('method', 'energy'),
+                          n_fft=prescreen_args.get('n_fft', 1024))
+    scores = prescreen.scores(dataset)
+    is_call = ~BaseDataset._noise_mask(dataset._labels)
+    threshold = calibrate_threshold(scores, is_call, prescreen_args.get('max_recall_loss', 0.01))
+    report = prescreen_report(scores, is_call, threshold)
+    print(f"Pre-screen on {Path(dataset.metadata_path).name} ({report['windows']} windows, {report['calls']} calls): "
+          f"threshold {threshold:.2f}dB skips {report['skip_rate']:.1%} of the windows, "
+          f"recall loss {report['recall_loss']:.2%}")
+    print(f"Use it with experiment.prescreen.enabled=true experiment.prescreen.threshold={threshold:.2f}")
+
+
+if __name__ == "__main__":
+    prescreen_main()
@@ -94,6 +94,101 @@ def inference_csv_to_raven(results_df: pd.DataFrame, num_classes, seq_len: float
     return annotations_df
 
 
+RAVEN_COLUMNS = ['Selection', 'View', 'Channel', 'Begin Time (s)', 'End Time (s)', 'Low Freq (Hz)', 'High Freq (Hz)',
+                 'Annotation', 'Class Name', 'Probability']
+
+
+def extract_events(results_df: pd.DataFrame, label_names, threshold: float = 0.5, low_threshold: float = None,
+                   min_gap: float = 0., max_freq: float = 20_000) -> pd.DataFrame:
+    """
+    Extracts the events of every class but the first (noise) from the windows of any number of files and channels,
+    in one grouped pass, as Raven selections.
+    A window is positive when its probability is above threshold, or above low_threshold and joined to a window above
+    threshold by consecutive windows above low_threshold (hysteresis: an event goes on while the probability dips a
+    little). The positive windows of a file, channel and class that are at most min_gap seconds apart (overlapping
+    windows are at a negative gap) are merged into one event, from the begin of the first to the end of the last, with
+    the highest probability. With min_gap None every positive window is a selection, as in inference_csv_to_raven.
+    Input:
+        results_df: the windows, with filename, channel, begin_time and end_time columns and a probability column per
+                    class, the windows of a file and channel in order of begin time. When only some of the windows are
+                    given, their index in the file and channel is in a window column (windows of consecutive indexes
+                    are consecutive), otherwise the rows are all the windows
+        label_names: the names of the classes, the probability columns
+        threshold: the probability above which a window is positive
+        low_threshold: the probability above which a window continues an event, defaults to threshold
+        min_gap: the gap in seconds up to which two events are merged, None keeps a selection per window
+        max_freq: the high frequency of the selections
+    Output:
+        the selections with a filename column, sorted by file and begin time and numbered per file
+    """
+    low_threshold = threshold if low_threshold is None else low_threshold
+    assert low_threshold <= threshold, f'low_threshold ({low_threshold}) should not be above threshold ({threshold})'
+    class_names = np.array(label_names[1:])
+    file_ids, files = pd.factorize(results_df['filename'])
+    channels = results_df['channel'].values.astype(np.int64)
+    if 'window' in results_df.columns:
+        windows = results_df['window'].values.astype(np.int64)
+    else:
+        windows = results_df.groupby(['filename', 'channel'], sort=False).cumcount().values
+    begin_times = results_df['begin_time'].values.astype(np.float64)
+    end_times = results_df['end_time'].values.astype(np.float64)
+    probabilities = results_df[list(class_names)].values.astype(np.float64)
+
+    def group_starts(rows, classes):
+        """True where a (class, file, channel) group starts, in a sequence of windows sorted by group"""
+        starts = np.ones(len(rows), dtype=bool)
+        starts[1:] = (classes[1:] != classes[:-1]) | (file_ids[rows[1:]] != file_ids[rows[:-1]]) | \
+                     (channels[rows[1:]] != channels[rows[:-1]])
+        return starts
+
+    # the (window, class) pairs above low_threshold, grouped by class, file and channel, in window order
+    row_order = np.lexsort((windows, channels, file_ids))
+    classes, positions = np.nonzero((probabilities[row_order] > low_threshold).T)
+    rows = row_order[positions]
+    probability = probabilities[rows, classes]
+    # a run is a stretch of consecutive windows above low_threshold, it is positive when one of them is above threshold
+    new_run = group_starts(rows, classes)
+    new_run[1:] |= windows[rows[1:]] != windows[rows[:-1]] + 1
+    run_ids = np.cumsum(new_run) - 1
+    positive = (np.bincount(run_ids, weights=probability > threshold) > 0)[run_ids]
+    rows, classes, probability = rows[positive], classes[positive], probability[positive]
+
+    if min_gap is None:
+        starts = np.arange(len(rows))
+    else:
+        new_event = group_starts(rows, classes)
+        new_event[1:] |= begin_times[rows[1:]] - end_times[rows[:-1]] > min_gap
+        starts = np.flatnonzero(new_event)
+    if len(starts) > 0:
+        event_end_times = np.maximum.reduceat(end_times[rows], starts)
+        event_probabilities = np.maximum.reduceat(probability, starts)
+    else:
+        event_end_times, event_probabilities = np.zeros(0), np.zeros(0)
+    rows, classes = rows[starts], classes[starts]
+
+    # sorted by file, begin time, channel and class
+    order = np.lexsort((classes, channels[rows], begin_times[rows], file_ids[rows]))
+    rows, classes = rows[order], classes[order]
+    event_end_times, event_probabilities = event_end_times[order], event_probabilities[order]
+    event_files = file_ids[rows]
+    # we have the redundancy here since ravenlite doesn't support extra columns,
+    # so we squeeze together the class and probability into annotation
+    probabilities_out = np.char.mod('%.3f', event_probabilities).astype(object)
+    class_names_out = class_names[classes].astype(object)
+    return pd.DataFrame({'filename': np.asarray(files, dtype=object)[event_files],
+                         'Selection': np.arange(len(rows)) - np.searchsorted(event_files, event_files) + 1,
+                         'View': 'Spectrogram 1',
+                         'Channel': channels[rows],
+                         'Begin Time (s)': begin_times[rows],
+                         'End Time (s)': np.round(event_end_times, decimals=3),
+                         'Low Freq (Hz)': np.zeros(len(rows)),
+                         'High Freq (Hz)': np.full(len(rows), float(max_freq)),
+                         'Annotation': class_names_out + ', ' + probabilities_out,
+                         'Class Name': class_names_out,
+                         'Probability': probabilities_out},
+                        columns=['filename'] + RAVEN_COLUMNS)
+
+
 def analysis_main() -> None:
     """
     The main function for running an analysis on a model inference results for required Dataset.
@@ -0,0 +1,301 @@
+import collections
+import queue
+import socket
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO
+
+import hydra
+import numpy as np
+import soundfile as sf
+import torch
+import torchaudio
+
+from soundbay.data import BaseDataset, BatchPreprocessor
+from soundbay.inference import default_label_names, load_model
+from soundbay.results_analysis import RAVEN_COLUMNS
+from soundbay.utils.audio_io import to_float32
+from soundbay.utils.checkpoint_utils import merge_with_checkpoint
+
+
+PCM_DTYPES = {'int16': np.dtype('<i2'), 'int32': np.dtype('<i4'), 'float32': np.dtype('<f4')}
+STREAM_SOURCES = ('stdin', 'socket', 'file')
+
+
+def pcm_source(stream, channels: int, dtype: str = 'int16', chunk_frames: int = 4096) -> Iterator[np.ndarray]:
+    """
+    reads interleaved raw PCM from a binary stream (e.g. sys.stdin.buffer) until it ends
+    Input:
+        stream: a binary file object
+        channels: the number of interleaved channels
+        dtype: the sample format, one of PCM_DTYPES (little endian)
+        chunk_frames: the number of frames read at once
+    Output (per chunk):
+        audio: [frames, channels] float32 numpy array in [-1, 1)
+    """
+    assert dtype in PCM_DTYPES, f'dtype should be one of {tuple(PCM_DTYPES)}, got {dtype}'
+    frame_size = PCM_DTYPES[dtype].itemsize * channels
+    leftover = b''
+    while True:
+        # read1 returns what is available instead of waiting for a whole chunk, so a slow feed is not held back
+        read = getattr(stream, 'read1', stream.read)
+        data = read(chunk_frames * frame_size)
+        if not data:
+            return
+        data = leftover + data
+        n_bytes = len(data) - len(data) % frame_size
+        leftover = data[n_bytes:]
+        if n_bytes:
+            yield to_float32(np.frombuffer(data[:n_bytes], dtype=PCM_DTYPES[dtype]).reshape(-1, channels))
+
+
+def socket_source(host: str, port: int, channels: int, dtype: str = 'int16',
+                  chunk_frames: int = 4096) -> Iterator[np.ndarray]:
+    """connects to a local socket that sends raw PCM, and reads it as pcm_source does until the sender closes it"""
+    with socket.create_connection((host, port)) as connection, connection.makefile('rb') as stream:
+        yield from pcm_source(stream, channels, dtype, chunk_frames)
+
+
+def file_replay_source(file_path, chunk_frames: int = 4096, speed: float = 1.) -> Iterator[np.ndarray]:
+    """
+    replays an audio file in chunks, as a live feed would deliver it, speed times faster than real time
+    Input:
+        file_path: path of the audio file
+        chunk_frames: the number of frames in a chunk
+        speed: the replay speed relative to real time, 0 replays without waiting
+    Output (per chunk):
+        audio: [frames, channels] float32 numpy array
+    """
+    with sf.SoundFile(str(file_path)) as f:
+        start = time.monotonic()
+        position = 0
+        for audio in f.blocks(blocksize=chunk_frames, dtype='float32', always_2d=True):
+            position += len(audio)
+            if speed > 0:
+                time.sleep(max(start + position / f.samplerate / speed - time.monotonic(), 0))
+            yield audio
+
+
+class RingBuffer:
+    """
+    Keeps the last capacity frames of a multichannel stream. Frames are addressed by their index in the whole stream,
+    and only the ones that were not overwritten yet can be read.
+    """
+
+    def __init__(self, channels: int, capacity: int):
+        self._buffer = np.zeros((channels, capacity), dtype=np.float32)
+        self.channels = channels
+        self.capacity = capacity
+        self.end = 0  # the number of frames written so far
+
+    def write(self, audio: np.ndarray):
+        """appends a [frames, channels] array, at most capacity frames at once"""
+        assert len(audio) <= self.capacity, f'trying to write {len(audio)} frames to a buffer of {self.capacity}'
+        first = self.end % self.capacity
+        head = min(len(audio), self.capacity - first)
+        self._buffer[:, first:first + head] = audio[:head].T
+        self._buffer[:, :len(audio) - head] = audio[head:].T
+        self.end += len(audio)
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        """the frames [start, stop) of the stream, as a [channels, stop - start] array"""
+        assert self.end - self.capacity <= start <= stop <= self.end, \
+            f'frames {start} to {stop} are not in the buffer, which holds {self.end - self.capacity} to {self.end}'
+        indices = np.arange(start, stop) % self.capacity
+        return self._buffer[:, indices]
+
+
+class StreamingDetector:
+    """
+    Runs a model on a live audio stream. The chunks of the stream go into a ring buffer, the windows of seq_length
+    seconds (every seq_length * (1 - overlap) seconds, as in InferenceDataset) are cut from it as soon as their last
+    sample arrives, and they are resampled, preprocessed and predicted in micro-batches on all the channels. A
+    micro-batch runs once it holds batch_size windows, or max_latency seconds after its oldest window arrived, and the
+    windows whose call probability is above the threshold are written right away as Raven selections, a selection per
+    window (as with experiment.raven.min_gap=null), since merging them into events would hold them until the event ends.
+    The latency of a window is the time from the arrival of its last sample to the writing of its selections; the
+    percentiles of the latencies are printed at the end and returned by run.
+    Input:
+        model: the trained model, on device
+        preprocessor: the preprocessor of the windows, as returned by BaseDataset.set_preprocessor
+        seq_length: the duration of a window in seconds
+        data_sample_rate: the sample rate of the stream
+        sample_rate: the sample rate of the model, the windows are resampled to it
+        overlap: the overlap of consecutive windows, between 0 and 1
+        batch_size: the number of model inputs (windows times channels) that fill a micro-batch
+        max_latency: the maximal time in seconds a window waits for others to share its micro-batch
+        threshold, label_names, raven_max_freq: as in infer_without_metadata
+        device: cpu/gpu
+    """
+
+    def __init__(self, model: torch.nn.Module, preprocessor, seq_length: float, data_sample_rate: int,
+                 sample_rate: int, overlap: float = 0, batch_size: int = 16, max_latency: float = 0.1,
+                 threshold: float = 0.5, label_names: Optional[List[str]] = None,
+                 raven_max_freq: Optional[float] = None, device: torch.device = torch.device('cpu')):
+        assert 0 <= overlap < 1, f'overlap should be between 0 and 1, got {overlap}'
+        assert batch_size >= 1, f'batch_size should be a positive integer, got {batch_size}'
+        self.model = model.eval()
+        self.batch_preprocessor = BatchPreprocessor(preprocessor).to(device)
+        self.sampler = torchaudio.transforms.Resample(orig_freq=data_sample_rate, new_freq=sample_rate).to(device)
+        self.seq_length = seq_length
+        self.data_sample_rate = data_sample_rate
+        self.step = seq_length * (1 - overlap)
+        self.window_frames = int(seq_length * data_sample_rate)
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.threshold = threshold
+        self.label_names = label_names
+        self.raven_max_freq = sample_rate // 2 if raven_max_freq is None else raven_max_freq
+        self.device = device
+        self.latencies = collections.deque(maxlen=100_000)
+        self._n_selections = 0
+
+    def _begin_frame(self, window: int) -> int:
+        return int(window * self.step * self.data_sample_rate)
+
+    def _read_source(self, source: Iterable[np.ndarray], chunks: queue.Queue):
+        try:
+            for audio in source:
+                chunks.put((audio, time.monotonic()))
+            chunks.put((None, None))
+        except Exception as e:
+            chunks.put((e, None))
+
+    def run(self, source: Iterable[np.ndarray], output: TextIO) -> Dict[str, float]:
+        """
+        predicts the windows of the stream until the source ends, and writes the Raven selections to output
+        Input:
+            source: an iterable of [frames, channels] float32 chunks, e.g. pcm_source or file_replay_source
+            output: a text stream, the Raven header is written first and then a line per selection
+        Output:
+            latency_percentiles: the 50th, 90th and 99th percentiles and the maximum of the windows latency, in
+            seconds
+        """
+        output.write('\t'.join(RAVEN_COLUMNS) + '\n')
+        output.flush()
+        self.latencies.clear()
+        self._n_selections = 0
+        # the source is read on its own thread, so a micro-batch is due on time even if the source blocks
+        chunks = queue.Queue(maxsize=64)
+        threading.Thread(target=self._read_source, args=(source, chunks), daemon=True).start()
+        buffer = None
+        next_window = 0
+        pending = []  # (begin time, audio [channels, window frames], arrival time of the last sample)
+        while True:
+            timeout = None if not pending else pending[0][2] + self.max_latency - time.monotonic()
+            try:
+                audio, arrival = chunks.get(timeout=timeout) if timeout is None or timeout > 0 \
+                    else chunks.get_nowait()
+            except queue.Empty:
+                self._predict(pending, output)
+                pending = []
+                continue
+            if isinstance(audio, Exception):
+                raise audio
+            if audio is None:
+                break
+            if buffer is None:
+                buffer = RingBuffer(audio.shape[1], 2 * self.window_frames)
+            # at most window_frames are written between two reads, so the buffer always keeps the next window
+            for first in range(0, len(audio), self.window_frames):
+                buffer.write(audio[first:first + self.window_frames])
+                while self._begin_frame(next_window) + self.window_frames <= buffer.end:
+                    begin = self._begin_frame(next_window)
+                    pending.append((next_window * self.step, buffer.read(begin, begin + self.window_frames),
+                                    arrival))
+                    next_window += 1
+                    if len(pending) * buffer.channels >= self.batch_size:
+                        self._predict(pending, output)
+                        pending = []
+        # the last window ends at the end of the stream, as in InferenceDataset
+        if buffer is not None and buffer.end >= self.window_frames and \
+                (next_window == 0 or self._begin_frame(next_window - 1) + self.window_frames < buffer.end):
+            begin_time = buffer.end / self.data_sample_rate - self.seq_length
+            begin = int(begin_time * self.data_sample_rate)
+            pending.append((begin_time, buffer.read(begin, begin + self.window_frames), time.monotonic()))
+        self._predict(pending, output)
+        return self.report()
+
+    def _predict(self, pending, output: TextIO):
+        if not pending:
+            return
+        channels = pending[0][1].shape[0]
+        audio = torch.from_numpy(np.concatenate([window for _, window, _ in pending])).unsqueeze(1)
+        with torch.no_grad():
+            audio = self.batch_preprocessor(self.sampler(audio.to(self.device)))
+            predictions = torch.softmax(self.model(audio), dim=1).cpu().numpy()
+        label_names = default_label_names(predictions.shape[1]) if self.label_names is None else self.label_names
+        lines = []
+        for i, (begin_time, _, _) in enumerate(pending):
+            for channel in range(channels):
+                for class_idx in range(1, len(label_names)):
+                    probability = predictions[i * channels + channel, class_idx]
+                    if probability <= self.threshold:
+                        continue
+                    self._n_selections += 1
+                    lines.append(f'{self._n_selections}\tSpectrogram 1\t{channel}\t{begin_time}\t'
+                                 f'{round(begin_time + self.seq_length, 3)}\t0.0\t{float(self.raven_max_freq)}\t'
+                                 f'{label_names[class_idx]}, {probability:.3f}\t{label_names[class_idx]}\t'
+                                 f'{probability:.3f}\n')
+        output.write(''.join(lines))
+        output.flush()
+        done = time.monotonic()
+        self.latencies.extend(done - arrival for _, _, arrival in pending)
+
+    def report(self) -> Dict[str, float]:
+        """the percentiles of the latencies of the windows predicted so far, also printed"""
+        if not self.latencies:
+            return {}
+        latencies = np.array(self.latencies)
+        percentiles = {'p50': np.percentile(latencies, 50), 'p90': np.percentile(latencies, 90),
+                       'p99': np.percentile(latencies, 99), 'max': latencies.max()}
+        print(f"Streaming latency over {len(latencies)} windows - " +
+              ', '.join(f'{name}: {value * 1000:.1f}ms' for name, value in percentiles.items()), file=sys.stderr)
+        return percentiles
+
+
+@hydra.main(config_name="/runs/inference_single_audio.yaml", config_path="conf", version_base='1.2')
+def stream_main(args) -> None:
+    """
+    Runs a trained model on a live stream (experiment.stream), with the InferenceDataset arguments of inference_main
+    (data.test_dataset). The Raven selections are written to experiment.stream.output, or to stdout.
+    Input:
+        args: from conf file (for instance: inference_single_audio.yaml)
+    """
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    ckpt_dict = torch.load(args.experiment.checkpoint.path, map_location=torch.device('cpu'))
+    args = merge_with_checkpoint(args, ckpt_dict['args'])
+    model = load_model(args.model.model, ckpt_dict['model']).to(device)
+    dataset_args = args.data.test_dataset
+    stream_args = args.experiment.get('stream', {})
+    source_type = stream_args.get('source', 'stdin')
+    if source_type not in STREAM_SOURCES:
+        raise ValueError(f'experiment.stream.source should be one of {STREAM_SOURCES}, got {source_type}')
+    pcm_args = dict(channels=stream_args.get('channels', 1), dtype=stream_args.get('dtype', 'int16'),
+                    chunk_frames=stream_args.get('chunk_frames', 4096))
+    if source_type == 'stdin':
+        source = pcm_source(sys.stdin.buffer, **pcm_args)
+    elif source_type == 'socket':
+        source = socket_source(stream_args.get('host', '127.0.0.1'), stream_args.get('port', 9000), **pcm_args)
+    else:
+        source = file_replay_source(dataset_args.file_path, pcm_args['chunk_frames'],
+                                    speed=stream_args.get('replay_speed', 1.))
+    detector = StreamingDetector(model, BaseDataset.set_preprocessor(dataset_args.preprocessors),
+                                 seq_length=dataset_args.seq_length, data_sample_rate=dataset_args.data_sample_rate,
+                                 sample_rate=dataset_args.sample_rate, overlap=dataset_args.get('overlap', 0),
+                                 batch_size=stream_args.get('batch_size', 16),
+                                 max_latency=stream_args.get('max_latency', 0.1), threshold=args.experiment.threshold,
+                                 label_names=args.data.label_names, raven_max_freq=args.experiment.raven_max_freq,
+                                 device=device)
+    output_file = stream_args.get('output')
+    if output_file is None:
+        detector.run(source, sys.stdout)
+    else:
+        with open(Path(output_file), 'w') as output:
+            detector.run(source, output)
+
+
+if __name__ == "__main__":
+    stream_main()
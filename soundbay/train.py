@@ -77,7 +77,17 @@ def modeling(
     seq_length=train_dataset_args['seq_length'], data_sample_rate=train_dataset_args['data_sample_rate'],
     sample_rate=train_dataset_args['sample_rate'], margin_ratio=train_dataset_args['margin_ratio'],
     slice_flag=train_dataset_args['slice_flag'], mode=train_dataset_args['mode'],
-    path_hierarchy=train_dataset_args['path_hierarchy']
+    path_hierarchy=train_dataset_args['path_hierarchy'],
+    file_pool_size=train_dataset_args.get('file_pool_size', 16),
+    read_dtype=train_dataset_args.get('read_dtype', 'float32'),
+    audio_backend=train_dataset_args.get('audio_backend', 'soundfile'),
+    sample_store=train_dataset_args.get('sample_store'),
+    feature_cache=train_dataset_args.get('feature_cache'),
+    feature_cache_max_gb=train_dataset_args.get('feature_cache_max_gb', 10),
+    metadata_cache=train_dataset_args.get('metadata_cache'),
+    batch_preprocessing=train_dataset_args.get('batch_preprocessing', False),
+    persist_index=train_dataset_args.get('persist_index', True),
+    index_dir=train_dataset_args.get('index_dir')
     )
 
     # train data which is handled as validation data
@@ -88,7 +98,17 @@ def modeling(
     seq_length=val_dataset_args['seq_length'], data_sample_rate=train_dataset_args['data_sample_rate'],
     sample_rate=train_dataset_args['sample_rate'], margin_ratio=val_dataset_args['margin_ratio'],
     slice_flag=val_dataset_args['slice_flag'], mode=val_dataset_args['mode'],
-    path_hierarchy=val_dataset_args['path_hierarchy']
+    path_hierarchy=val_dataset_args['path_hierarchy'],
+    file_pool_size=val_dataset_args.get('file_pool_size', 16),
+    read_dtype=val_dataset_args.get('read_dtype', 'float32'),
+    audio_backend=val_dataset_args.get('audio_backend', 'soundfile'),
+    sample_store=train_dataset_args.get('sample_store'),
+    feature_cache=train_dataset_args.get('feature_cache'),
+    feature_cache_max_gb=train_dataset_args.get('feature_cache_max_gb', 10),
+    metadata_cache=train_dataset_args.get('metadata_cache'),
+    batch_preprocessing=train_dataset_args.get('batch_preprocessing', False),
+    persist_index=train_dataset_args.get('persist_index', True),
+    index_dir=train_dataset_args.get('index_dir')
     )
 
     val_dataset = datasets_dict[val_dataset_args['_target_']](data_path = val_dataset_args['data_path'],
@@ -98,7 +118,17 @@ def modeling(
     seq_length=val_dataset_args['seq_length'], data_sample_rate=val_dataset_args['data_sample_rate'],
     sample_rate=val_dataset_args['sample_rate'], margin_ratio=val_dataset_args['margin_ratio'],
     slice_flag=val_dataset_args['slice_flag'], mode=val_dataset_args['mode'],
-    path_hierarchy=train_dataset_args['path_hierarchy']
+    path_hierarchy=train_dataset_args['path_hierarchy'],
+    file_pool_size=val_dataset_args.get('file_pool_size', 16),
+    read_dtype=val_dataset_args.get('read_dtype', 'float32'),
+    audio_backend=val_dataset_args.get('audio_backend', 'soundfile'),
+    sample_store=val_dataset_args.get('sample_store'),
+    feature_cache=val_dataset_args.get('feature_cache'),
+    feature_cache_max_gb=val_dataset_args.get('feature_cache_max_gb', 10),
+    metadata_cache=val_dataset_args.get('metadata_cache'),
+    batch_preprocessing=val_dataset_args.get('batch_preprocessing', False),
+    persist_index=val_dataset_args.get('persist_index', True),
+    index_dir=val_dataset_args.get('index_dir')
     )
 
     # Define model and device for training
@@ -106,6 +106,7 @@ class Trainer:
             self.model.zero_grad()
             audio, label, raw_wav, meta = batch
             audio, label = audio.to(self.device), label.to(self.device)
+            audio = self._batch_preprocess(audio, self.train_dataloader)
 
             if (it == 0) and (not self.debug) and ((epoch % 5) == 0):
                 self.logger.upload_artifacts(audio, label, raw_wav, meta, sample_rate=self.train_dataloader.dataset.sample_rate,
@@ -146,6 +147,7 @@ class Trainer:
                     break
                 audio, label, raw_wav, meta = batch
                 audio, label = audio.to(self.device), label.to(self.device)
+                audio = self._batch_preprocess(audio, dataloader)
                 if (it == 0) and (not self.debug) and ((epoch % 5) == 0):
                     self.logger.upload_artifacts(audio, label, raw_wav, meta, sample_rate=self.train_dataloader.dataset.sample_rate,
                                                  flag=datatset_name, data_sample_rate=self.train_dataloader.dataset.data_sample_rate)
@@ -164,6 +166,13 @@ class Trainer:
             self.logger.log(epoch, datatset_name)
 
 
+    def _batch_preprocess(self, audio: torch.Tensor, dataloader) -> torch.Tensor:
+        """applies the preprocessors to the batch, for datasets that leave preprocessing to the batch level"""
+        batch_preprocessor = getattr(getattr(dataloader, 'dataset', None), 'batch_preprocessor', None)
+        if batch_preprocessor is None:
+            return audio
+        return batch_preprocessor.to(self.device)(audio)
+
     def _save_checkpoint(self, checkpoint_path: Union[str, None]):
         """Save checkpoint.
         Args:
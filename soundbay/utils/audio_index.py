@@ -0,0 +1,248 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Union
+
+import pandas as pd
+import soundfile as sf
+
+
+AUDIO_INDEX_FILENAME = '.soundbay_audio_index.csv'
+DIRECTORY_INDEX_FILENAME = '.soundbay_directory_index.json'
+INDEX_FILE_PREFIX = '.soundbay_'
+
+
+def index_file_path(root: Path, filename: str, index_dir: Optional[Union[str, Path]] = None) -> Path:
+    """
+    Path of the index file of a data directory: inside the directory itself, or inside index_dir under a name made
+    from the directory's absolute path, so the indexes of several data directories can share one index_dir
+    """
+    if index_dir is None:
+        return root / filename
+    digest = hashlib.sha1(root.resolve().as_posix().encode()).hexdigest()[:16]
+    return Path(index_dir) / f'{filename}.{digest}'
+
+
+class AudioInfo(NamedTuple):
+    """
+    The header fields of an audio file that the data pipeline needs, plus the file's mtime and size which are used
+    to invalidate the entry once the file changes on disk.
+    """
+    frames: int
+    samplerate: int
+    channels: int
+    subtype: str
+    mtime_ns: int
+    size: int
+
+    @property
+    def duration(self) -> float:
+        return self.frames / self.samplerate
+
+
+class AudioIndex:
+    """
+    Index of audio headers for the files under a data directory, used instead of calling sf.info in the data path.
+    The index is built once per data directory, persisted (AUDIO_INDEX_FILENAME, next to the data unless index_dir
+    is given) and shared by every dataset reading from that directory. On later runs, only new or modified files (by
+    mtime and size) are opened again.
+    Input:
+        root: the data directory
+        audio_paths: paths of the audio files to index (and validate against the disk)
+        persist: whether to load and save the index file, otherwise the index is kept in memory
+        index_dir: directory of the index file, None saves it inside root
+    """
+
+    def __init__(self, root: Union[str, Path], audio_paths: Iterable[Path] = (), persist: bool = True,
+                 index_dir: Optional[Union[str, Path]] = None):
+        self.root = Path(root)
+        self.index_path = index_file_path(self.root, AUDIO_INDEX_FILENAME, index_dir)
+        self.persist = persist
+        self._cached = self._load() if persist else {}
+        self._entries: Dict[str, AudioInfo] = {}
+        self._dirty = False
+        for path in audio_paths:
+            self._add(path)
+        if self._dirty:
+            self.save()
+
+    def __getitem__(self, path: Union[str, Path]) -> AudioInfo:
+        entry = self._entries.get(str(path))
+        if entry is None:
+            entry = self._add(path)
+        return entry
+
+    def __contains__(self, path: Union[str, Path]) -> bool:
+        return str(path) in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _key(self, path: Path) -> str:
+        """key of the file in the persisted index - relative to root when possible so the index survives remounts"""
+        try:
+            return Path(path).relative_to(self.root).as_posix()
+        except ValueError:
+            return Path(path).resolve().as_posix()
+
+    def _add(self, path: Union[str, Path]) -> AudioInfo:
+        key = self._key(Path(path))
+        stat = os.stat(path)
+        entry = self._cached.get(key)
+        if entry is None or entry.mtime_ns != stat.st_mtime_ns or entry.size != stat.st_size:
+            info = sf.info(str(path))
+            entry = AudioInfo(frames=info.frames, samplerate=info.samplerate, channels=info.channels,
+                              subtype=info.subtype, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+            self._cached[key] = entry
+            self._dirty = True
+        self._entries[str(path)] = entry
+        return entry
+
+    def _load(self) -> Dict[str, AudioInfo]:
+        if not self.index_path.is_file():
+            return {}
+        try:
+            df = pd.read_csv(self.index_path, dtype={'path': str, 'subtype': str})
+        except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError):
+            print(f'Notice: audio index {self.index_path} is corrupted, rebuilding it')
+            return {}
+        if list(df.columns) != ['path'] + list(AudioInfo._fields):
+            return {}
+        return {row[0]: AudioInfo(*row[1:]) for row in df.itertuples(index=False, name=None)}
+
+    def save(self):
+        """
+        Writes the index file. The file is replaced atomically, so concurrent runs on the same data directory never
+        read a partially written index. Read-only directories are skipped with a notice.
+        """
+        if not self.persist:
+            return
+        df = pd.DataFrame([(key,) + tuple(entry) for key, entry in self._cached.items()],
+                          columns=['path'] + list(AudioInfo._fields))
+        tmp_path = self.index_path.with_name(f'{self.index_path.name}.{os.getpid()}.tmp')
+        try:
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            df.to_csv(tmp_path, index=False)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print(f'Notice: could not save audio index to {self.index_path} ({e})')
+            return
+        self._dirty = False
+
+
+class DirectoryIndex:
+    """
+    Listing of the files under a data directory, used instead of walking the whole tree (rglob) on every dataset
+    construction. Every directory keeps its mtime, files and subdirectories, the index is persisted
+    (DIRECTORY_INDEX_FILENAME, next to the data unless index_dir is given) and on later runs only the directories
+    whose mtime changed are listed again, the others cost a single stat. The subdirectories of the root are walked
+    in parallel threads, which pays off on network file systems.
+    Input:
+        root: the data directory
+        persist: whether to load and save the index file, otherwise the index is kept in memory
+        num_workers: number of threads walking the subdirectories of the root
+        index_dir: directory of the index file, None saves it inside root
+    """
+
+    def __init__(self, root: Union[str, Path], persist: bool = True, num_workers: int = 8,
+                 index_dir: Optional[Union[str, Path]] = None):
+        self.root = Path(root)
+        self.index_path = index_file_path(self.root, DIRECTORY_INDEX_FILENAME, index_dir)
+        self.persist = persist
+        self._cached = self._load() if persist else {}
+        self._dirty = False
+        if not self.root.is_dir():  # as rglob, a missing directory has no files
+            self._dirs = {'': {'mtime_ns': 0, 'files': [], 'dirs': []}}
+            return
+        self._dirs = self._walk_root(num_workers)
+        if self._dirty or self._dirs.keys() != self._cached.keys():
+            self.save()
+
+    def _list(self, rel: str) -> dict:
+        """returns the (possibly cached) entry of a directory, relative to root"""
+        path = self.root / rel if rel else self.root
+        mtime_ns = os.stat(path).st_mtime_ns
+        entry = self._cached.get(rel)
+        if entry is not None and entry['mtime_ns'] == mtime_ns:
+            return entry
+        files, dirs = [], []
+        with os.scandir(path) as it:
+            for dir_entry in it:
+                # as rglob, symlinked directories are not followed (a symlink cycle would never end)
+                if dir_entry.is_dir(follow_symlinks=False):
+                    dirs.append(dir_entry.name)
+                elif not dir_entry.is_dir():
+                    files.append(dir_entry.name)
+        new_entry = {'mtime_ns': mtime_ns, 'files': sorted(files), 'dirs': sorted(dirs)}
+        # the index files themselves change the root mtime, a relisting with the same content is not saved
+        if entry is None or entry['files'] != new_entry['files'] or entry['dirs'] != new_entry['dirs']:
+            self._dirty = True
+        return new_entry
+
+    def _walk(self, rel: str) -> Dict[str, dict]:
+        dirs = {}
+        stack = [rel]
+        while stack:
+            rel = stack.pop()
+            try:
+                entry = self._list(rel)
+            except FileNotFoundError:  # removed while walking
+                continue
+            dirs[rel] = entry
+            stack.extend(f'{rel}/{name}' if rel else name for name in entry['dirs'])
+        return dirs
+
+    def _walk_root(self, num_workers: int) -> Dict[str, dict]:
+        root_entry = self._list('')
+        dirs = {'': root_entry}
+        if num_workers > 1 and len(root_entry['dirs']) > 1:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                for sub_dirs in executor.map(self._walk, root_entry['dirs']):
+                    dirs.update(sub_dirs)
+        else:
+            for name in root_entry['dirs']:
+                dirs.update(self._walk(name))
+        return dirs
+
+    def paths(self, suffix: Optional[str] = '.wav', recursive: bool = True) -> List[Path]:
+        """
+        Paths of the indexed files
+        Input:
+            suffix: only the files whose name ends with suffix (case sensitive, as rglob), None for all the files
+            recursive: False lists the files directly under root only
+        """
+        paths = []
+        for rel, entry in sorted(self._dirs.items()) if recursive else [('', self._dirs[''])]:
+            directory = self.root / rel if rel else self.root
+            paths.extend(directory / name for name in entry['files']
+                         if (suffix is None or name.endswith(suffix)) and not name.startswith(INDEX_FILE_PREFIX))
+        return paths
+
+    def _load(self) -> Dict[str, dict]:
+        if not self.index_path.is_file():
+            return {}
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)['dirs']
+        except (ValueError, KeyError, UnicodeDecodeError):
+            print(f'Notice: directory index {self.index_path} is corrupted, rebuilding it')
+            return {}
+
+    def save(self):
+        """
+        Writes the index file, atomically. Read-only directories are skipped with a notice.
+        """
+        if not self.persist:
+            return
+        tmp_path = self.index_path.with_name(f'{self.index_path.name}.{os.getpid()}.tmp')
+        try:
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump({'dirs': self._dirs}, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print(f'Notice: could not save directory index to {self.index_path} ({e})')
+            return
+        self._dirty = False
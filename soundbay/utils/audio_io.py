@@ -0,0 +1,232 @@
+import os
+import struct
+from collections import OrderedDict
+from pathlib import Path
+from typing import NamedTuple, Optional, Union
+
+import numpy as np
+import soundfile as sf
+
+
+READ_DTYPES = ('float32', 'int16')
+AUDIO_BACKENDS = ('soundfile', 'memmap')
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+_PCM_DTYPES = {(WAVE_FORMAT_PCM, 8): np.dtype('u1'),
+               (WAVE_FORMAT_PCM, 16): np.dtype('<i2'),
+               (WAVE_FORMAT_PCM, 32): np.dtype('<i4'),
+               (WAVE_FORMAT_IEEE_FLOAT, 32): np.dtype('<f4'),
+               (WAVE_FORMAT_IEEE_FLOAT, 64): np.dtype('<f8')}
+
+
+def to_float32(data: np.ndarray) -> np.ndarray:
+    """converts PCM samples to float32 in [-1, 1), float32 input is returned as is (no copy)"""
+    if data.dtype == np.float32:
+        return data
+    if data.dtype == np.uint8:
+        return (data.astype(np.float32) - 128) / 128
+    if np.issubdtype(data.dtype, np.integer):
+        return data.astype(np.float32) / np.float32(2 ** (8 * data.dtype.itemsize - 1))
+    return data.astype(np.float32)
+
+
+def _select_channel(data: np.ndarray, channel: Optional[int]) -> np.ndarray:
+    return data if channel is None else data[:, channel]
+
+
+class SoundFilePool:
+    """
+    LRU pool of open sf.SoundFile handles, used to read segments by seeking in an already open file instead of
+    opening the file on every item. Each DataLoader worker ends up with its own pool: handles are dropped when the
+    pool is pickled (spawn) and closed the first time the pool is used in a new process (fork), so a file offset is
+    never shared between processes.
+    Input:
+        max_open_files: maximal number of handles kept open, 0 opens and closes the file on every read
+        dtype: the dtype the samples are read into - 'float32' or 'int16' (scaled to [-1, 1) float32 on read)
+    """
+
+    def __init__(self, max_open_files: int = 16, dtype: str = 'float32'):
+        assert max_open_files >= 0, f'max_open_files should be a non-negative integer, got {max_open_files}'
+        assert dtype in READ_DTYPES, f'dtype should be one of {READ_DTYPES}, got {dtype}'
+        self.max_open_files = max_open_files
+        self.dtype = dtype
+        self._handles = OrderedDict()
+        self._pid = os.getpid()
+
+    def __len__(self) -> int:
+        return len(self._handles)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_handles'] = OrderedDict()
+        return state
+
+    def _check_process(self):
+        if self._pid != os.getpid():
+            self.close()
+            self._pid = os.getpid()
+
+    def get(self, path: Union[str, Path]) -> sf.SoundFile:
+        """returns an open handle of path, opening it (and closing the least recently used one) if needed"""
+        self._check_process()
+        key = str(path)
+        handle = self._handles.get(key)
+        if handle is not None:
+            self._handles.move_to_end(key)
+            return handle
+        handle = sf.SoundFile(key)
+        if self.max_open_files > 0:
+            self._handles[key] = handle
+            while len(self._handles) > self.max_open_files:
+                _, evicted = self._handles.popitem(last=False)
+                evicted.close()
+        return handle
+
+    def read(self, path: Union[str, Path], start: int, stop: int, channel: Optional[int] = None) -> np.ndarray:
+        """
+        reads frames [start, stop) of path
+        Input:
+            channel: zero-based channel to return, None returns all the channels
+        Output:
+            data - float32 numpy array of shape (frames, channels), or (frames,) if channel is given
+        """
+        handle = self.get(path)
+        try:
+            handle.seek(start)
+            data = handle.read(stop - start, dtype=self.dtype, always_2d=True)
+        finally:
+            if self.max_open_files == 0:
+                handle.close()
+        return to_float32(_select_channel(data, channel))
+
+    def close(self):
+        for handle in self._handles.values():
+            handle.close()
+        self._handles.clear()
+
+
+class WavLayout(NamedTuple):
+    """where the sample data of an uncompressed WAV file lies, as parsed from its header"""
+    offset: int
+    frames: int
+    channels: int
+    samplerate: int
+    dtype: np.dtype
+
+
+def parse_wav_header(path: Union[str, Path]) -> WavLayout:
+    """
+    Parses the RIFF header of a WAV file, raises ValueError for files whose samples can't be mapped as a flat numpy
+    array (compressed, 24-bit, RF64 etc.)
+    """
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError(f'{path} is not a RIFF WAV file')
+        fmt = None
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                raise ValueError(f'{path} has no data chunk')
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+            if chunk_id == b'fmt ':
+                chunk = f.read(chunk_size)
+                audio_format, channels, samplerate, _, block_align, bits = struct.unpack('<HHIIHH', chunk[:16])
+                if audio_format == WAVE_FORMAT_EXTENSIBLE and chunk_size >= 26:
+                    audio_format = struct.unpack('<H', chunk[24:26])[0]
+                fmt = (audio_format, channels, samplerate, block_align, bits)
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError(f'{path} has a data chunk before its fmt chunk')
+                audio_format, channels, samplerate, block_align, bits = fmt
+                dtype = _PCM_DTYPES.get((audio_format, bits))
+                if dtype is None or block_align != channels * dtype.itemsize:
+                    raise ValueError(f'{path} has an unsupported sample format ({audio_format}, {bits} bits)')
+                offset = f.tell()
+                # truncated recordings declare more data than they hold
+                frames = min(chunk_size, file_size - offset) // block_align
+                return WavLayout(offset, frames, channels, samplerate, dtype)
+            else:
+                f.seek(chunk_size, os.SEEK_CUR)
+            if chunk_size % 2:
+                f.seek(1, os.SEEK_CUR)
+
+
+class WavMemmapReader:
+    """
+    Reads segments of uncompressed PCM WAV files as views of a memory map of the file, so no buffered reads are done
+    and the page cache is shared by all the DataLoader workers. float32 files are handed over without a copy, integer
+    PCM is converted after the channel is selected. Files that can't be mapped are read through a SoundFilePool.
+    The maps are copy-on-write, so the returned arrays are writable and never modify the file.
+    Input:
+        max_open_files: maximal number of files kept mapped (and of fallback handles kept open)
+    """
+
+    def __init__(self, max_open_files: int = 16):
+        assert max_open_files >= 0, f'max_open_files should be a non-negative integer, got {max_open_files}'
+        self.max_open_files = max_open_files
+        self.fallback = SoundFilePool(max_open_files)
+        self._maps = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._maps)
+
+    def __getstate__(self):
+        # a pickled memmap would carry a copy of the whole recording
+        state = self.__dict__.copy()
+        state['_maps'] = OrderedDict()
+        return state
+
+    def get(self, path: Union[str, Path]) -> Optional[np.memmap]:
+        """returns the (frames, channels) map of path, or None if it can't be mapped"""
+        key = str(path)
+        if key in self._maps:
+            self._maps.move_to_end(key)
+            return self._maps[key]
+        try:
+            layout = parse_wav_header(key)
+        except ValueError:
+            data = None
+        else:
+            data = np.memmap(key, dtype=layout.dtype, mode='c', offset=layout.offset,
+                             shape=(layout.frames, layout.channels))
+        if self.max_open_files > 0:
+            self._maps[key] = data
+            while len(self._maps) > self.max_open_files:
+                self._maps.popitem(last=False)
+        return data
+
+    def read(self, path: Union[str, Path], start: int, stop: int, channel: Optional[int] = None) -> np.ndarray:
+        """
+        reads frames [start, stop) of path
+        Input:
+            channel: zero-based channel to return, None returns all the channels
+        Output:
+            data - float32 numpy array of shape (frames, channels), or (frames,) if channel is given
+        """
+        data = self.get(path)
+        if data is None:
+            return self.fallback.read(path, start, stop, channel)
+        return to_float32(_select_channel(data[start:stop], channel))
+
+    def close(self):
+        self._maps.clear()
+        self.fallback.close()
+
+
+def create_audio_reader(backend: str = 'soundfile', max_open_files: int = 16, dtype: str = 'float32'):
+    """
+    creates the reader the datasets load audio segments with
+    Input:
+        backend: 'soundfile' (pooled sf.SoundFile handles) or 'memmap' (memory mapped PCM WAV)
+        max_open_files: number of files kept open per process
+        dtype: read dtype of the soundfile backend, the memmap backend always reads the file's own sample format
+    """
+    if backend == 'soundfile':
+        return SoundFilePool(max_open_files, dtype=dtype)
+    elif backend == 'memmap':
+        return WavMemmapReader(max_open_files)
+    raise ValueError(f'audio_backend should be one of {AUDIO_BACKENDS}, got {backend}')
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import numpy as np
+import torch
+from omegaconf import DictConfig, OmegaConf
+
+
+def config_hash(*configs) -> str:
+    """hash of (resolved) configs, used to tell apart features computed by different preprocessors"""
+    configs = [OmegaConf.to_container(c, resolve=True) if isinstance(c, DictConfig) else c for c in configs]
+    return hashlib.sha1(json.dumps(configs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class FeatureCache:
+    """
+    On-disk cache of the items of a deterministic dataset (no augmentations and deterministic preprocessors), so the
+    features are computed once and then loaded instead of reading, resampling and preprocessing the audio every epoch.
+    Entries are content addressed: the namespace is a hash of everything that determines the features (preprocessors
+    config, sample rates, sequence length) and the key a hash of the segment (file, its mtime and size, start sample,
+    channel), so a changed config or recording never hits stale entries. All the entries of a namespace have the same
+    shapes, and are stored as fixed size float16 records (the features followed by the raw waveform) appended to shard
+    files that are read as memory maps. Every process appends to its own shards, so DataLoader workers never share a
+    file, and each shard has a text index with the keys of its records, one per line. A shard is closed once it
+    reaches shard_mb, and when the cache outgrows max_gb the least recently used shards are removed whole.
+    Input:
+        root: the cache directory, may be shared by several datasets and runs
+        namespace: hash of the features config, see config_hash
+        max_gb: size limit of the cache directory
+        shard_mb: size of a shard
+    """
+
+    def __init__(self, root: Union[str, Path], namespace: str, max_gb: float = 10, shard_mb: float = 256):
+        self.root = Path(root)
+        self.path = self.root / namespace
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = int(max_gb * 2 ** 30)
+        self.shard_bytes = int(shard_mb * 2 ** 20)
+        self._shapes = self._load_shapes()
+        self._entries = {}  # key -> (shard, record)
+        self._index_read = {}  # shard -> (bytes of its index read, records read)
+        self._refreshed = 0.
+        self._maps = {}
+        self._touched = {}
+        self._writer = None
+        self._pid = os.getpid()
+        self._size = None  # measured lazily, then tracked per process
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_maps'], state['_writer'] = {}, None
+        return state
+
+    def _check_process(self):
+        # the open shard of the parent process is left to it, its buffers are always flushed
+        if self._pid != os.getpid():
+            self._writer, self._maps, self._pid = None, {}, os.getpid()
+
+    def _load_shapes(self) -> Optional[Tuple[tuple, tuple]]:
+        shapes_path = self.path / 'shapes.json'
+        if not shapes_path.is_file():
+            return None
+        with open(shapes_path) as f:
+            shapes = json.load(f)
+        return tuple(shapes['features']), tuple(shapes['raw'])
+
+    def _save_shapes(self, features_shape: tuple, raw_shape: tuple):
+        self._shapes = (tuple(features_shape), tuple(raw_shape))
+        tmp_path = self.path / f'shapes.json.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'features': list(features_shape), 'raw': list(raw_shape)}, f)
+        os.replace(tmp_path, self.path / 'shapes.json')
+
+    @property
+    def _record_size(self) -> int:
+        features_shape, raw_shape = self._shapes
+        return int(np.prod(features_shape)) + int(np.prod(raw_shape))
+
+    @staticmethod
+    def key(*fields) -> str:
+        return hashlib.sha1(repr(fields).encode()).hexdigest()
+
+    def _refresh(self):
+        """reads the records added to the shard indices (by all the processes) since the last refresh"""
+        self._refreshed = time.monotonic()
+        for index_path in self.path.glob('*.idx'):
+            shard = index_path.stem
+            offset, records = self._index_read.get(shard, (0, 0))
+            try:
+                with open(index_path, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read()
+            except FileNotFoundError:  # evicted by another process
+                continue
+            data = data[:data.rfind(b'\n') + 1]  # a record is indexed once its line is complete
+            for line in data.splitlines():
+                self._entries[line.decode()] = (shard, records)
+                records += 1
+            self._index_read[shard] = (offset + len(data), records)
+
+    def _record(self, shard: str, record: int) -> Optional[np.ndarray]:
+        size = self._record_size
+        data = self._maps.get(shard)
+        if data is None or len(data) < (record + 1) * size:
+            try:
+                data = np.memmap(self.path / f'{shard}.bin', dtype=np.float16, mode='r')
+            except (FileNotFoundError, ValueError):
+                return None
+            self._maps[shard] = data
+        if len(data) < (record + 1) * size:
+            return None
+        now = time.monotonic()
+        if now - self._touched.get(shard, 0) > 10:  # mtime is the LRU order
+            self._touched[shard] = now
+            try:
+                os.utime(self.path / f'{shard}.bin')
+            except FileNotFoundError:
+                pass
+        return data[record * size:(record + 1) * size]
+
+    def get(self, key: str) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+        """returns the (features, raw waveform) of the entry as float32 tensors, None on a miss"""
+        self._check_process()
+        if self._shapes is None:
+            self._shapes = self._load_shapes()
+            if self._shapes is None:
+                return None
+        if key not in self._entries and time.monotonic() - self._refreshed > 1:
+            self._refresh()
+        entry = self._entries.get(key)
+        data = None if entry is None else self._record(*entry)
+        if data is None:
+            return None
+        features_shape, raw_shape = self._shapes
+        n_features = int(np.prod(features_shape))
+        features = torch.from_numpy(data[:n_features].astype(np.float32)).reshape(features_shape)
+        raw = torch.from_numpy(data[n_features:].astype(np.float32)).reshape(raw_shape)
+        return features, raw
+
+    def put(self, key: str, features: torch.Tensor, raw: torch.Tensor):
+        self._check_process()
+        if self._shapes is None:
+            self._save_shapes(features.shape, raw.shape)
+        elif self._shapes != (tuple(features.shape), tuple(raw.shape)):
+            return
+        if self._writer is None:
+            shard = f'{os.getpid()}-{time.time_ns()}'
+            self._writer = [shard, open(self.path / f'{shard}.bin', 'ab'), open(self.path / f'{shard}.idx', 'ab'), 0]
+        shard, data_file, index_file, records = self._writer
+        data = np.concatenate([features.detach().cpu().numpy().ravel(), raw.detach().cpu().numpy().ravel()])
+        data = data.astype(np.float16).tobytes()
+        # the record is written before its key, so a reader never indexes a partial record
+        data_file.write(data)
+        data_file.flush()
+        index_file.write(f'{key}\n'.encode())
+        index_file.flush()
+        self._entries[key] = (shard, records)
+        self._writer[3] = records + 1
+        if self._size is None:
+            self._size = self._measure()[1]
+        else:
+            self._size += len(data) + len(key) + 1
+        if (records + 1) * len(data) >= self.shard_bytes:
+            data_file.close()
+            index_file.close()
+            self._writer = None
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def _measure(self):
+        shards = []
+        for data_path in self.root.glob('*/*.bin'):
+            index_path = data_path.with_suffix('.idx')
+            try:
+                stat = data_path.stat()
+                size = stat.st_size + (index_path.stat().st_size if index_path.exists() else 0)
+            except FileNotFoundError:  # evicted by another process
+                continue
+            shards.append((stat.st_mtime_ns, data_path.name, size, data_path))
+        return shards, sum(size for _, _, size, _ in shards)
+
+    def evict(self, ratio: float = 0.9):
+        """removes the least recently used shards (of all namespaces) until the cache is below ratio * max_gb"""
+        shards, size = self._measure()
+        open_shard = None if self._writer is None else self.path / f'{self._writer[0]}.bin'
+        for _, _, shard_size, data_path in sorted(shards):
+            if size <= ratio * self.max_bytes:
+                break
+            if data_path == open_shard:
+                continue
+            for path in [data_path, data_path.with_suffix('.idx')]:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+            size -= shard_size
+            if data_path.parent == self.path:
+                shard = data_path.stem
+                self._entries = {key: entry for key, entry in self._entries.items() if entry[0] != shard}
+                self._maps.pop(shard, None)
+                self._index_read.pop(shard, None)
+        self._size = size
@@ -0,0 +1,191 @@
+import copy
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+
+PREPROCESS_BACKENDS = ('process', 'thread')
+
+_worker_sampler = None
+_worker_preprocessor = None
+
+
+def _init_preprocess_worker(sampler, preprocessor):
+    global _worker_sampler, _worker_preprocessor
+    torch.set_num_threads(1)
+    _worker_sampler, _worker_preprocessor = sampler, preprocessor
+
+
+def _preprocess(sampler, preprocessor, audio: torch.Tensor) -> torch.Tensor:
+    """resamples a [B, 1, T] batch of segments and applies the preprocessor to every segment, as __getitem__ does"""
+    audio = sampler(audio)
+    if preprocessor is not None:
+        audio = torch.stack([preprocessor(sample) for sample in audio])
+    return audio
+
+
+def _preprocess_in_worker(audio: torch.Tensor) -> torch.Tensor:
+    return _preprocess(_worker_sampler, _worker_preprocessor, audio)
+
+
+class InferencePipeline:
+    """
+    Iterates over the batches of an InferenceDataset like a DataLoader, with the work split into stages connected by
+    bounded queues: io_threads threads read the audio segments of the batches, preprocess_workers processes (or
+    threads) resample and preprocess them, and the consumer - the model, on the main thread - takes the batches in
+    order. A full queue blocks the stage that feeds it, and at most queue_size batches are in flight (read, but not
+    yet taken by the consumer), so a slow batch holds back the reading of the next ones instead of piling them up.
+    When the iteration ends, the utilization of every stage (busy time / (wall time * workers)) is printed and kept in
+    self.utilization; the stage closest to 100% is the bottleneck.
+    Input:
+        dataset: an InferenceDataset
+        batch_size: the number of segments in a batch
+        io_threads: the number of reading threads
+        preprocess_workers: the number of preprocessing workers
+        preprocess_backend: 'process' (a spawned process pool) or 'thread'
+        queue_size: the number of batches in flight
+    """
+
+    def __init__(self, dataset, batch_size: int, io_threads: int = 2, preprocess_workers: int = 2,
+                 preprocess_backend: str = 'process', queue_size: int = 8):
+        assert io_threads >= 1, f'io_threads should be a positive integer, got {io_threads}'
+        assert preprocess_workers >= 1, f'preprocess_workers should be a positive integer, got {preprocess_workers}'
+        assert queue_size >= 1, f'queue_size should be a positive integer, got {queue_size}'
+        assert preprocess_backend in PREPROCESS_BACKENDS, \
+            f'preprocess_backend should be one of {PREPROCESS_BACKENDS}, got {preprocess_backend}'
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.io_threads = io_threads
+        self.preprocess_workers = preprocess_workers
+        self.preprocess_backend = preprocess_backend
+        self.queue_size = queue_size
+        # with batch preprocessing the preprocessor runs on the batches, next to the model (see predict_proba)
+        self._preprocessor = dataset.preprocessor if dataset.batch_preprocessor is None else None
+        self._busy = {}
+        self._lock = threading.Lock()
+        self.utilization = {}
+
+    def __len__(self) -> int:
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def _add_busy(self, stage: str, seconds: float):
+        with self._lock:
+            self._busy[stage] += seconds
+
+    @staticmethod
+    def _put(q: queue.Queue, item, stop: threading.Event):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    @staticmethod
+    def _get(q: queue.Queue, stop: threading.Event):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def _read_stage(self, batch_ids: queue.Queue, in_flight: threading.Semaphore, read_queue: queue.Queue,
+                    stop: threading.Event):
+        # every thread reads through its own handles, an open file is not shared between threads
+        dataset = copy.copy(self.dataset)
+        dataset.audio_reader = copy.deepcopy(self.dataset.audio_reader)
+        while not stop.is_set():
+            if not in_flight.acquire(timeout=0.1):
+                continue
+            try:
+                batch_id = batch_ids.get_nowait()
+            except queue.Empty:
+                in_flight.release()
+                return
+            start = time.perf_counter()
+            try:
+                first = batch_id * self.batch_size
+                indices = range(first, min(first + self.batch_size, len(self.dataset)))
+                audio = torch.stack([dataset.read_window(idx) for idx in indices])
+                item = (batch_id, audio, None)
+            except Exception as e:
+                item = (batch_id, None, e)
+            self._add_busy('read', time.perf_counter() - start)
+            self._put(read_queue, item, stop)
+
+    def _preprocess_stage(self, executor, read_queue: queue.Queue, out_queue: queue.Queue, stop: threading.Event):
+        while True:
+            item = self._get(read_queue, stop)
+            if item is None:
+                return
+            batch_id, audio, error = item
+            if error is None:
+                start = time.perf_counter()
+                try:
+                    if executor is None:
+                        audio = _preprocess(self.dataset.sampler, self._preprocessor, audio)
+                    else:
+                        audio = executor.submit(_preprocess_in_worker, audio).result()
+                except Exception as e:
+                    audio, error = None, e
+                self._add_busy('preprocess', time.perf_counter() - start)
+            self._put(out_queue, (batch_id, audio, error), stop)
+
+    def _report(self, wall_time: float):
+        workers = {'read': self.io_threads, 'preprocess': self.preprocess_workers, 'model': 1}
+        self.utilization = {stage: self._busy[stage] / (max(wall_time, 1e-9) * workers[stage])
+                            for stage in workers}
+        print(f"Inference pipeline utilization over {wall_time:.1f}s - "
+              f"read: {self.utilization['read']:.0%} ({self.io_threads} threads), "
+              f"preprocess: {self.utilization['preprocess']:.0%} ({self.preprocess_workers} "
+              f"{self.preprocess_backend}{'es' if self.preprocess_backend == 'process' else 's'}), "
+              f"model: {self.utilization['model']:.0%}")
+
+    def __iter__(self):
+        n_batches = len(self)
+        batch_ids = queue.Queue()
+        for batch_id in range(n_batches):
+            batch_ids.put(batch_id)
+        read_queue, out_queue = queue.Queue(self.queue_size), queue.Queue(self.queue_size)
+        in_flight = threading.Semaphore(self.queue_size)
+        stop = threading.Event()
+        self._busy = {'read': 0., 'preprocess': 0., 'model': 0.}
+        start = time.perf_counter()
+        executor = None
+        if self.preprocess_backend == 'process':
+            executor = ProcessPoolExecutor(self.preprocess_workers, mp_context=multiprocessing.get_context('spawn'),
+                                           initializer=_init_preprocess_worker,
+                                           initargs=(self.dataset.sampler, self._preprocessor))
+        threads = [threading.Thread(target=self._read_stage, args=(batch_ids, in_flight, read_queue, stop),
+                                    daemon=True)
+                   for _ in range(self.io_threads)]
+        threads += [threading.Thread(target=self._preprocess_stage, args=(executor, read_queue, out_queue, stop),
+                                     daemon=True)
+                    for _ in range(self.preprocess_workers)]
+        for thread in threads:
+            thread.start()
+        done = {}  # batches that arrived before the previous ones
+        try:
+            for batch_id in range(n_batches):
+                while batch_id not in done:
+                    item_id, audio, error = out_queue.get()
+                    if error is not None:
+                        raise error
+                    done[item_id] = audio
+                audio = done.pop(batch_id)
+                in_flight.release()
+                consumer_start = time.perf_counter()
+                yield audio
+                self._add_busy('model', time.perf_counter() - consumer_start)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            if executor is not None:
+                executor.shutdown()
+            self._report(time.perf_counter() - start)
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+
+_SNAPSHOT_VERSION = 2
+
+
+def file_hash(path: Union[str, Path]) -> str:
+    """sha1 of the content of a file"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class MetadataCache:
+    """
+    On-disk snapshots of the preprocessed metadata of the datasets, so later datasets over the same annotations load
+    it instead of parsing and slicing the csv again. ClassifierDataset keeps two snapshots: the filtered metadata
+    (after the mode split and the noise filtering), keyed without the slicing arguments so the train and
+    train_as_val datasets of a run share it, and the sliced metadata, which the datasets of later runs load. A
+    snapshot is keyed by the content of the metadata file, the audio files the dataset resolves the filenames to and
+    the preprocessing arguments, and holds the metadata columns, the label array and the sample weights as a numpy
+    .npz archive.
+    Input:
+        root: the cache directory, may be shared by several datasets and runs
+    """
+
+    def __init__(self, root: Union[str, Path]):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(metadata_path: Union[str, Path], audio_dict: Dict[str, Path], **params) -> str:
+        listing = sorted((name, str(path)) for name, path in audio_dict.items())
+        fields = [_SNAPSHOT_VERSION, file_hash(metadata_path), listing, sorted(params.items())]
+        return hashlib.sha1(json.dumps(fields, default=str).encode()).hexdigest()
+
+    def _snapshot_path(self, key: str) -> Path:
+        return self.root / f'{key}.npz'
+
+    def get(self, key: str) -> Optional[Tuple[pd.DataFrame, np.ndarray, np.ndarray]]:
+        """returns the (metadata, labels, samples weight) of the snapshot, None on a miss"""
+        try:
+            snapshot = np.load(self._snapshot_path(key), allow_pickle=False)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        with snapshot:
+            columns = json.loads(str(snapshot['columns']))
+            labels, samples_weight = snapshot['labels'], snapshot['samples_weight']
+            metadata = {}
+            for i, (name, kind) in enumerate(columns):
+                if name == 'label':
+                    metadata[name] = list(labels) if labels.ndim == 2 else labels
+                elif kind == 'object':
+                    values = snapshot[f'column_{i}'].astype(object)
+                    values[snapshot[f'null_{i}']] = np.nan
+                    metadata[name] = values
+                else:
+                    metadata[name] = snapshot[f'column_{i}']
+        return pd.DataFrame(metadata), labels, samples_weight
+
+    def put(self, key: str, metadata: pd.DataFrame, labels: np.ndarray, samples_weight: np.ndarray):
+        arrays = {'labels': labels, 'samples_weight': np.asarray(samples_weight)}
+        columns = []
+        for i, name in enumerate(metadata.columns):
+            values = metadata[name]
+            if name == 'label':
+                kind = 'label'
+            elif values.dtype == object:
+                kind = 'object'
+                null = values.isna().values
+                arrays[f'column_{i}'] = values.astype(str).values.astype(str)
+                arrays[f'null_{i}'] = null
+            else:
+                kind = str(values.dtype)
+                arrays[f'column_{i}'] = values.values
+            columns.append((str(name), kind))
+        arrays['columns'] = np.array(json.dumps(columns))
+        tmp_path = self.root / f'{key}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, self._snapshot_path(key))
@@ -0,0 +1,182 @@
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from soundbay.results_analysis import RAVEN_COLUMNS, extract_events
+
+
+RESULTS_FORMATS = ('csv', 'parquet')
+
+
+class CSVResultsWriter:
+    """
+    Writes the results of the inference to a csv file batch by batch: the first batch creates the file with the
+    header, the next ones are appended, and the file is flushed after every batch, so the results are on disk as soon
+    as they are predicted.
+    Input:
+        path: the csv file, overwritten
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._file = None
+
+    def write(self, results: pd.DataFrame):
+        header = self._file is None
+        if header:
+            self._file = open(self.path, 'w', newline='')
+        results.to_csv(self._file, index=False, header=header)
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ParquetResultsWriter(CSVResultsWriter):
+    """
+    Writes the results of the inference to a parquet file, one row group per batch. The schema is taken from the first
+    batch, object columns (the file paths) are written as strings. Requires pyarrow.
+    Input:
+        path: the parquet file, overwritten
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError('writing the results as parquet requires pyarrow: pip install pyarrow') from e
+        super().__init__(path)
+        self._pa, self._pq = pyarrow, pyarrow.parquet
+        self._schema = None
+
+    def write(self, results: pd.DataFrame):
+        results = results.astype({name: str for name in results.columns if results[name].dtype == object})
+        table = self._pa.Table.from_pandas(results, schema=self._schema, preserve_index=False)
+        if self._file is None:
+            self._schema = table.schema
+            self._file = self._pq.ParquetWriter(str(self.path), self._schema)
+        self._file.write_table(table)
+
+
+def create_results_writer(path: Union[str, Path]):
+    """returns the writer of the results file by its suffix, one of RESULTS_FORMATS"""
+    results_format = Path(path).suffix.lstrip('.')
+    if results_format not in RESULTS_FORMATS:
+        raise ValueError(f'the results file should be one of {RESULTS_FORMATS}, got {path}')
+    return ParquetResultsWriter(path) if results_format == 'parquet' else CSVResultsWriter(path)
+
+
+class RavenWriter:
+    """
+    Writes the Raven selection tables of the inference, one per recording, from the results given batch by batch (the
+    rows of a file come together, and the rows of a file and channel in order of begin time). Only the windows that
+    may be part of an event, above low_threshold for some class, are kept until their file is over. The events of the
+    files that are over are extracted together once there are flush_files of them (see extract_events), and their
+    tables are written by num_workers threads.
+    Input:
+        output_path: the directory of the tables
+        model_name: ends the names of the tables
+        threshold, low_threshold, min_gap, max_freq: see extract_events
+        num_workers: the number of threads writing the tables
+        flush_files: the number of files whose tables are written together
+    """
+
+    def __init__(self, output_path: Union[str, Path], model_name: str = '', threshold: float = 0.5,
+                 low_threshold: Optional[float] = None, min_gap: Optional[float] = 0., max_freq: float = 20_000,
+                 num_workers: int = 4, flush_files: int = 256):
+        assert num_workers >= 1, f'num_workers should be a positive integer, got {num_workers}'
+        self.output_path = Path(output_path)
+        self.model_name = model_name
+        self.threshold = threshold
+        self.low_threshold = threshold if low_threshold is None else low_threshold
+        self.min_gap = min_gap
+        self.max_freq = max_freq
+        self.flush_files = flush_files
+        self._label_names = None
+        self._windows = {}  # the number of windows of every (file, channel) so far
+        self._current, self._done = None, []  # the file in progress, and the files that are over
+        self._rows = []
+        self._executor = ThreadPoolExecutor(num_workers)
+        self._futures = []
+
+    def write(self, results: pd.DataFrame, label_names):
+        """
+        takes the results of a batch: filename, channel, begin_time and end_time columns and a probability column per
+        class (label_names)
+        """
+        self._label_names = list(label_names)
+        codes, keys = pd.factorize(pd.MultiIndex.from_frame(results[['filename', 'channel']]))
+        offsets = np.array([self._windows.get(key, 0) for key in keys], dtype=np.int64)
+        counts = np.bincount(codes, minlength=len(keys))
+        self._windows.update(zip(keys, offsets + counts))
+        windows = offsets[codes] + pd.Series(codes).groupby(codes).cumcount().values
+        class_names = self._label_names[1:]
+        keep = (results[class_names].values > self.low_threshold).any(axis=1)
+        self._rows.append(results.loc[keep, ['filename', 'channel', 'begin_time', 'end_time'] + class_names]
+                          .assign(window=windows[keep]))
+        for file in pd.unique(results['filename']):
+            if file != self._current:
+                if self._current is not None:
+                    self._done.append(self._current)
+                self._current = file
+        if len(self._done) >= self.flush_files:
+            self._flush()
+
+    def _flush(self, final: bool = False):
+        files = self._done + ([self._current] if final and self._current is not None else [])
+        self._done = []
+        if not files:
+            return
+        rows = pd.concat(self._rows, ignore_index=True)
+        in_progress = np.zeros(len(rows), dtype=bool) if final else (rows['filename'] == self._current).values
+        self._rows = [rows[in_progress]]
+        events = extract_events(rows[~in_progress], self._label_names, self.threshold, self.low_threshold,
+                                self.min_gap, self.max_freq)
+        # the selections of all the files are formatted at once, and split into the tables of the files
+        table = events[RAVEN_COLUMNS].astype(str)
+        lines = (table[RAVEN_COLUMNS[0]].str.cat([table[name] for name in RAVEN_COLUMNS[1:]], sep='\t') + '\n').tolist()
+        first = np.flatnonzero(np.r_[True, events['filename'].values[1:] != events['filename'].values[:-1]])
+        bounds = {file: (start, stop) for file, start, stop in
+                  zip(events['filename'].values[first], first, np.r_[first[1:], len(events)])}
+        header = '\t'.join(RAVEN_COLUMNS) + '\n'
+        now = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        # the tables of the previous flush are written by now, so at most two flushes are held in memory
+        for future in self._futures:
+            future.result()
+        self._futures = []
+        for file in files:
+            start, stop = bounds.get(file, (0, 0))
+            path = self.output_path / f"{Path(file).stem}-Raven-inference_results-{now}-{self.model_name}.txt"
+            self._futures.append(self._executor.submit(path.write_text, header + ''.join(lines[start:stop])))
+            for key in [key for key in self._windows if key[0] == file]:
+                del self._windows[key]
+
+    def close(self):
+        """writes the tables of the files left, and waits for all the tables to be written"""
+        try:
+            self._flush(final=True)
+            for future in self._futures:
+                future.result()
+        finally:
+            self._futures = []
+            self._current = None
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
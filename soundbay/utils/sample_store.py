@@ -0,0 +1,134 @@
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from soundbay.utils.audio_index import AudioInfo
+from soundbay.utils.audio_io import to_float32
+
+
+SAMPLE_STORE_INDEX = 'index.csv'
+SAMPLE_STORE_DTYPES = ('int16', 'float16')
+_INDEX_COLUMNS = ['filename', 'file', 'frames', 'samplerate', 'channels', 'dtype']
+
+
+class SampleStore:
+    """
+    Recordings that were resampled ahead of time to the training sample rate (see soundbay/materialize.py). Every
+    recording is a contiguous (frames, channels) int16 or float16 .npy file, and the index maps the metadata filenames
+    to the files and their shape. The store serves both as the datasets' audio index and as their audio reader, the
+    files are memory mapped so reads are page cache hits shared by all the DataLoader workers.
+    Input:
+        root: the store directory
+        max_open_files: maximal number of files kept mapped
+    """
+
+    def __init__(self, root: Union[str, Path], max_open_files: int = 16):
+        self.root = Path(root)
+        index_path = self.root / SAMPLE_STORE_INDEX
+        assert index_path.is_file(), f'{self.root} is not a sample store, run soundbay/materialize.py first'
+        index = pd.read_csv(index_path, dtype={'filename': str, 'file': str, 'dtype': str})
+        assert index['samplerate'].nunique() == 1, f'{self.root} holds recordings in several sample rates'
+        self.sample_rate = int(index['samplerate'].iloc[0])
+        self.audio_dict = {row.filename: self.root / row.file for row in index.itertuples()}
+        self._entries: Dict[str, AudioInfo] = {}
+        for row in index.itertuples():
+            path = self.root / row.file
+            stat = os.stat(path)
+            self._entries[str(path)] = AudioInfo(frames=row.frames, samplerate=row.samplerate, channels=row.channels,
+                                                 subtype=row.dtype, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+        self.max_open_files = max_open_files
+        self._maps = OrderedDict()
+
+    def __getitem__(self, path: Union[str, Path]) -> AudioInfo:
+        return self._entries[str(path)]
+
+    def __contains__(self, path: Union[str, Path]) -> bool:
+        return str(path) in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_maps'] = OrderedDict()
+        return state
+
+    def get(self, path: Union[str, Path]) -> np.ndarray:
+        """returns the (frames, channels) map of a stored recording"""
+        key = str(path)
+        if key in self._maps:
+            self._maps.move_to_end(key)
+            return self._maps[key]
+        data = np.load(key, mmap_mode='c')
+        if self.max_open_files > 0:
+            self._maps[key] = data
+            while len(self._maps) > self.max_open_files:
+                self._maps.popitem(last=False)
+        return data
+
+    def read(self, path: Union[str, Path], start: int, stop: int, channel: Optional[int] = None) -> np.ndarray:
+        """
+        reads frames [start, stop) of a stored recording
+        Input:
+            channel: zero-based channel to return, None returns all the channels
+        Output:
+            data - float32 numpy array of shape (frames, channels), or (frames,) if channel is given
+        """
+        data = self.get(path)[start:stop]
+        if channel is not None:
+            data = data[:, channel]
+        return to_float32(data)
+
+    def close(self):
+        self._maps.clear()
+
+
+def write_samples(root: Union[str, Path], filename: str, samples: np.ndarray, sample_rate: int,
+                  dtype: str = 'int16') -> tuple:
+    """
+    Writes the samples of one recording to a sample store without updating its index, see update_sample_store_index
+    Output:
+        the index row of the recording
+    """
+    assert dtype in SAMPLE_STORE_DTYPES, f'dtype should be one of {SAMPLE_STORE_DTYPES}, got {dtype}'
+    if dtype == 'int16':
+        samples = np.clip(np.round(samples * 32768), -32768, 32767)
+    file = f'{filename}.npy'
+    (Path(root) / file).parent.mkdir(parents=True, exist_ok=True)
+    np.save(Path(root) / file, np.ascontiguousarray(samples.astype(dtype)))
+    return filename, file, samples.shape[0], sample_rate, samples.shape[1], dtype
+
+
+def update_sample_store_index(root: Union[str, Path], rows: List[tuple], sample_rate: int):
+    """Adds the index rows of written recordings to the index of a sample store, replacing the same filenames"""
+    root = Path(root)
+    index_path = root / SAMPLE_STORE_INDEX
+    if index_path.is_file():
+        index = pd.read_csv(index_path, dtype={'filename': str, 'file': str, 'dtype': str})
+        assert (index['samplerate'] == sample_rate).all(), \
+            f'{root} holds recordings in another sample rate than {sample_rate}'
+    else:
+        index = pd.DataFrame(columns=_INDEX_COLUMNS)
+    index = index[~index['filename'].isin([row[0] for row in rows])]
+    index = pd.concat([index, pd.DataFrame(rows, columns=_INDEX_COLUMNS)], ignore_index=True)
+    tmp_path = index_path.with_name(f'{index_path.name}.{os.getpid()}.tmp')
+    index.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, index_path)
+
+
+def write_sample_store(root: Union[str, Path], recordings: Dict[str, np.ndarray], sample_rate: int,
+                       dtype: str = 'int16'):
+    """
+    Adds recordings to a sample store, replacing the ones with the same filename
+    Input:
+        root: the store directory
+        recordings: metadata filename -> float (frames, channels) samples at sample_rate
+        sample_rate: the sample rate of the recordings
+        dtype: 'int16' or 'float16'
+    """
+    rows = [write_samples(root, filename, samples, sample_rate, dtype) for filename, samples in recordings.items()]
+    update_sample_store_index(root, rows, sample_rate)
@@ -0,0 +1,50 @@
+import math
+import os
+import pathlib
+
+import torch
+from hydra import compose, initialize
+from omegaconf import OmegaConf
+
+from soundbay.batch_augmentations import BatchBandStopFilter, BatchCompose, BatchGain, BatchTimeMask, \
+    BatchTimeStretch
+from soundbay.data import ClassifierDataset
+
+
+def test_batch_augmentations() -> None:
+    sample_rate = 16000
+    time = torch.arange(sample_rate) / sample_rate
+    samples = torch.sin(2 * math.pi * 1000 * time).repeat(8, 1, 1)  # [B, 1, T]
+
+    for augmentation in [BatchGain(p=1), BatchTimeMask(0.1, 0.2, fade=True, p=1), BatchTimeStretch(0.8, 1.2, p=1),
+                         BatchBandStopFilter(500, 2000, p=1)]:
+        augmented = augmentation(samples, sample_rate)
+        assert augmented.shape == samples.shape
+        assert not torch.equal(augmented[0], augmented[1])  # random parameters per sample
+        assert torch.equal(type(augmentation)(p=0)(samples, sample_rate), samples)
+
+    masked = BatchTimeMask(0.1, 0.1, p=1)(samples, sample_rate)
+    assert ((masked == 0) & (samples != 0)).sum(dim=-1).le(sample_rate // 10).all()
+    band_stopped = BatchBandStopFilter(1000, 1000, min_bandwidth_fraction=0.5, max_bandwidth_fraction=0.5, p=1)
+    assert band_stopped(samples, sample_rate).abs().max() < 0.05
+
+    compose_p0 = BatchCompose([BatchGain(p=1)], p=0)
+    assert torch.equal(compose_p0(samples, sample_rate), samples)
+
+
+def test_batch_augmentations_in_dataset() -> None:
+    with initialize(config_path=os.path.join('..', 'soundbay', 'conf'), version_base='1.2'):
+        cfg = compose(config_name="runs/main")
+    batch_augmentations = pathlib.Path(__file__).parents[1] / 'soundbay' / 'conf' / 'augmentations' / \
+        '_batch_augmentations.yaml'
+    cfg = OmegaConf.merge(cfg, OmegaConf.load(batch_augmentations))
+    dataset_args = dict(data_path=cfg.data.train_dataset.data_path, metadata_path=cfg.data.train_dataset.metadata_path,
+                        augmentations=cfg._augmentations, augmentations_p=1, preprocessors=cfg._preprocessors,
+                        mode='train', data_sample_rate=44100, sample_rate=16000)
+    dataset = ClassifierDataset(**dataset_args)
+    assert dataset._train_batch_augmenter is not None and not dataset._train_augmenter.transforms
+    assert dataset[0][0].dim() == 3
+
+    batch_dataset = ClassifierDataset(**dataset_args, batch_preprocessing=True)
+    batch = torch.stack([batch_dataset[i][0] for i in range(3)])
+    assert batch_dataset.batch_preprocessor(batch).shape == torch.Size([3]) + dataset[0][0].shape
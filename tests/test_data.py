@@ -1,11 +1,24 @@
+import ast
 import pathlib
 import os
+import pickle
+import shutil
 
 from hydra import compose, initialize
+from omegaconf import OmegaConf
 from random import randint
 from random import seed
-from soundbay.data import ClassifierDataset
+from soundbay.data import ClassifierDataset, InferenceDataset, SlidingWindowNormalize, StreamingInferenceDataset
+from soundbay.utils.audio_index import AudioIndex, DirectoryIndex, AUDIO_INDEX_FILENAME, DIRECTORY_INDEX_FILENAME
+from soundbay.utils.audio_io import SoundFilePool, WavMemmapReader, parse_wav_header
+from soundbay.utils.sample_store import SampleStore
+from soundbay.utils.feature_cache import FeatureCache
+from soundbay.materialize import materialize
 import numpy as np
+import pandas as pd
+import pytest
+import soundfile as sf
+import torch
 
 
 def test_dataloader() -> None:
@@ -31,3 +44,322 @@ def test_dataloader() -> None:
                 assert sample[0].shape[1] == (cfg.data.train_dataset.preprocessors.spectrogram.n_fft // 2 + 1)
         else:
             assert sample[0].shape[1] == 1
+
+
+def test_audio_index(tmp_path) -> None:
+    wav_path = tmp_path / 'sample.wav'
+    shutil.copy(pathlib.Path(__file__).parent / 'assets' / 'data' / 'sample.wav', wav_path)
+    index = AudioIndex(tmp_path, [wav_path])
+    info = sf.info(str(wav_path))
+    assert (tmp_path / AUDIO_INDEX_FILENAME).is_file()
+    assert index[wav_path].frames == info.frames
+    assert index[wav_path].samplerate == info.samplerate
+    assert index[wav_path].channels == info.channels
+    assert index[wav_path].duration == info.duration
+
+    # a reloaded index serves the entry from disk, a modified file is read again
+    assert AudioIndex(tmp_path, [wav_path])[wav_path] == index[wav_path]
+    data, sample_rate = sf.read(str(wav_path))
+    sf.write(str(wav_path), data[:sample_rate], sample_rate)
+    assert AudioIndex(tmp_path, [wav_path])[wav_path].frames == sample_rate
+
+
+def test_sound_file_pool(tmp_path) -> None:
+    wav_path = pathlib.Path(__file__).parent / 'assets' / 'data' / 'sample.wav'
+    other_path = tmp_path / 'other.wav'
+    shutil.copy(wav_path, other_path)
+    expected, _ = sf.read(str(wav_path), start=1000, stop=5000, dtype='float32', always_2d=True)
+
+    pool = SoundFilePool(max_open_files=1)
+    assert np.array_equal(pool.read(wav_path, 1000, 5000), expected)
+    assert np.array_equal(pool.read(wav_path, 1000, 5000), expected)
+    pool.read(other_path, 0, 10)
+    assert len(pool) == 1
+
+    # int16 reads are scaled back to float32, and pickled pools (DataLoader workers) come without open handles
+    int16_pool = SoundFilePool(max_open_files=0, dtype='int16')
+    data = int16_pool.read(wav_path, 1000, 5000)
+    assert data.dtype == np.float32
+    assert np.allclose(data, expected, atol=1 / 32768)
+    assert len(pickle.loads(pickle.dumps(pool))) == 0
+
+
+def test_wav_memmap_reader(tmp_path) -> None:
+    wav_path = pathlib.Path(__file__).parent / 'assets' / 'data' / 'sample.wav'
+    expected, sample_rate = sf.read(str(wav_path), start=1000, stop=5000, dtype='float32', always_2d=True)
+    reader = WavMemmapReader()
+    assert np.array_equal(reader.read(wav_path, 1000, 5000), expected)
+
+    # float32 files are mapped without a copy, one channel of a multichannel file is a strided view
+    stereo = np.stack([expected[:, 0], -expected[:, 0]], axis=1)
+    float_path = tmp_path / 'stereo.wav'
+    sf.write(str(float_path), stereo, sample_rate, subtype='FLOAT')
+    layout = parse_wav_header(float_path)
+    assert (layout.frames, layout.channels, layout.dtype) == (len(stereo), 2, np.float32)
+    channel = reader.read(float_path, 10, 20, channel=1)
+    assert np.shares_memory(channel, reader.get(float_path))
+    assert np.array_equal(channel, stereo[10:20, 1])
+
+    # formats that can't be mapped are read through soundfile
+    pcm24_path = tmp_path / 'pcm24.wav'
+    sf.write(str(pcm24_path), stereo, sample_rate, subtype='PCM_24')
+    assert reader.get(pcm24_path) is None
+    assert np.allclose(reader.read(pcm24_path, 10, 20, channel=1), stereo[10:20, 1], atol=1e-6)
+
+
+def test_sample_store(tmp_path) -> None:
+    data_path = pathlib.Path(__file__).parent / 'assets' / 'data'
+    metadata_path = pathlib.Path(__file__).parent / 'assets' / 'annotations' / 'sample_annotations.csv'
+    materialize(data_path, tmp_path, 16000, metadata_paths=[metadata_path])
+    store = SampleStore(tmp_path)
+    info = sf.info(str(data_path / 'sample.wav'))
+    assert store.sample_rate == 16000
+    assert store[store.audio_dict['sample']].frames == np.ceil(info.frames * 16000 / info.samplerate)
+
+    # the store is read at sample_rate, so the dataset resamples nothing
+    dataset = ClassifierDataset(data_path, metadata_path, augmentations=None, augmentations_p=0, preprocessors={},
+                                mode='val', slice_flag=True, data_sample_rate=44100, sample_rate=16000,
+                                sample_store=tmp_path)
+    store_audio = dataset[0][2]
+    assert dataset.data_sample_rate == 16000
+    assert store_audio.shape[-1] == 16000
+    dataset = ClassifierDataset(data_path, metadata_path, augmentations=None, augmentations_p=0, preprocessors={},
+                                mode='val', slice_flag=True, data_sample_rate=44100, sample_rate=16000)
+    assert (store_audio - dataset[0][2]).abs().max() < 1e-2
+
+
+def test_feature_cache(tmp_path) -> None:
+    with initialize(config_path=os.path.join('..', 'soundbay', 'conf'), version_base='1.2'):
+        cfg = compose(config_name="runs/main")
+    dataset_args = dict(data_path=cfg.data.val_dataset.data_path, metadata_path=cfg.data.val_dataset.metadata_path,
+                        augmentations=None, augmentations_p=0, preprocessors=cfg._preprocessors, mode='val',
+                        slice_flag=True, data_sample_rate=44100, sample_rate=16000, feature_cache=tmp_path)
+    dataset = ClassifierDataset(**dataset_args)
+    assert dataset.feature_cache is not None
+    audio, label, raw, meta = dataset[2]
+    cached_audio, cached_label, cached_raw, _ = ClassifierDataset(**dataset_args)[2]
+    assert cached_label == label
+    assert cached_audio.shape == audio.shape and cached_raw.shape == raw.shape
+    assert torch.allclose(cached_audio, audio, atol=1e-3) and torch.allclose(cached_raw, raw, atol=1e-3)
+
+    # items of a train dataset are random, so they are never cached
+    assert ClassifierDataset(**{**dataset_args, 'mode': 'train'}).feature_cache is None
+
+    # the entries are appended to shards, and the least recently used shards are evicted once the cache is full
+    cache = FeatureCache(tmp_path, 'small', max_gb=2 ** -20, shard_mb=2 ** -10)
+    for i in range(10):
+        cache.put(cache.key(i), torch.full((100,), i), torch.zeros(100))
+    assert len(list(cache.path.glob('*.bin'))) < 10
+    assert cache.get(cache.key(9))[0][0] == 9
+    assert cache.get(cache.key(0)) is None
+    # another process finds the entries of the shards through their indices
+    assert FeatureCache(tmp_path, 'small', max_gb=2 ** -20, shard_mb=2 ** -10).get(cache.key(9))[0][0] == 9
+
+
+def test_batch_preprocessor() -> None:
+    for config_name in ['runs/main', 'runs/main_unit_norm']:
+        with initialize(config_path=os.path.join('..', 'soundbay', 'conf'), version_base='1.2'):
+            cfg = compose(config_name=config_name)
+        dataset_args = dict(data_path=cfg.data.val_dataset.data_path,
+                            metadata_path=cfg.data.val_dataset.metadata_path, augmentations=None, augmentations_p=0,
+                            preprocessors=cfg._preprocessors, mode='val', slice_flag=True, data_sample_rate=44100,
+                            sample_rate=16000)
+        dataset = ClassifierDataset(**dataset_args)
+        batch_dataset = ClassifierDataset(**dataset_args, batch_preprocessing=True)
+        assert batch_dataset[0][0].shape == batch_dataset[0][2].shape  # items are waveforms
+        expected = torch.stack([dataset[i][0] for i in range(4)])
+        processed = batch_dataset.batch_preprocessor(torch.stack([batch_dataset[i][0] for i in range(4)]))
+        assert torch.allclose(processed, expected, atol=1e-4)
+
+
+def test_sliding_window_normalize() -> None:
+    def reference(spect, transform, dim):
+        # the per row np.convolve implementation
+        spect = spect.numpy().squeeze().copy()
+        min_f_ind = int((transform.lower_cutoff / (transform.sr / 2)) * transform.n_fft)
+        mval, sval = np.mean(spect[min_f_ind:, :]), np.std(spect[min_f_ind:, :])
+        spect = np.clip(spect, mval - 1.5 * sval, mval + 1.5 * sval)
+        spect[:min_f_ind, :] = mval
+        w_inner = np.ones(int(transform.inner_ratio * spect.shape[dim]))
+        w_outer = np.ones(int(transform.outer_ratio * spect.shape[dim]))
+        for i in range(spect.shape[1 - dim]):
+            line = spect[:, i] if dim == 0 else spect[i, :]
+            line -= (np.convolve(line, w_outer, 'same') - np.convolve(line, w_inner, 'same')) / (
+                len(w_outer) - len(w_inner))
+        spect[spect < 0] = 0.
+        return spect
+
+    transform = SlidingWindowNormalize(sr=16000, n_fft=256)
+    spects = torch.rand(3, 1, 129, 251) * 10
+    for dim in [0, 1]:
+        batch_result = transform.slidingWindow(spects, dim=dim)
+        for spect, result in zip(spects, batch_result):
+            assert np.allclose(result.squeeze().numpy(), reference(spect, transform, dim), atol=1e-4)
+    assert transform.batch(spects).shape == spects.shape
+
+
+def test_compiled_index() -> None:
+    with initialize(config_path=os.path.join("..", 'soundbay', 'conf/runs/'), version_base='1.2'):
+        cfg = compose(config_name="main")
+        dataset = ClassifierDataset(cfg.data.val_dataset.data_path, cfg.data.val_dataset.metadata_path,
+                                    augmentations=cfg.data.val_dataset.augmentations,
+                                    augmentations_p=cfg.data.val_dataset.augmentations_p,
+                                    preprocessors=cfg.data.val_dataset.preprocessors,
+                                    seq_length=cfg.data.val_dataset.seq_length, mode='val', slice_flag=True)
+        metadata = dataset.metadata
+        for idx in range(len(metadata)):
+            path_to_file, begin_time, end_time, label, channel = dataset._grab_fields(idx)
+            assert path_to_file == dataset.audio_dict[metadata['filename'][idx]]
+            assert begin_time == int(metadata['begin_time'][idx] * dataset.data_sample_rate)
+            assert end_time == int(metadata['end_time'][idx] * dataset.data_sample_rate)
+            assert np.array_equal(label, metadata['label'][idx])
+        # the workers get the compiled arrays only
+        worker_dataset = pickle.loads(pickle.dumps(dataset))
+        assert not hasattr(worker_dataset, 'metadata')
+        assert len(worker_dataset) == len(dataset)
+        assert torch.equal(worker_dataset[0][0], dataset[0][0])
+
+
+def test_slice_times() -> None:
+    rng = np.random.default_rng(0)
+    begin_times = np.round(rng.uniform(0, 1000, 200), 3)
+    end_times = begin_times + np.round(rng.uniform(0, 8, 200), 2)
+    is_call = rng.random(200) < 0.5
+    seq_length = 0.3
+    rows, new_begin_time, new_end_time = ClassifierDataset._slice_times(begin_times, end_times, is_call, seq_length)
+    # the windows of the former per-segment implementation
+    points = [np.arange(b, e, seq_length) for b, e in zip(begin_times, end_times)]
+    points = [np.append(p, e) if call else p for p, e, call in zip(points, end_times, is_call)]
+    assert np.array_equal(np.bincount(rows, minlength=200), [len(p) - 1 if len(p) else 0 for p in points])
+    assert np.array_equal(new_begin_time, np.concatenate([p[:-1] for p in points]))
+    assert np.array_equal(new_end_time, np.concatenate([p[1:] for p in points]))
+
+
+def test_multi_label_parsing(tmp_path) -> None:
+    labels = ['[0, 0, 0]', '[1, 0, 0]', '[0, 1, 1]', '(0,1,0)', '[1, 1, 0]', '[0, 0, 0]']
+    metadata_path = tmp_path / 'multi_label.csv'
+    pd.DataFrame({'begin_time': np.arange(6) * 5.0, 'end_time': np.arange(6) * 5.0 + 2, 'filename': 'sample',
+                  'call_length': 2.0, 'label': labels}).to_csv(metadata_path, index=False)
+    with initialize(config_path=os.path.join("..", 'soundbay', 'conf/runs/'), version_base='1.2'):
+        cfg = compose(config_name="main")
+        dataset = ClassifierDataset(cfg.data.val_dataset.data_path, metadata_path,
+                                    augmentations=cfg.data.val_dataset.augmentations,
+                                    augmentations_p=cfg.data.val_dataset.augmentations_p,
+                                    preprocessors=cfg.data.val_dataset.preprocessors, seq_length=1, mode='val')
+    expected = np.array([ast.literal_eval(label) for label in labels])
+    assert dataset.label_type == 'multi_label'
+    assert dataset.num_classes == 3
+    assert dataset._labels.dtype == np.uint8
+    assert np.array_equal(dataset._labels, expected)
+    assert all(np.array_equal(label, row) for label, row in zip(dataset.metadata['label'], expected))
+    # inverse of the minimal count of the sample's classes, noise samples count as a class
+    assert np.allclose(dataset.samples_weight, 1 / np.array([2, 2, 1, 3, 2, 2]))
+
+
+def test_metadata_cache(tmp_path, monkeypatch) -> None:
+    with initialize(config_path=os.path.join("..", 'soundbay', 'conf/runs/'), version_base='1.2'):
+        cfg = compose(config_name="main")
+        args = cfg.data.val_dataset
+
+        def make_dataset(metadata_cache, mode='val', slice_flag=True):
+            return ClassifierDataset(args.data_path, args.metadata_path, augmentations=args.augmentations,
+                                     augmentations_p=args.augmentations_p, preprocessors=args.preprocessors,
+                                     seq_length=args.seq_length, mode=mode, slice_flag=slice_flag,
+                                     metadata_cache=metadata_cache)
+
+        expected = make_dataset(None)
+        make_dataset(tmp_path / 'metadata_cache')
+        assert len(list((tmp_path / 'metadata_cache').glob('*.npz'))) == 2
+        cached = make_dataset(tmp_path / 'metadata_cache')
+        pd.testing.assert_frame_equal(cached.metadata.drop(columns='label'), expected.metadata.drop(columns='label'))
+        assert all(np.array_equal(a, b) for a, b in zip(cached.metadata['label'], expected.metadata['label']))
+        assert np.array_equal(cached._labels, expected._labels)
+        assert np.array_equal(cached.samples_weight, expected.samples_weight)
+        assert torch.equal(cached[0][0], expected[0][0])
+
+        # a dataset of another mode that slices the same annotations differently (as the train and train_as_val
+        # datasets of a run do) starts from the filtered snapshot
+        expected = make_dataset(None, mode='train', slice_flag=False)
+        monkeypatch.setattr(ClassifierDataset, '_filter_metadata', lambda self: pytest.fail('filtered again'))
+        cached = make_dataset(tmp_path / 'metadata_cache', mode='train', slice_flag=False)
+        assert len(list((tmp_path / 'metadata_cache').glob('*.npz'))) == 3
+        pd.testing.assert_frame_equal(cached.metadata.drop(columns='label'), expected.metadata.drop(columns='label'))
+        assert np.array_equal(cached._labels, expected._labels)
+        assert np.array_equal(cached.samples_weight, expected.samples_weight)
+
+
+def test_directory_index(tmp_path) -> None:
+    wav_path = pathlib.Path(__file__).parent / 'assets' / 'data' / 'sample.wav'
+    for rel in ['a.wav', 'class1/b.wav', 'class1/deep/c.wav', 'class2/d.wav', 'class2/notes.txt']:
+        (tmp_path / rel).parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy(wav_path, tmp_path / rel)
+    index = DirectoryIndex(tmp_path, num_workers=2)
+    assert (tmp_path / DIRECTORY_INDEX_FILENAME).is_file()
+    assert sorted(index.paths('.wav')) == sorted(tmp_path.rglob('*.wav'))
+    assert index.paths(suffix=None, recursive=False) == [tmp_path / 'a.wav']
+
+    # a reloaded index lists only the modified directories again
+    shutil.copy(wav_path, tmp_path / 'class2' / 'e.wav')
+    (tmp_path / 'class1' / 'deep' / 'c.wav').unlink()
+    assert sorted(DirectoryIndex(tmp_path).paths('.wav')) == sorted(tmp_path.rglob('*.wav'))
+    audio_dict = ClassifierDataset._create_audio_dict(tmp_path, path_hierarchy=1)
+    assert audio_dict['class2/e'] == tmp_path / 'class2' / 'e.wav'
+
+    # symlinked directories, including cycles, are skipped as rglob skips them
+    (tmp_path / 'linked').symlink_to(tmp_path / 'class1', target_is_directory=True)
+    (tmp_path / 'class1' / 'cycle').symlink_to(tmp_path, target_is_directory=True)
+    assert sorted(DirectoryIndex(tmp_path).paths('.wav')) == sorted(tmp_path.rglob('*.wav'))
+
+
+def test_index_dir(tmp_path) -> None:
+    data_path, index_dir = tmp_path / 'data', tmp_path / 'index'
+    data_path.mkdir()
+    shutil.copy(pathlib.Path(__file__).parent / 'assets' / 'data' / 'sample.wav', data_path / 'a.wav')
+
+    # inference keeps the indexes in memory by default
+    dataset = InferenceDataset(data_path, preprocessors={}, seq_length=1)
+    assert sorted(p.name for p in data_path.iterdir()) == ['a.wav']
+
+    # index_dir moves the saved indexes out of the data directory, and serves them to later datasets
+    InferenceDataset(data_path, preprocessors={}, seq_length=1, persist_index=True, index_dir=index_dir)
+    assert sorted(p.name for p in data_path.iterdir()) == ['a.wav']
+    assert len(list(index_dir.glob(f'{AUDIO_INDEX_FILENAME}.*'))) == 1
+    assert len(list(index_dir.glob(f'{DIRECTORY_INDEX_FILENAME}.*'))) == 1
+    assert DirectoryIndex(data_path, index_dir=index_dir)._cached.keys() == {''}
+    assert AudioIndex(data_path, index_dir=index_dir)._cached == {'a.wav': dataset.audio_index[data_path / 'a.wav']}
+
+
+def test_streaming_inference_dataset(tmp_path) -> None:
+    data, sample_rate = sf.read(str(pathlib.Path(__file__).parent / 'assets' / 'data' / 'sample.wav'),
+                                dtype='float32', frames=441000)
+    sf.write(str(tmp_path / 'stereo.wav'), np.stack([data, data[::-1]], axis=1), sample_rate)
+    args = dict(file_path=tmp_path, preprocessors=OmegaConf.create({}), seq_length=0.2, overlap=0.5,
+                data_sample_rate=sample_rate, sample_rate=sample_rate)
+    dataset = InferenceDataset(**args)
+    streaming_dataset = StreamingInferenceDataset(block_length=1, **args)
+    assert len(streaming_dataset) == len(dataset)
+    items = list(streaming_dataset)
+    assert len(items) == len(dataset)
+    # the windows come in the order of the streaming metadata, and match the windows read one by one
+    metadata = dataset.metadata.reset_index().set_index(['filename', 'channel', 'begin_time'])
+    for row, item in zip(streaming_dataset.metadata.itertuples(), items):
+        idx = metadata.loc[(row.filename, row.channel, row.begin_time), 'index']
+        assert torch.equal(item, dataset[idx])
+
+
+def test_block_spectrogram() -> None:
+    preprocessors = OmegaConf.create({
+        'spectrogram': {'_target_': 'torchaudio.transforms.Spectrogram', 'n_fft': 882, 'hop_length': 441,
+                        'center': False},
+        'min_freq_filtering': {'_target_': 'soundbay.data.MinFreqFiltering', 'min_freq_filtering': 1000,
+                               'sample_rate': 44100},
+        'amplitude_2_db': {'_target_': 'torchaudio.transforms.AmplitudeToDB'},
+        'peak_norm': {'_target_': 'soundbay.data.PeakNormalize'}})
+    args = dict(file_path=pathlib.Path(__file__).parent / 'assets' / 'data' / 'sample.wav',
+                preprocessors=preprocessors, seq_length=0.2, overlap=0.75, data_sample_rate=44100, sample_rate=44100)
+    streaming_dataset = StreamingInferenceDataset(block_length=5, block_spectrogram=True, **args)
+    assert len(streaming_dataset.window_preprocessor.transforms) == 1
+    expected = StreamingInferenceDataset(block_length=5, **args)
+    for item, expected_item in zip(streaming_dataset, expected):
+        assert item.shape == expected_item.shape
+        assert torch.allclose(item, expected_item, atol=1e-4)
@@ -6,7 +6,7 @@ from torch.utils.data import DataLoader
 from torchvision import transforms
 from torchvision.datasets import ImageFolder
 from soundbay.models import ResNet1Channel, GoogleResNet50, OrcaLabResNet18, ChristophCNN, ChristophCNNwithPCEN, \
-    GoogleResNet50withPCEN, SqueezeNet1D, ResNet182D, Squeezenet2D, EfficientNet2D
+    GoogleResNet50withPCEN, SqueezeNet1D, ResNet182D, Squeezenet2D, EfficientNet2D, PCENTransform
 
 
 @pytest.fixture(scope="module", params=[ResNet1Channel('torchvision.models.resnet.Bottleneck', [3, 4, 6, 3]),
@@ -30,3 +30,17 @@ def test_model(own_model):
     dataset = ImageFolder(os.path.join(current_path, 'assets', 'demi_image_data'), transform=data_transform)
     data = DataLoader(dataset, batch_size=16, shuffle=True)
     assert torch.sum(own_model(next(iter(data))[0])).detach().numpy() != 0
+
+
+def test_pcen_smoother():
+    x = torch.rand(2, 1000, 64)
+    s = 0.025
+    expected = [s * x[:, 0]]
+    for t in range(1, x.shape[1]):
+        expected.append((1 - s) * expected[-1] + s * x[:, t])
+    assert torch.allclose(PCENTransform.smooth(x, s), torch.stack(expected, 1), atol=1e-5)
+
+    # trainable parameters get gradients through the smoother
+    pcen = PCENTransform(trainable=True)
+    pcen(torch.rand(2, 1, 64, 300)).sum().backward()
+    assert pcen.log_s.grad is not None
@@ -1,13 +1,33 @@
 import copy
+import io
 import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+import pytest
+import pandas as pd
+import soundfile as sf
 import torch
 import wandb
+from soundbay.cascade import Cascade
+from soundbay.data import ClassifierDataset, InferenceDataset
+from soundbay.prescreen import PreScreen, calibrate_threshold, prescreen_report
+from soundbay.results_analysis import RAVEN_COLUMNS, extract_events, inference_csv_to_raven
+from soundbay.utils.inference_pipeline import InferencePipeline
 from soundbay.utils.logging import Logger
-from soundbay.inference import predict_proba
+from soundbay.utils.results_writers import RavenWriter, create_results_writer
+from soundbay.stream_inference import StreamingDetector, file_replay_source, pcm_source, socket_source
+from soundbay.inference_server import DynamicBatcher, InferenceServer, request_predictions
+from soundbay.inference import infer_without_metadata, iter_predictions, predict_files_in_parallel, \
+    predict_in_chunks, predict_proba
 from soundbay.trainers import Trainer
 from pathlib import Path
 from soundbay.utils.app import App
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
+from torch.utils.data import DataLoader
 
 
 class VariablesChangeException(Exception):
@@ -88,3 +108,498 @@ def test_inference(model, inference_data_loader):
     y = predict_proba(model, inference_data_loader)
     assert y.sum() != 0
     predict_proba(model, inference_data_loader, selected_class_idx=1)
+
+
+def _write_noise_wav(path, hours, sample_rate=1000):
+    rng = np.random.default_rng(0)
+    with sf.SoundFile(str(path), 'w', samplerate=sample_rate, channels=1, subtype='PCM_16') as f:
+        for _ in range(hours):
+            f.write(rng.uniform(-0.5, 0.5, 3600 * sample_rate).astype(np.float32))
+
+
+_CHUNKED_INFERENCE = """
+import sys, torch
+from pathlib import Path
+from soundbay.inference import predict_in_chunks
+from soundbay.utils.results_writers import RavenWriter
+wav_path, output_file = Path(sys.argv[1]), Path(sys.argv[2])
+torch.manual_seed(0)
+model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(1000, 2))
+dataset_args = {'_target_': 'soundbay.data.InferenceDataset', 'file_path': wav_path, 'preprocessors': {},
+                'seq_length': 1, 'overlap': 0.5, 'data_sample_rate': 1000, 'sample_rate': 1000}
+predict_in_chunks(model, dataset_args, 600, 256, torch.device('cpu'), output_file,
+                  raven_writer=RavenWriter(output_file.parent))
+# ru_maxrss keeps the peak of the forked parent across exec, VmHWM is the peak of this program only
+with open('/proc/self/status') as f:
+    print(next(line.split()[1] for line in f if line.startswith('VmHWM')))
+"""
+
+
+def _chunked_inference_peak(tmp_path, hours):
+    """runs predict_in_chunks on an hours long recording in a new process, returns the results and its peak RSS (kB)"""
+    wav_path = tmp_path / f'{hours}h.wav'
+    _write_noise_wav(wav_path, hours)
+    output_file = tmp_path / f'{hours}h.csv'
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join([str(Path(__file__).parents[1]),
+                                                         os.environ.get('PYTHONPATH', '')])}
+    run = subprocess.run([sys.executable, '-c', _CHUNKED_INFERENCE, str(wav_path), str(output_file)],
+                         capture_output=True, text=True, env=env, check=True)
+    return output_file, int(run.stdout.split()[-1])
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/status'), reason='the peak RSS is read from /proc')
+def test_predict_in_chunks(tmp_path):
+    output_file, peak = _chunked_inference_peak(tmp_path, 1)
+    results = pd.read_csv(output_file)
+    dataset = InferenceDataset(tmp_path / '1h.wav', preprocessors={}, seq_length=1, overlap=0.5,
+                               data_sample_rate=1000, sample_rate=1000)
+    assert np.allclose(results['begin_time'], dataset.metadata['begin_time'])
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(1000, 2))
+    expected = predict_proba(model, torch.utils.data.DataLoader(dataset, batch_size=256))
+    assert np.allclose(results[['Noise', 'Call_1']].values, expected, atol=1e-5)
+
+    # the peak RSS doesn't grow with the recording length (reading the 4h windows at once adds ~15MB)
+    _, long_peak = _chunked_inference_peak(tmp_path, 4)
+    assert long_peak - peak < 6 * 1024
+
+
+def test_predict_in_chunks_row_order(tmp_path, monkeypatch):
+    data_path = tmp_path / 'data'
+    data_path.mkdir()
+    sf.write(str(data_path / 'a.wav'), np.random.default_rng(0).uniform(-0.5, 0.5, (7300, 2)), 1000)
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(1000, 3))
+    monkeypatch.setattr('soundbay.inference.load_model', lambda model_args, state_dict: model)
+    dataset_args = DictConfig({'_target_': 'soundbay.data.InferenceDataset', 'file_path': str(data_path),
+                               'preprocessors': {}, 'seq_length': 1, 'overlap': 0.5, 'data_sample_rate': 1000,
+                               'sample_rate': 1000})
+    results = []
+    for chunk_length in [None, 2]:
+        output_path = tmp_path / f'outputs_{chunk_length}'
+        output_path.mkdir()
+        infer_without_metadata(torch.device('cpu'), 5, dataset_args, None, None, output_path, 'm', False, 0.5, None,
+                               None, chunk_length=chunk_length)
+        results.append(pd.read_csv(next(output_path.glob('*.csv'))))
+    # the chunks of a multichannel file come channel by channel, as the rows of the whole file
+    assert (results[0][['filename', 'channel']].values == results[1][['filename', 'channel']].values).all()
+    assert np.allclose(results[0].drop(columns='filename').values, results[1].drop(columns='filename').values,
+                       atol=1e-6)
+
+
+def test_predict_files_in_parallel(tmp_path):
+    rng = np.random.default_rng(0)
+    for name, seconds in [('a', 20), ('b', 5), ('c', 12)]:
+        sf.write(str(tmp_path / f'{name}.wav'), rng.uniform(-0.5, 0.5, seconds * 1000), 1000)
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(1000, 2))
+    dataset_args = {'preprocessors': {}, 'seq_length': 1, 'overlap': 0.5, 'data_sample_rate': 1000,
+                    'sample_rate': 1000, 'file_path': tmp_path}
+    metadata, predict_prob = predict_files_in_parallel(model, 'soundbay.data.InferenceDataset', dataset_args, 16, 2)
+    dataset = InferenceDataset(**dataset_args)
+    expected = predict_proba(model, torch.utils.data.DataLoader(dataset, batch_size=16))
+    order = dataset.metadata.sort_values(['filename', 'begin_time'], kind='stable').index
+    assert (metadata['filename'].values == dataset.metadata['filename'].values[order]).all()
+    assert np.allclose(metadata['begin_time'], dataset.metadata['begin_time'].values[order])
+    assert np.allclose(predict_prob, expected[order], atol=1e-6)
+
+
+def test_infer_without_metadata_in_parallel(tmp_path, monkeypatch):
+    data_path, output_path = tmp_path / 'data', tmp_path / 'outputs'
+    data_path.mkdir()
+    output_path.mkdir()
+    rng = np.random.default_rng(0)
+    for name, seconds in [('a', 8), ('b', 3)]:
+        sf.write(str(data_path / f'{name}.wav'), rng.uniform(-0.5, 0.5, seconds * 1000), 1000)
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(1000, 2))
+    monkeypatch.setattr('soundbay.inference.load_model', lambda model_args, state_dict: model)
+    dataset_args = DictConfig({'_target_': 'soundbay.data.InferenceDataset', 'file_path': str(data_path),
+                               'preprocessors': {}, 'seq_length': 1, 'overlap': 0.5, 'data_sample_rate': 1000,
+                               'sample_rate': 1000})
+    for num_processes, model_name in [(1, 'serial'), (2, 'parallel')]:
+        infer_without_metadata(torch.device('cpu'), 4, dataset_args, None, None, output_path, model_name, True, 0.5,
+                               None, None, num_processes=num_processes)
+    serial, parallel = [pd.read_csv(next(output_path.glob(f'*-{model_name}-data.csv')))
+                        for model_name in ['serial', 'parallel']]
+    assert len(list((output_path / 'data').glob('*-parallel.txt'))) == 2
+    assert (serial['filename'] == parallel['filename']).all()
+    assert np.allclose(serial[['begin_time', 'Noise', 'Call_1']], parallel[['begin_time', 'Noise', 'Call_1']],
+                       atol=1e-6)
+
+
+@pytest.mark.parametrize('preprocess_backend', ['thread', 'process'])
+def test_inference_pipeline(tmp_path, preprocess_backend):
+    rng = np.random.default_rng(0)
+    for name, seconds in [('a', 9), ('b', 4)]:
+        sf.write(str(tmp_path / f'{name}.wav'), rng.uniform(-0.5, 0.5, (seconds * 2000, 2)), 2000)
+    dataset = InferenceDataset(tmp_path, preprocessors={}, seq_length=1, overlap=0.5, data_sample_rate=2000,
+                               sample_rate=1000)
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(1000, 2))
+    expected = predict_proba(model, torch.utils.data.DataLoader(dataset, batch_size=5))
+    pipeline = InferencePipeline(dataset, 5, io_threads=3, preprocess_workers=2,
+                                 preprocess_backend=preprocess_backend, queue_size=1)
+    assert len(pipeline) == int(np.ceil(len(dataset) / 5))
+    assert np.allclose(predict_proba(model, pipeline), expected, atol=1e-6)
+    assert set(pipeline.utilization) == {'read', 'preprocess', 'model'}
+
+
+def test_inference_pipeline_back_pressure(tmp_path, monkeypatch):
+    sf.write(str(tmp_path / 'a.wav'), np.random.default_rng(0).uniform(-0.5, 0.5, 30 * 1000), 1000)
+    dataset = InferenceDataset(tmp_path / 'a.wav', preprocessors={}, seq_length=1, data_sample_rate=1000,
+                               sample_rate=1000)
+    get_audio, reads = dataset._get_audio, []
+
+    def stalled_get_audio(filepath, channel, begin_time):
+        if begin_time == 0:
+            time.sleep(0.5)  # the first batch is stuck, the other reading threads go on
+        reads.append(begin_time)
+        return get_audio(filepath, channel, begin_time)
+
+    monkeypatch.setattr(dataset, '_get_audio', stalled_get_audio)
+    pipeline = InferencePipeline(dataset, 2, io_threads=4, preprocess_workers=1, preprocess_backend='thread',
+                                 queue_size=3)
+    batches = iter(pipeline)
+    next(batches)
+    # at most queue_size batches were read while the first one was stuck
+    assert len(reads) <= 3 * 2
+    assert len(list(batches)) == len(pipeline) - 1
+
+
+@pytest.mark.parametrize('suffix', ['.csv', '.parquet'])
+def test_iter_predictions(tmp_path, suffix):
+    if suffix == '.parquet':
+        pytest.importorskip('pyarrow')
+    sf.write(str(tmp_path / 'a.wav'), np.random.default_rng(0).uniform(-0.5, 0.5, 10 * 1000), 1000)
+    dataset = InferenceDataset(tmp_path / 'a.wav', preprocessors={}, seq_length=1, overlap=0.5,
+                               data_sample_rate=1000, sample_rate=1000)
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(1000, 3))
+    data_loader = torch.utils.data.DataLoader(dataset, batch_size=4)
+    output_file = tmp_path / f'results{suffix}'
+    with create_results_writer(output_file) as writer:
+        for i, (metadata, predictions) in enumerate(iter_predictions(model, data_loader)):
+            assert predictions.shape == (len(metadata), 3)
+            assert np.allclose(predictions.sum(axis=1), 1)
+            results = pd.concat([metadata.reset_index(drop=True), pd.DataFrame(predictions, columns=list('abc'))],
+                                axis=1)
+            writer.write(results)
+            if i == 0 and suffix == '.csv':
+                # the first batch is on disk before the next one is predicted
+                assert len(pd.read_csv(output_file)) == 4
+    results = pd.read_csv(output_file) if suffix == '.csv' else pd.read_parquet(output_file)
+    assert np.allclose(results['begin_time'], dataset.metadata['begin_time'])
+    assert np.allclose(results[list('abc')].values, predict_proba(model, data_loader), atol=1e-6)
+
+
+def test_infer_without_metadata_streams_raven(tmp_path, monkeypatch):
+    data_path, output_path = tmp_path / 'data', tmp_path / 'outputs'
+    data_path.mkdir()
+    output_path.mkdir()
+    rng = np.random.default_rng(0)
+    for name, seconds in [('a', 7), ('b', 4)]:
+        sf.write(str(data_path / f'{name}.wav'), rng.uniform(-0.5, 0.5, (seconds * 1000, 2)), 1000)
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(1000, 3))
+    monkeypatch.setattr('soundbay.inference.load_model', lambda model_args, state_dict: model)
+    dataset_args = DictConfig({'_target_': 'soundbay.data.InferenceDataset', 'file_path': str(data_path),
+                               'preprocessors': {}, 'seq_length': 1, 'overlap': 0.5, 'data_sample_rate': 1000,
+                               'sample_rate': 1000})
+    with pytest.raises(ValueError):
+        infer_without_metadata(torch.device('cpu'), 5, dataset_args, None, None, output_path, 'm', True, 0.3, None,
+                               None, results_format='prquet')
+    infer_without_metadata(torch.device('cpu'), 5, dataset_args, None, None, output_path, 'm', True, 0.3, None, None,
+                           raven={'min_gap': None})
+    results = pd.read_csv(next(output_path.glob('*.csv')))
+    assert len(results) == len(InferenceDataset(**{k: v for k, v in dataset_args.items() if k != '_target_'}))
+
+    # the selections written per file as its batches finish are the ones of the whole file
+    for file, df in results.groupby('filename'):
+        expected = pd.concat([inference_csv_to_raven(df, 3, 1, name, threshold=0.3, class_name=name, max_freq=500)
+                              for name in ['Call_1', 'Call_2']]).sort_values('Begin Time (s)', kind='stable')
+        raven = pd.read_csv(next((output_path / 'data').glob(f'{Path(file).stem}-*.txt')), sep='\t')
+        assert len(raven) == len(expected) > 0
+        assert (raven['Selection'] == np.arange(1, len(raven) + 1)).all()
+        assert np.allclose(raven['Begin Time (s)'], expected['Begin Time (s)'])
+        # selections with the same begin time (channels, classes) may come in another order
+        columns = ['Begin Time (s)', 'Channel', 'Annotation']
+        raven, expected = [df[columns].sort_values(columns).reset_index(drop=True) for df in [raven, expected]]
+        assert np.allclose(raven['Begin Time (s)'], expected['Begin Time (s)'])
+        assert (raven[['Channel', 'Annotation']].values == expected[['Channel', 'Annotation']].values).all()
+
+
+def test_extract_events():
+    # one file and channel: the call windows 1-2 overlap, 5 is a window apart and 7 dips below the threshold
+    probabilities = np.array([0.1, 0.9, 0.6, 0.2, 0.1, 0.8, 0.1, 0.4, 0.7, 0.1])
+    results = pd.DataFrame({'filename': 'a.wav', 'channel': 0, 'begin_time': np.arange(10) * 0.5,
+                            'end_time': np.arange(10) * 0.5 + 1, 'Noise': 1 - probabilities, 'Call': probabilities})
+    events = extract_events(results, ['Noise', 'Call'], threshold=0.5)
+    assert list(events.columns) == ['filename'] + RAVEN_COLUMNS
+    assert np.allclose(events[['Begin Time (s)', 'End Time (s)']].values, [[0.5, 2], [2.5, 3.5], [4, 5]])
+    assert list(events['Probability']) == ['0.900', '0.800', '0.700']
+    assert list(events['Selection']) == [1, 2, 3]
+    # the events at most min_gap apart are merged
+    events = extract_events(results, ['Noise', 'Call'], threshold=0.5, min_gap=0.5)
+    assert np.allclose(events[['Begin Time (s)', 'End Time (s)']].values, [[0.5, 5]])
+    assert list(events['Annotation']) == ['Call, 0.900']
+    # the hysteresis keeps an event going through window 7, which then touches the event of window 5
+    events = extract_events(results, ['Noise', 'Call'], threshold=0.5, low_threshold=0.3)
+    assert np.allclose(events[['Begin Time (s)', 'End Time (s)']].values, [[0.5, 2], [2.5, 5]])
+    # windows above the low threshold alone are not an event
+    assert len(extract_events(results, ['Noise', 'Call'], threshold=0.95, low_threshold=0.3)) == 0
+    # the windows given by their index are the same events as all the windows
+    windows = results.assign(window=np.arange(10))[probabilities > 0.3]
+    assert extract_events(windows, ['Noise', 'Call'], threshold=0.5, low_threshold=0.3).equals(events)
+
+
+def test_raven_writer(tmp_path):
+    rng = np.random.default_rng(0)
+    files = [Path(f'{name}.wav') for name in 'abcd']
+    results = pd.concat([pd.DataFrame({'filename': file, 'channel': channel, 'begin_time': np.arange(40) * 0.5,
+                                       'end_time': np.arange(40) * 0.5 + 1}) for file in files for channel in [0, 1]],
+                        ignore_index=True)
+    results[['Noise', 'Call_1', 'Call_2']] = rng.dirichlet([1, 1, 1], len(results))
+    raven_args = {'threshold': 0.5, 'low_threshold': 0.3, 'min_gap': 1}
+    # written in batches that split the files, a flush per file
+    with RavenWriter(tmp_path, 'm', flush_files=1, num_workers=2, **raven_args) as writer:
+        for first in range(0, len(results), 7):
+            writer.write(results.iloc[first:first + 7], ['Noise', 'Call_1', 'Call_2'])
+    expected = extract_events(results, ['Noise', 'Call_1', 'Call_2'], **raven_args)
+    assert len(expected) > 0
+    for file in files:
+        raven = pd.read_csv(next(tmp_path.glob(f'{file.stem}-Raven-*-m.txt')), sep='\t', dtype={'Probability': str})
+        assert list(raven.columns) == RAVEN_COLUMNS
+        file_events = expected[expected['filename'] == file][RAVEN_COLUMNS].reset_index(drop=True)
+        assert raven.equals(file_events.astype({'Channel': raven['Channel'].dtype}))
+
+
+def test_inference_server(tmp_path, monkeypatch):
+    data_path, output_path = tmp_path / 'data', tmp_path / 'outputs'
+    data_path.mkdir()
+    output_path.mkdir()
+    rng = np.random.default_rng(0)
+    for name, seconds in [('a', 7), ('b', 4), ('c', 3), ('d', 5)]:
+        sf.write(str(data_path / f'{name}.wav'), rng.uniform(-0.5, 0.5, (seconds * 1000, 2)), 1000)
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(1000, 3))
+    monkeypatch.setattr('soundbay.inference.load_model', lambda model_args, state_dict: model)
+    dataset_args = DictConfig({'_target_': 'soundbay.data.InferenceDataset', 'file_path': str(data_path),
+                               'preprocessors': {}, 'seq_length': 1, 'overlap': 0.5, 'data_sample_rate': 1000,
+                               'sample_rate': 1000})
+    infer_without_metadata(torch.device('cpu'), 5, dataset_args, None, None, output_path, 'm', True, 0.3, None, None)
+    expected = pd.read_csv(next(output_path.glob('*.csv')))
+
+    batcher = DynamicBatcher(model, max_batch_size=16, max_latency=0.5)
+    server = InferenceServer(('127.0.0.1', 0), batcher, dataset_args, threshold=0.3)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f'http://127.0.0.1:{server.server_address[1]}'
+    try:
+        responses = {}
+        clients = [threading.Thread(target=lambda f: responses.update({f.name: request_predictions(url, f)}),
+                                    args=(f,)) for f in sorted(data_path.iterdir())]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+    finally:
+        server.shutdown()
+        server.server_close()
+        batcher.close()
+
+    # the windows of the concurrent requests share batches, and get the results of infer_without_metadata
+    assert batcher.n_requests == 4
+    assert batcher.n_windows == len(expected)
+    assert batcher.n_batches < batcher.n_windows / 5
+    for name, (results, raven) in responses.items():
+        file_expected = expected[expected['filename'].map(lambda f: Path(f).name) == name].reset_index(drop=True)
+        assert (results['filename'] == name).all()
+        assert np.allclose(results[['channel', 'begin_time', 'end_time']], file_expected[['channel', 'begin_time',
+                                                                                          'end_time']])
+        assert np.allclose(results[['Noise', 'Call_1', 'Call_2']], file_expected[['Noise', 'Call_1', 'Call_2']],
+                           atol=1e-6)
+        expected_raven = pd.read_csv(next((output_path / 'data').glob(f'{Path(name).stem}-*.txt')), sep='\t')
+        assert len(raven) == len(expected_raven)
+        assert np.allclose(raven['Begin Time (s)'], expected_raven['Begin Time (s)'])
+
+
+class _TrickleStream:
+    """a stream that returns at most 7 bytes per read, so the frames are split between reads"""
+    def __init__(self, data):
+        self._stream = io.BytesIO(data)
+
+    def read(self, size):
+        return self._stream.read(min(size, 7))
+
+
+def test_pcm_sources(tmp_path):
+    audio = np.random.default_rng(0).integers(-2 ** 15, 2 ** 15, (3001, 2), dtype=np.int16)
+    sf.write(str(tmp_path / 'a.wav'), audio, 1000, subtype='PCM_16')
+    expected = sf.read(str(tmp_path / 'a.wav'), dtype='float32')[0]
+    chunks = list(pcm_source(_TrickleStream(audio.tobytes()), channels=2, chunk_frames=100))
+    assert np.array_equal(np.concatenate(chunks), expected)
+    assert np.array_equal(np.concatenate(list(file_replay_source(tmp_path / 'a.wav', chunk_frames=100, speed=0))),
+                          expected)
+
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+
+        def send():
+            connection, _ = listener.accept()
+            with connection:
+                connection.sendall(audio.tobytes())
+        sender = threading.Thread(target=send)
+        sender.start()
+        chunks = list(socket_source('127.0.0.1', listener.getsockname()[1], channels=2, chunk_frames=512))
+        sender.join()
+    assert np.array_equal(np.concatenate(chunks), expected)
+
+
+def test_streaming_detector(tmp_path, monkeypatch):
+    data_path, output_path = tmp_path / 'data', tmp_path / 'outputs'
+    data_path.mkdir()
+    output_path.mkdir()
+    # the duration is not a multiple of the step, so the stream ends with a window aligned to its end
+    sf.write(str(data_path / 'a.wav'), np.random.default_rng(0).uniform(-0.5, 0.5, (7300, 2)), 1000)
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(500, 3))
+    monkeypatch.setattr('soundbay.inference.load_model', lambda model_args, state_dict: model)
+    dataset_args = DictConfig({'_target_': 'soundbay.data.InferenceDataset', 'file_path': str(data_path),
+                               'preprocessors': {}, 'seq_length': 1, 'overlap': 0.5, 'data_sample_rate': 1000,
+                               'sample_rate': 500})
+    infer_without_metadata(torch.device('cpu'), 5, dataset_args, None, None, output_path, 'm', True, 0.3, None, None,
+                           raven={'min_gap': None})
+    expected = pd.read_csv(next((output_path / 'data').glob('a-*.txt')), sep='\t')
+
+    detector = StreamingDetector(model, torch.nn.Identity(), seq_length=1, data_sample_rate=1000, sample_rate=500,
+                                 overlap=0.5, batch_size=4, max_latency=0.05, threshold=0.3)
+    output = io.StringIO()
+    latencies = detector.run(file_replay_source(data_path / 'a.wav', chunk_frames=300, speed=20), output)
+    output.seek(0)
+    raven = pd.read_csv(output, sep='\t')
+
+    # the selections of the stream are the ones of the file, written as the windows arrive
+    assert list(raven.columns) == list(expected.columns)
+    assert len(raven) == len(expected) > 0
+    assert (raven['Selection'] == np.arange(1, len(raven) + 1)).all()
+    columns = ['Begin Time (s)', 'Channel', 'Annotation']
+    raven, expected = [df.sort_values(columns).reset_index(drop=True) for df in [raven, expected]]
+    assert np.allclose(raven[['Begin Time (s)', 'High Freq (Hz)']], expected[['Begin Time (s)', 'High Freq (Hz)']])
+    assert np.allclose(raven['End Time (s)'], raven['Begin Time (s)'] + 1)
+    assert (raven[['Channel', 'Annotation']].values == expected[['Channel', 'Annotation']].values).all()
+    assert set(latencies) == {'p50', 'p90', 'p99', 'max'}
+    assert 0 <= latencies['p50'] <= latencies['max'] < 1
+
+
+def _write_tone_bursts(path, sample_rate=4000):
+    """10 seconds of faint noise on 2 channels, with a 1kHz tone in [3, 5) on channel 0 and a 100Hz one in [6, 8)"""
+    rng = np.random.default_rng(0)
+    audio = rng.normal(0, 1e-3, (10 * sample_rate, 2))
+    t = np.arange(2 * sample_rate) / sample_rate
+    audio[3 * sample_rate:5 * sample_rate, 0] += 0.5 * np.sin(2 * np.pi * 1000 * t)
+    audio[6 * sample_rate:8 * sample_rate, 0] += 0.5 * np.sin(2 * np.pi * 100 * t)
+    sf.write(str(path), audio, sample_rate)
+
+
+@pytest.mark.parametrize('method', ['energy', 'flux'])
+def test_prescreen(tmp_path, method):
+    _write_tone_bursts(tmp_path / 'a.wav')
+    dataset = InferenceDataset(tmp_path / 'a.wav', preprocessors={}, seq_length=1, data_sample_rate=4000,
+                               sample_rate=4000)
+    # the band is 500-2000Hz, the 100Hz tone is out of it, and a steady tone has spectral flux only at its onset
+    scores = PreScreen(min_freq=500, max_freq=2000, method=method, n_fft=256).scores(dataset)
+    in_band = ((dataset.metadata['channel'] == 0) &
+               dataset.metadata['begin_time'].between(3, 4 if method == 'energy' else 3)).values
+    assert len(scores) == len(dataset)
+    assert scores[in_band].min() > scores[~in_band].max() + 10
+    threshold = calibrate_threshold(scores, in_band, max_recall_loss=0)
+    report = prescreen_report(scores, in_band, threshold)
+    assert report['recall_loss'] == 0 and report['skip_rate'] == 1 - in_band.mean()
+    assert (PreScreen(500, 2000, method, threshold, n_fft=256).keep_mask(dataset) == in_band).all()
+
+    # the windows of a labeled set are scored where ClassifierDataset reads them
+    metadata_path = tmp_path / 'metadata.csv'
+    pd.DataFrame({'filename': ['a'] * 3, 'begin_time': [0., 3., 6.], 'end_time': [2., 3.9, 8.],
+                  'call_length': [2., .9, 2.], 'label': [0, 1, 0], 'channel': [1, 1, 1]}).to_csv(metadata_path)
+    labeled = ClassifierDataset(tmp_path, metadata_path, augmentations=None, augmentations_p=0, preprocessors={},
+                                mode='test', slice_flag=True, seq_length=1, data_sample_rate=4000, sample_rate=4000)
+    is_call = labeled.metadata['label'].values == 1
+    report = prescreen_report(PreScreen(500, 2000, method, n_fft=256).scores(labeled), is_call, threshold)
+    assert report['recall_loss'] == 0 and report['skip_rate'] == (~is_call).mean()
+
+
+def test_iter_predictions_with_prescreen(tmp_path):
+    _write_tone_bursts(tmp_path / 'a.wav')
+    dataset = InferenceDataset(tmp_path / 'a.wav', preprocessors={}, seq_length=0.5, data_sample_rate=4000,
+                               sample_rate=4000)
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(2000, 3))
+    calls = []
+    model.register_forward_hook(lambda module, inputs, output: calls.append(len(inputs[0])))
+    prescreen = PreScreen(500, 2000, n_fft=256, threshold=-20)
+    keep = prescreen.keep_mask(dataset)
+    assert 0 < keep.sum() < len(dataset)
+    data_loader = DataLoader(dataset, batch_size=3)
+    expected = predict_proba(model, data_loader)
+    calls.clear()
+    batches = list(iter_predictions(model, data_loader, prescreen=prescreen))
+
+    # only the kept windows go through the model, and the skipped ones are noise, in the order of the metadata
+    assert sum(calls) == keep.sum()
+    assert all(len(predictions) <= 3 for _, predictions in batches)
+    assert pd.concat([metadata for metadata, _ in batches]).equals(dataset.metadata)
+    predictions = np.concatenate([predictions for _, predictions in batches])
+    assert np.allclose(predictions[keep], expected[keep])
+    assert (predictions[~keep] == [1, 0, 0]).all()
+
+
+@pytest.mark.parametrize('second_stage_input', ['features', 'waveforms', 'read'])
+def test_cascade(tmp_path, monkeypatch, capsys, second_stage_input):
+    sf.write(str(tmp_path / 'a.wav'), np.random.default_rng(0).uniform(-0.5, 0.5, (6000, 2)), 1000)
+    peak = {'peak': {'_target_': 'soundbay.data.PeakNormalize'}}
+    # the second stage preprocesses like the first, has the same sample rate only, or neither
+    second_preprocessors, second_sample_rate = {'features': ({}, 1000), 'waveforms': (peak, 1000),
+                                                'read': (peak, 500)}[second_stage_input]
+    dataset_args = {'preprocessors': {}, 'seq_length': 1, 'overlap': 0.5, 'data_sample_rate': 1000,
+                    'sample_rate': 1000, 'batch_preprocessing': second_stage_input == 'waveforms'}
+    torch.manual_seed(0)
+    first_model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(1000, 3))
+    second_model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(second_sample_rate, 3))
+    dataset = InferenceDataset(tmp_path / 'a.wav', **dataset_args)
+    first_stage = predict_proba(first_model, DataLoader(dataset, batch_size=4))
+    second_dataset = InferenceDataset(tmp_path / 'a.wav', preprocessors=second_preprocessors, seq_length=1,
+                                      overlap=0.5, data_sample_rate=1000, sample_rate=second_sample_rate)
+    second_stage = predict_proba(second_model, DataLoader(second_dataset, batch_size=4))
+    band = tuple(np.quantile(1 - first_stage[:, 0], [0.3, 0.7]))
+    escalate = ((1 - first_stage[:, 0]) >= band[0]) & ((1 - first_stage[:, 0]) <= band[1])
+    expected = np.where(escalate[:, None], second_stage, first_stage)
+
+    cascade = Cascade(second_model, second_preprocessors, second_sample_rate, band, first_stage_preprocessors={})
+    predictions = predict_proba(first_model, DataLoader(dataset, batch_size=4), cascade=cascade)
+    assert cascade.input == second_stage_input
+    assert np.allclose(predictions, expected, atol=1e-6)
+    report = cascade.report(wall_time=1.)
+    assert report['escalated'] == escalate.sum() and report['windows'] == len(dataset)
+
+    # through infer_without_metadata, which loads the second stage from its checkpoint
+    second_args = OmegaConf.create({'model': {'model': {'_target_': 'unused'}}, 'data': {'train_dataset': {
+        'preprocessors': second_preprocessors, 'seq_length': 1, 'sample_rate': second_sample_rate}}})
+    monkeypatch.setattr('soundbay.inference.load_model',
+                        lambda model_args, state_dict: second_model if model_args.get('_target_') == 'unused'
+                        else first_model)
+    monkeypatch.setattr('torch.load', lambda path, map_location: {'args': second_args, 'model': None})
+    output_path = tmp_path / 'outputs'
+    output_path.mkdir()
+    infer_without_metadata(torch.device('cpu'), 4, DictConfig({'_target_': 'soundbay.data.InferenceDataset',
+                                                               'file_path': str(tmp_path / 'a.wav'),
+                                                               **dataset_args, 'batch_preprocessing': False}),
+                           DictConfig({'_target_': 'first'}), None, output_path, 'm', False, 0.5, None, None,
+                           cascade={'enabled': True, 'checkpoint': 'second.pth', 'band': list(band)})
+    results = pd.read_csv(next(output_path.glob('*.csv')))
+    assert np.allclose(results[['Noise', 'Call_1', 'Call_2']], expected, atol=1e-6)
+    out = capsys.readouterr().out
+    assert f'Cascade escalated {escalate.mean():.1%}' in out
+    # the dataset is switched to batch_preprocessing for the second stage to reuse the waveforms, with a notice
+    assert ('Notice: the cascade stages preprocess differently' in out) == (second_stage_input == 'waveforms')